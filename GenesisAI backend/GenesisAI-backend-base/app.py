@@ -1,13 +1,12 @@
-from flask import Flask, request, jsonify, Response
+from flask import Flask, request, jsonify, Response, stream_with_context
 from flask_cors import cross_origin
 import managers
+import openai
+import orjson
 import logging
 import os
 import azure.cognitiveservices.speech as speechsdk
 import time
-from pydub import AudioSegment
-from io import BytesIO
-import scipy.io.wavfile as wav # type: ignore
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -23,17 +22,281 @@ keyvault_manager = managers.KeyvaultManager()
 history_manager = managers.CosmosHistoryManager(logger=None)
 knowledge_manager = managers.StorageKnowledgeManager()
 model_manager = managers.GptModelManager(logger=None)
-
-# Get Keyvault client
-azure_keyvault_client = keyvault_manager.get_azure_keyvault_client()
+# Conversations read with the turns of the write-behind journal not saved in CosmosDB yet, and the recent turns cache
+history_manager.set_journal(model_manager.history_journal)
+history_manager.set_recent_turns_cache(model_manager.recent_turns_cache)
+# Stage pool shared by the request threads of the worker: each request runs its classification on its own thread and
+# queues up to 3 stages on the pool (history, speculative retrieval and rewrite), so by default the pool has 3 threads
+# per request thread (SERVER_THREADS, the --threads of the gunicorn workers)
+server_threads = int(os.environ.get("SERVER_THREADS", "16"))
+stage_scheduler = managers.StageScheduler(
+    max_workers=int(os.environ.get("STAGE_SCHEDULER_WORKERS") or server_threads * 3),
+    timeout_seconds=float(os.environ.get("STAGE_TIMEOUT_SECONDS", "30")))
+
+# Semantic answer cache for questions without conversation history
+answer_cache = None
+if 'true' in os.environ.get("SEMANTIC_CACHE", "true").lower():
+    answer_cache = managers.SemanticAnswerCache(
+        similarity_threshold=float(os.environ.get("SEMANTIC_CACHE_THRESHOLD", "0.95")),
+        max_entries=int(os.environ.get("SEMANTIC_CACHE_MAX_ENTRIES", "2000")),
+        ttl_seconds=float(os.environ.get("SEMANTIC_CACHE_TTL_SECONDS", "86400")))
+
+# Embedding-similarity fast path for topics 1 and 2 (skips the GPT model topic classification when confident)
+if 'true' in os.environ.get("TOPIC_FAST_PATH", "true").lower():
+    try:
+        model_manager.set_topic_classifier(managers.EmbeddingTopicClassifier(
+            knowledge_manager.embeddings,
+            similarity_threshold=float(os.environ.get("TOPIC_SIMILARITY_THRESHOLD", "0.90")),
+            margin_threshold=float(os.environ.get("TOPIC_MARGIN_THRESHOLD", "0.05")),
+            centroids_path=os.environ.get("TOPIC_CENTROIDS_FILE") or None))
+    except Exception as e:
+        logger.error(f"Topic fast path disabled: {e}")
 
 # Load some environment variables
-backend_api_key = azure_keyvault_client.get_secret("BACKEND-API-KEY").value
+backend_api_key = keyvault_manager.get_secret("BACKEND-API-KEY")
 aisearch_top_n = os.environ['AISEARCH_TOP_N']
 frontend_endpoint = os.environ["FRONTEND_ENDPOINT"]
+# combined = single pre-classification call / sequential = one call per classifier
+preclassify_mode = os.environ.get("PRECLASSIFY_MODE", "combined").lower()
+# true = run the independent pre-generation stages at the same time
+stage_scheduler_enabled = 'true' in os.environ.get("STAGE_SCHEDULER", "true").lower()
 
 # Dashboard api key for feedback endpoint
-dashboard_api_key = azure_keyvault_client.get_secret("DASHBOARD-API-KEY").value
+dashboard_api_key = keyvault_manager.get_secret("DASHBOARD-API-KEY")
+
+# Timing spans of the request stages, exported on /metrics (Prometheus text format)
+stage_metrics = model_manager.stage_metrics
+metrics_endpoint_enabled = 'true' in os.environ.get("METRICS_ENDPOINT", "true").lower()
+
+# Speech to text and text to speech (shared with the ASGI endpoints)
+speech_config_pool = managers.SpeechConfigPool(
+    keyvault_manager,
+    max_recognitions=int(os.environ.get("SPEECH_MAX_RECOGNITIONS", "16")),
+    max_configs_per_language=int(os.environ.get("SPEECH_CONFIGS_PER_LANGUAGE", "4")),
+    queue_timeout_seconds=float(os.environ.get("SPEECH_QUEUE_TIMEOUT_SECONDS", "30")))
+speech_manager = managers.SpeechManager(keyvault_manager, stage_metrics, speech_config_pool,
+                                        ffmpeg_path=os.environ.get("FFMPEG_PATH", "ffmpeg"),
+                                        spool_folder=os.environ.get("SPEECH_SPOOL_FOLDER") or None,
+                                        recognize_once_max_seconds=float(os.environ.get("SPEECH_RECOGNIZE_ONCE_MAX_SECONDS", "15")),
+                                        recognition_timeout_seconds=float(os.environ.get("SPEECH_RECOGNITION_TIMEOUT_SECONDS", "30")),
+                                        stream_max_seconds=float(os.environ.get("SPEECH_STREAM_MAX_SECONDS", "300")),
+                                        stream_idle_timeout_seconds=float(os.environ.get("SPEECH_STREAM_IDLE_TIMEOUT_SECONDS", "10")))
+
+
+# Method to get the knowledge context of a question (from the retrieval cache when possible)
+def get_knowledge_context(question, retriever):
+    return knowledge_manager.get_knowledge_context(question, aisearch_top_n,
+                                                   lambda: model_manager.get_context_string(question, retriever))
+
+
+# Method to get the stream format of a chat request: the "stream_format" field ("legacy", "ndjson" or "sse"), or the
+# Accept header (application/x-ndjson or text/event-stream), or STREAM_FORMAT
+def get_stream_format(prompt_request, accept):
+    stream_format = str(prompt_request.get('stream_format') or '').strip().lower()
+    if stream_format:
+        return stream_format
+    accept = accept or ''
+    if 'text/event-stream' in accept:
+        return 'sse'
+    if 'application/x-ndjson' in accept:
+        return 'ndjson'
+    return None
+
+
+# Method to stream the answer of a chat request in its stream format
+def stream_response(framer, *generate_args):
+    return Response(model_manager.generate(*generate_args, framer=framer), mimetype=framer.mimetype, headers=framer.headers)
+
+
+# Method to get the events of a streamed speech recognition as JSON lines (an exception ends the stream with an
+# "error" event, the response status is already sent)
+def speech_stream_lines(events):
+    try:
+        for event in events:
+            yield orjson.dumps(event) + b"\n"
+    except Exception as e:
+        yield orjson.dumps({"type": "error", "message": str(e)}) + b"\n"
+
+
+# Method to get the conversation history (formatted last turns)
+def get_conversation_history(conversation_id):
+    return managers.await_cosmosdb_function(history_manager.get_last_conversation_items(conversation_id))
+
+
+# Method to classify the user prompt: topic, translated user prompt and client topic
+# prompt_topic is the topic of the embedding-similarity fast path (None if it wasn't confident)
+def classify_user_prompt(request_context, user_prompt, language, client_topic_others, prompt_topic):
+
+    # Get the prompt topic, language, client topic and translation in a single call (if enabled)
+    classification = None
+    if prompt_topic is None and preclassify_mode == 'combined':
+        classification = request_context.timed('pre_classification', model_manager.get_prompt_classification,
+                                               request_context, user_prompt, client_topic_others)
+
+    # Get the prompt topic (if the fast path wasn't confident)
+    if prompt_topic is None:
+        if classification:
+            prompt_topic = classification['topic']
+        else:
+            prompt_topic = request_context.timed('topic_classification', model_manager.get_prompt_topic, request_context, user_prompt)
+    print(prompt_topic)
+
+    if 'Responsible AI Policy Violation' in prompt_topic:
+        return {"topic": prompt_topic, "user_prompt": user_prompt, "client_topic": prompt_topic}
+
+    # Get the prompt language
+    if classification:
+        promptLanguage = classification['language']
+    else:
+        promptLanguage = request_context.timed('language_classification', model_manager.get_prompt_language, request_context, user_prompt)
+
+    # Translate the user prompt if the frontend language is different from the user language
+    if promptLanguage != language and (not user_prompt.isdigit()) and (len(user_prompt) > 1):
+        if classification and classification['translated_prompt']:
+            user_prompt = classification['translated_prompt']
+        else:
+            user_prompt = request_context.timed('translation', model_manager.translate_prompt, request_context, user_prompt)
+
+    # Get the client topic (topics 1 and 2 don't need it)
+    if prompt_topic in ('1', '2'):
+        client_topic = client_topic_others
+    elif classification:
+        client_topic = classification['client_topic']
+    else:
+        client_topic = request_context.timed('client_topic_classification', model_manager.get_client_topic,
+                                             request_context, user_prompt, client_topic_others)
+
+    return {"topic": prompt_topic, "user_prompt": user_prompt, "client_topic": client_topic}
+
+
+# Method to rewrite the classified user prompt based on the conversation context (if there's a conversation history)
+def rewrite_classified_prompt(request_context, classification, conversation_history, client_topic_others):
+
+    if classification['topic'] in ('1', '2') or 'Responsible AI Policy Violation' in classification['topic']:
+        return classification['user_prompt']
+
+    if client_topic_others.lower() in classification['client_topic'].lower():
+        return model_manager.rewrite_user_prompt(request_context, classification['user_prompt'], conversation_history)
+
+    return classification['user_prompt']
+
+
+# Method to prepare the answer of a chat request: classification, history, retrieval and the RAG chain
+# Returns the arguments of GptModelManager.generate/agenerate (without the stream framer)
+def prepare_completion(request_context, user_prompt, language, conversation_id, audio_duration):
+
+    # Add element to context list (to be used only if user_survey_profile exists)
+    #request_context.add_element_to_context_list(user_survey_profile)
+
+    client_topic_others = model_manager.get_client_topic_others(language)
+
+    # Get the knowledge context retriever
+    retriever = knowledge_manager.get_knowledgecontext_retriever(aisearch_top_n)
+
+    # Get the prompt topic from the embedding-similarity fast path (only confident topics 1 and 2, which need neither the
+    # conversation history nor the knowledge context)
+    fast_prompt_topic = request_context.timed('topic_fast_path', model_manager.get_prompt_topic_fast, user_prompt)
+
+    stages = None
+    if stage_scheduler_enabled and fast_prompt_topic is None:
+        # Run the classifiers, the history fetch and a speculative retrieval (with the raw user prompt) at the same time
+        # The classification runs on the request thread (when its result is asked), the other stages on the pool
+        stages = stage_scheduler.new_run()
+        stages.add('classification', lambda: request_context.timed('classification', classify_user_prompt, request_context, user_prompt, language, client_topic_others, None),
+                   inline=True)
+        history_stage = stages.add('history', lambda: request_context.timed('history', get_conversation_history, conversation_id))
+        retrieval_stage = stages.add('retrieval', lambda: request_context.timed('speculative_retrieval', get_knowledge_context, user_prompt, retriever))
+        # The rewrite starts as soon as the classification and the history are ready
+        rewrite_stage = stages.add('rewrite',
+                                   lambda classification, conversation_history: request_context.timed('rewrite', rewrite_classified_prompt, request_context, classification, conversation_history, client_topic_others),
+                                   depends_on=('classification', 'history'))
+
+        classification = stages.result('classification')
+    else:
+        classification = request_context.timed('classification', classify_user_prompt, request_context, user_prompt, language, client_topic_others, fast_prompt_topic)
+
+    prompt_topic = classification['topic']
+    client_topic = classification['client_topic']
+
+    # Policy violations and topics 1 and 2 don't use the history, the rewrite and the speculative retrieval (cancelled
+    # if they haven't started yet)
+    if stages is not None and (prompt_topic in ('1', '2') or 'Responsible AI Policy Violation' in prompt_topic):
+        for stage in (history_stage, retrieval_stage, rewrite_stage):
+            stage.cancel()
+
+    if 'Responsible AI Policy Violation' in prompt_topic:
+        rag_chain = None
+        return (request_context, rag_chain, user_prompt, conversation_id, prompt_topic, audio_duration, None)
+
+    on_complete = None
+
+    # Get the (translated if needed) user prompt
+    raw_user_prompt = user_prompt
+    user_prompt = classification['user_prompt']
+
+    # If topics 1 or 2, get the langchain RAG chain for topics 1 and 2
+    if prompt_topic in ('1', '2'):
+        
+        # Get the langchain RAG chain for topics 1 and 2
+        rag_chain = request_context.timed('chain_build', model_manager.get_ragChain_topics_1and2, request_context, user_prompt)
+
+    else:
+        print("Client topic: "+client_topic)
+
+        if stages is not None:
+            conversation_history = stages.result('history')
+            rewriten_user_prompt = stages.result('rewrite')
+
+            # The speculative retrieval is only used if the user prompt wasn't translated or rewritten
+            if rewriten_user_prompt != raw_user_prompt:
+                retrieval_stage.cancel()
+        else:
+            # Get conversation history
+            conversation_history = request_context.timed('history', get_conversation_history, conversation_id)
+
+            # Rewrite the user prompt based on the conversation context (if there's a conversation history)
+            rewriten_user_prompt = request_context.timed('rewrite', rewrite_classified_prompt, request_context, classification, conversation_history, client_topic_others)
+
+        print("User question: "+rewriten_user_prompt)
+
+        # Look for a cached answer to a similar question (not used with conversation history)
+        cached_answer = None
+        if answer_cache is not None:
+            if conversation_history:
+                answer_cache.record_bypass()
+            else:
+                try:
+                    with request_context.span('answer_cache_lookup'):
+                        index_version = knowledge_manager.get_index_version()
+                        query_embedding = knowledge_manager.embeddings.embed_query(rewriten_user_prompt)
+                        cached_answer = answer_cache.get(query_embedding, language, client_topic, index_version)
+
+                    # Cache the answer when the stream finishes
+                    on_complete = lambda full_response: answer_cache.put(query_embedding, language, client_topic, index_version, full_response)
+                except Exception as e:
+                    print(f"Semantic answer cache unavailable: {e}")
+
+        if cached_answer is not None:
+            # Stream the cached answer
+            rag_chain = managers.CachedAnswerChain(cached_answer)
+            on_complete = None
+            if stages is not None:
+                retrieval_stage.cancel()
+        else:
+            # Get the knowledge context (from the speculative retrieval, if used and successful)
+            context_string = None
+            if stages is not None and not retrieval_stage.cancelled():
+                try:
+                    context_string = stages.result('retrieval')
+                except Exception as e:
+                    print(f"Speculative retrieval failed: {e}")
+            if context_string is None:
+                context_string = request_context.timed('retrieval', get_knowledge_context, rewriten_user_prompt, retriever)
+
+            # Get the main langchain RAG chain
+            rag_chain = request_context.timed('chain_build', model_manager.get_main_rag_chain, request_context, rewriten_user_prompt, conversation_history, retriever, context_string)
+
+    return (request_context, rag_chain, user_prompt, conversation_id, client_topic, audio_duration, on_complete)
 
 
 ###############################
@@ -46,7 +309,7 @@ def stream():
     try:
         
         # Record the start time to process the citizen question
-        model_manager.set_start_time()
+        start_time = time.time()
 
         # Check if the request has the correct backend API key
         if request.headers.get("api-key") != backend_api_key:
@@ -66,74 +329,92 @@ def stream():
         except Exception as e:
             audio_duration = 0    
 
-        # Set the langchain model client object
-        model_manager.set_language(language)
-        model_manager.set_llm_model()
+        # Create the request context (language, langchain model client object, start time and token usage)
+        request_context = model_manager.new_request_context(language, start_time)
 
-        # Add element to context list (to be used only if user_survey_profile exists)
-        #model_manager.add_element_to_context_list(user_survey_profile)
+        # Stream format of the answer (legacy format for the old frontends)
+        framer = model_manager.new_stream_framer(get_stream_format(prompt_request, request.headers.get('Accept')))
 
-        # Get the prompt topic
-        prompt_topic = model_manager.get_prompt_topic(user_prompt)    
-        print(prompt_topic)
-
-        if 'Responsible AI Policy Violation' in prompt_topic:
-            rag_chain = None
-            # Generate the model response and stream it to the frontend
-            return Response(model_manager.generate(rag_chain, user_prompt, conversation_id, prompt_topic, audio_duration), mimetype='text/plain')
+        # Generate the model response and stream it to the frontend
+        return stream_response(framer, *prepare_completion(request_context, user_prompt, language, conversation_id, audio_duration))
+        
 
+    # Handle exceptions
+    except Exception as e:
+            # Read the Azure OpenAI secrets again on the next request (they may have been rotated)
+            if isinstance(e, openai.AuthenticationError):
+                model_manager.llm_client_registry.invalidate_credentials()
+            return jsonify({'Error processing user question': str(e)}), 500
 
-        # Get the prompt language
-        promptLanguage = model_manager.get_prompt_language(user_prompt)
 
-        # Translate the user prompt if the frontend language is different from the user language
-        if promptLanguage != language and (not user_prompt.isdigit()) and (len(user_prompt) > 1):
-            user_prompt = model_manager.translate_prompt(user_prompt)       
-        
-        client_topic_others = model_manager.get_client_topic_others(language)
-        
-        # If topics 1 or 2, get the langchain RAG chain for topics 1 and 2
-        if prompt_topic in ('1', '2'):
-            
-            # Get the langchain RAG chain for topics 1 and 2
-            rag_chain = model_manager.get_ragChain_topics_1and2(user_prompt)
-            
-            client_topic = client_topic_others    
-    
-        else:
-            conversation_history = ''
-            
-            # Get conversation history
-            conversation_history = managers.await_cosmosdb_function(history_manager.get_last_conversation_items(conversation_id))
+# Method to send the feedback of a message to the backoffice; returns the feedback of the conversation history
+# ("Like", "Dislike", or None when the feedback is removed)
+def send_backoffice_feedback(conversation_id, message_id, feedback):
 
-            # Get the client topic
-            client_topic = model_manager.get_client_topic(user_prompt, client_topic_others)
-            print("Client topic: "+client_topic)
+    # Backoffice feedback URL
+    feedback_url = "https://genhelpbackoffice-api.azurewebsites.net/v1/gpt/messages/feedback"
 
-            # Get the knowledge context retriever
-            retriever = knowledge_manager.get_knowledgecontext_retriever(aisearch_top_n)
+    if 'negative' in feedback.lower():
+       
+        thumbs_down_json = {
+        "projectId": keyvault_manager.get_secret("PROJECT-ID"),
+        "conversationId": conversation_id,            
+        "messageId": message_id,
+        "feedback": -1
+        }
 
-            # Rewrite the user prompt based on the conversation context (if there's a conversation history)
-            if client_topic_others.lower() in client_topic.lower():
-                # Rewrite the user prompt based on the conversation context (if there's a conversation history)    
-                rewriten_user_prompt = model_manager.rewrite_user_prompt(user_prompt, conversation_history)
-                # Get the main langchain RAG chain
-                rag_chain = model_manager.get_main_rag_chain(rewriten_user_prompt, conversation_history, retriever)
-                print("Rewriten User question: "+rewriten_user_prompt)
+        # Headers
+        headers = {                
+            "X-API-KEY": dashboard_api_key,
+            "Content-Type": "application/json"
+        }  
 
-            else:
-                # Get the main langchain RAG chain
-                rag_chain = model_manager.get_main_rag_chain(user_prompt, conversation_history, retriever)
-                print("User question: "+user_prompt)
+        if 'true' in (os.environ['PROD_FLAG']).lower():
+            # Make the POST requests (Uncomment for production stage)
+            model_manager.patch_data(feedback_url, thumbs_down_json, headers)
 
-            
-        # Generate the model response and stream it to the frontend
-        return Response(model_manager.generate(rag_chain, user_prompt, conversation_id, client_topic, audio_duration), mimetype='text/plain')
+        return "Dislike"
+   
+    elif 'positive' in feedback.lower():
+       
+        thumbs_up_json = {
+        "projectId": keyvault_manager.get_secret("PROJECT-ID"),
+        "conversationId": conversation_id,            
+        "messageId": message_id,
+        "feedback": 1
+        }
+       
+        # Headers
+        headers = {
+            "X-API-KEY": dashboard_api_key,
+            "Content-Type": "application/json"
+        }  
+
+        if 'true' in (os.environ['PROD_FLAG']).lower():
+            # Make the POST requests (Uncomment for production stage)
+            model_manager.patch_data(feedback_url, thumbs_up_json, headers)
         
+        return "Like"
+   
+    else:
+        no_feedback_json = {
+        "projectId": keyvault_manager.get_secret("PROJECT-ID"),
+        "conversationId": conversation_id,            
+        "messageId": message_id,
+        "feedback": 0
+        }
+       
+        # Headers
+        headers = {
+            "X-API-KEY": dashboard_api_key,
+            "Content-Type": "application/json"
+        }  
 
-    # Handle exceptions
-    except Exception as e:
-            return jsonify({'Error processing user question': str(e)}), 500
+        if 'true' in (os.environ['PROD_FLAG']).lower():           
+            # Make the POST requests (Uncomment for production stage)
+            model_manager.patch_data(feedback_url, no_feedback_json, headers)
+
+    return None
 
 
 ##############################
@@ -157,83 +438,12 @@ def feedback():
         feedback = prompt_request['feedback']
         conversation_id = request.headers.get("context-key")
  
-        # Backoffice feedback URL
-        feedback_url = "https://genhelpbackoffice-api.azurewebsites.net/v1/gpt/messages/feedback"
- 
-        if 'negative' in feedback.lower():
-           
-            thumbs_down_json = {
-            "projectId": azure_keyvault_client.get_secret("PROJECT-ID").value,
-            "conversationId": conversation_id,            
-            "messageId": message_id,
-            "feedback": -1
-            }
-
-            # Headers
-            headers = {                
-                "X-API-KEY": dashboard_api_key,
-                "Content-Type": "application/json"
-            }  
-
-            if 'true' in (os.environ['PROD_FLAG']).lower():
-                # Make the POST requests (Uncomment for production stage)
-                model_manager.patch_data(feedback_url, thumbs_down_json, headers)
-
-            conversation = managers.await_cosmosdb_function(history_manager.get_conversation(conversation_id))
-            
-            for item in conversation.Items:
-                if item.MessageId == message_id:                    
-                    item.Feedback = "Dislike"
-                    break
-                        
-            managers.await_cosmosdb_function(history_manager.update_conversation(conversation_id, conversation))
-       
-        elif 'positive' in feedback.lower():
-           
-            thumbs_up_json = {
-            "projectId": azure_keyvault_client.get_secret("PROJECT-ID").value,
-            "conversationId": conversation_id,            
-            "messageId": message_id,
-            "feedback": 1
-            }
-           
-            # Headers
-            headers = {
-                "X-API-KEY": dashboard_api_key,
-                "Content-Type": "application/json"
-            }  
-
-            if 'true' in (os.environ['PROD_FLAG']).lower():
-                # Make the POST requests (Uncomment for production stage)
-                model_manager.patch_data(feedback_url, thumbs_up_json, headers)
-            
-            conversation = managers.await_cosmosdb_function(history_manager.get_conversation(conversation_id))
-            
-            for item in conversation.Items:
-                if item.MessageId == message_id:                    
-                    item.Feedback = "Like"
-                    break
-                        
-            managers.await_cosmosdb_function(history_manager.update_conversation(conversation_id, conversation))
-       
-        else:
-            no_feedback_json = {
-            "projectId": azure_keyvault_client.get_secret("PROJECT-ID").value,
-            "conversationId": conversation_id,            
-            "messageId": message_id,
-            "feedback": 0
-            }
-           
-            # Headers
-            headers = {
-                "X-API-KEY": dashboard_api_key,
-                "Content-Type": "application/json"
-            }  
-
-            if 'true' in (os.environ['PROD_FLAG']).lower():           
-                # Make the POST requests (Uncomment for production stage)
-                model_manager.patch_data(feedback_url, no_feedback_json, headers)
-           
+        # Send the feedback to the backoffice
+        history_feedback = send_backoffice_feedback(conversation_id, message_id, feedback)
+
+        if history_feedback:
+            # Only the Feedback field of the message is updated (in the background with the write-behind journal)
+            managers.await_cosmosdb_function(history_manager.set_feedback(conversation_id, message_id, history_feedback))
        
         return Response(status=200)
    
@@ -242,6 +452,76 @@ def feedback():
             return jsonify({'Error processing feedback': str(e)}), 500
     
 
+#################################
+## Cache statistics endpoint ##
+#################################
+@app.route('/genesisai-cache-stats', methods=['GET'])
+def cache_stats():
+
+    # Check if the request has the correct backend API key
+    if request.headers.get("api-key") != backend_api_key:
+        return jsonify({'error': 'Unauthorized'}), 401
+
+    stats = {}
+    if answer_cache is not None:
+        stats['semantic_answer_cache'] = answer_cache.get_stats()
+    if model_manager.memo_cache is not None:
+        stats['classifier_memo_cache'] = model_manager.memo_cache.get_stats()
+    stats['embeddings_cache'] = knowledge_manager.embeddings.get_stats()
+    stats['llm_clients'] = model_manager.llm_client_registry.get_stats()
+    stats['keyvault_secrets'] = keyvault_manager.secret_cache.get_stats()
+    stats['backoffice_dispatcher'] = model_manager.backoffice_dispatcher.get_stats()
+    stats['backoffice_context_ids'] = model_manager.context_id_cache.get_stats()
+    stats['cosmos_history'] = history_manager.get_stats()
+    if model_manager.history_journal is not None:
+        stats['history_journal'] = model_manager.history_journal.get_stats()
+    if model_manager.recent_turns_cache is not None:
+        stats['recent_turns_cache'] = model_manager.recent_turns_cache.get_stats()
+    if knowledge_manager.retrieval_cache is not None:
+        stats['retrieval_cache'] = knowledge_manager.retrieval_cache.get_stats()
+    stats['speech_recognitions'] = speech_config_pool.get_stats()
+
+    return jsonify(stats)
+
+
+#########################
+## Prometheus metrics ##
+#########################
+# Stage latency histograms of all the workers (genesisai_stage_seconds, by stage and outcome)
+@app.route('/metrics', methods=['GET'])
+def metrics():
+
+    if not metrics_endpoint_enabled:
+        return jsonify({'error': 'Not found'}), 404
+
+    metrics_data, content_type = stage_metrics.export()
+    return Response(metrics_data, content_type=content_type)
+
+
+######################################
+## Knowledge caches purge endpoint ##
+######################################
+# Called by the ingestion job after reindexing
+@app.route('/genesisai-knowledge-purge', methods=['POST'])
+def knowledge_purge():
+
+    try:
+        # Check if the request has the correct backend API key
+        if request.headers.get("api-key") != backend_api_key:
+            return jsonify({'error': 'Unauthorized'}), 401
+
+        # New index version for all the workers, and clear the caches of this worker
+        index_version = knowledge_manager.purge_caches()
+        if answer_cache is not None:
+            answer_cache.clear()
+
+        return jsonify({'status': 'purged', 'index_version': index_version})
+
+    # Handle exceptions
+    except Exception as e:
+            return jsonify({'Error purging the knowledge caches': str(e)}), 500
+
+
 ####################################
 ## Speech to text backend endpoint##
 ####################################
@@ -267,77 +547,56 @@ def speech_to_text():
         # Get the request language
         language = request.headers.get("language")
                 
-        # Read the uploaded file
-        audio = AudioSegment.from_file(file)
-        # Convert to mono (1 channel), 32-bits per samples and 48KHz sample rate
-        audio = audio.set_channels(1).set_frame_rate(48000).set_sample_width(4)
-        # Save to a BytesIO object
-        output = BytesIO()
-        audio.export(output, format="wav")
-        output.seek(0)
-        # Read the WAV file using scipy
-        sample_rate, audio_data = wav.read(output)
-
-        audio_bytes = audio_data.tobytes()
+        # Decode the uploaded file (mono, 16-bits per sample, 16KHz PCM) and get the audio duration in seconds
+        pcm, audio_duration_seconds = speech_manager.decode_audio(file)
+
+        # Get the text of the audio (continuous recognition)
+        final_transcription = speech_manager.recognize(pcm, language)
+
+        # Convert the audio duration to minutes
+        audio_duration_minutes = audio_duration_seconds / 60
         
-        all_results = []
+        audio_duration_minutes_rounded = float(round(audio_duration_minutes, 5))              
 
-        channels = 1
-        bits_per_sample = 32
-        samples_per_second = 48000
+        return jsonify({"text": final_transcription, "audio_duration": audio_duration_minutes_rounded})
 
-        wave_format = speechsdk.audio.AudioStreamFormat(samples_per_second, bits_per_sample, channels)        
-        audio_input_stream = speechsdk.audio.PushAudioInputStream(stream_format=wave_format)
-        audio_config = speechsdk.audio.AudioConfig(stream=audio_input_stream)
+        
+    # Handle exceptions
+    except Exception as e:
+            return jsonify({'Error processing speech to text': str(e)}), 500
 
-        speech_config = speechsdk.SpeechConfig(subscription=azure_keyvault_client.get_secret("AISPEECH-KEY").value, region=azure_keyvault_client.get_secret("AISPEECH-REGION").value)
-        speech_config.speech_recognition_language = language
 
-        speech_recognizer = speechsdk.SpeechRecognizer(speech_config=speech_config, audio_config=audio_config)
 
-        done = False
+##############################################
+## Streaming speech to text backend endpoint##
+##############################################
+# The client uploads 16KHz 16-bits mono PCM with a chunked request while the user speaks, and reads the partial and
+# final results as JSON lines ({"type": "partial" | "final" | "error", ...}), then {"type": "done", "text": ...,
+# "audio_duration": ...} after the end of the upload
+# Browsers can't read the response of an upload that isn't finished: they use the WebSocket of the ASGI mode (asgi.py)
+@app.route('/genesisai-speech-stream', methods=['POST', 'OPTIONS'])
+@cross_origin(supports_credentials=True, origins=frontend_endpoint)
+def speech_to_text_stream():
 
-        def stop_cb(evt: speechsdk.SessionEventArgs):
-            """callback that signals to stop continuous transcription upon receiving an event `evt`"""
-            print('CLOSING {}'.format(evt))
-            nonlocal done
-            done = True
-        
-        # Subscribe to the events fired by the conversation transcriber
-        speech_recognizer.recognizing.connect(lambda evt: print('RECOGNIZING: {}'.format(evt)))
-        speech_recognizer.recognized.connect(lambda evt: all_results.append(evt.result.text))          
-        speech_recognizer.session_started.connect(lambda evt: print('SESSION STARTED: {}'.format(evt)))
-        speech_recognizer.session_stopped.connect(lambda evt: print('SESSION STOPPED {}'.format(evt)))
-        speech_recognizer.canceled.connect(lambda evt: print('CANCELED {}'.format(evt)))
-        # stop continuous transcription on either session stopped or canceled events
-        speech_recognizer.session_stopped.connect(stop_cb)
-        speech_recognizer.canceled.connect(stop_cb)
-
-        # Start continuous speech recognition
-        speech_recognizer.start_continuous_recognition()
-
-        # Read the whole wave files at once and stream it to sdk
-        #_, wav_data = wavfile.read(conversationfilename)
-        audio_input_stream.write(audio_bytes)
-        audio_input_stream.close()
-        while not done:
-            time.sleep(.5)
-        
-        speech_recognizer.stop_continuous_recognition()        
-              
-        final_transcription = ' '.join(all_results)
+    try:
 
-        # Get the audio duration in seconds
-        audio_duration_seconds = audio.duration_seconds
+        # Check if the request has the correct backend API key
+        if request.headers.get("api-key") != backend_api_key:
+            return jsonify({'error': 'Unauthorized'}), 500
 
-        # Convert the audio duration to minutes
-        audio_duration_minutes = audio_duration_seconds / 60
-        
-        audio_duration_minutes_rounded = float(round(audio_duration_minutes, 5))              
+        if not request.headers.get("language"):
+            return jsonify({"status": "error", "message": "No language header provided"}), 500
 
-        return jsonify({"text": final_transcription, "audio_duration": audio_duration_minutes_rounded})
+        # Audio chunks of the request body, read as they arrive (by a worker thread of the speech manager, so the
+        # stream is taken from the request here)
+        body_stream = request.stream
+        chunks = iter(lambda: body_stream.read(speech_manager.stream_chunk_bytes), b"")
+
+        # Recognize the audio while it is uploaded (the request context is kept while streaming)
+        events = speech_manager.stream_recognize(chunks, request.headers.get("language"))
+        return Response(stream_with_context(speech_stream_lines(events)), mimetype='application/x-ndjson',
+                        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
-        
     # Handle exceptions
     except Exception as e:
             return jsonify({'Error processing speech to text': str(e)}), 500
@@ -373,39 +632,8 @@ def text_to_speech():
         # Optional: voice name (you can customize based on language)
         voice_name = request_data.get('voice_name', None)
         
-        # Map language codes to Azure voice names if not provided
-        voice_map = {
-            'pt-PT': 'pt-PT-DuarteNeural',  # Portuguese (Portugal) - Male
-            'pt-BR': 'pt-BR-AntonioNeural',  # Portuguese (Brazil) - Male
-            'en-US': 'en-US-JennyNeural',    # English (US) - Female
-            'en-GB': 'en-GB-RyanNeural',     # English (UK) - Male
-            'es-ES': 'es-ES-AlvaroNeural',   # Spanish (Spain) - Male
-            'fr-FR': 'fr-FR-DeniseNeural',   # French - Female
-        }
-        
-        # Set voice name based on language if not provided
-        if not voice_name:
-            voice_name = voice_map.get(language, 'pt-PT-DuarteNeural')
-        
-        # Configure Azure Speech Service
-        speech_config = speechsdk.SpeechConfig(
-            subscription=azure_keyvault_client.get_secret("AISPEECH-KEY").value, 
-            region="eastus"#azure_keyvault_client.get_secret("AISPEECH-REGION").value
-        )
-        
-        # Set the voice name
-        speech_config.speech_synthesis_voice_name = voice_name
-        
-        # Set output format to high quality audio
-        speech_config.set_speech_synthesis_output_format(
-            speechsdk.SpeechSynthesisOutputFormat.Audio16Khz32KBitRateMonoMp3
-        )
-        
-        # Create a speech synthesizer with null output (we'll get the audio data directly)
-        synthesizer = speechsdk.SpeechSynthesizer(speech_config=speech_config, audio_config=None)
-        
-        # Perform text-to-speech
-        result = synthesizer.speak_text_async(text).get()
+        # Perform text-to-speech (the voice is based on the language if not provided)
+        result = speech_manager.synthesize(text, language, voice_name)
         
         # Check result
         if result.reason == speechsdk.ResultReason.SynthesizingAudioCompleted:
@@ -0,0 +1,315 @@
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Mount, Route, WebSocketRoute
+from starlette.websockets import WebSocketDisconnect
+from a2wsgi import WSGIMiddleware
+import azure.cognitiveservices.speech as speechsdk
+import managers
+import openai
+import orjson
+import anyio
+import asyncio
+import json
+import time
+
+# The Flask app module: same managers, helpers and environment variables as the WSGI mode
+import app as wsgi_app
+
+# ASGI app (SERVER_MODE=asgi): the chat, feedback and speech endpoints run on the event loop, so a worker holds many
+# streams at the same time (the GPT model stream and the speech recognition don't hold a thread while waiting)
+# The other endpoints (statistics, metrics, knowledge purge) are served by the Flask app
+# The pre-generation phase of the chat (classifiers, history, retrieval and rewrite) is made of blocking calls and runs in
+# threads: at most SERVER_THREADS requests of a worker prepare their answer at the same time (the others wait for a
+# thread), with the same stage pool as the WSGI mode; only the generation phase is bounded by memory
+
+model_manager = wsgi_app.model_manager
+history_manager = wsgi_app.history_manager
+speech_manager = wsgi_app.speech_manager
+backend_api_key = wsgi_app.backend_api_key
+
+# Threads of the pre-generation phase (apart from the threadpool of the other blocking calls, e.g. audio decoding)
+prepare_limiter = anyio.CapacityLimiter(wsgi_app.server_threads)
+
+# Same CORS rules as the flask_cors decorators of the Flask endpoints
+cors_middleware = [Middleware(CORSMiddleware, allow_origins=[wsgi_app.frontend_endpoint], allow_credentials=True,
+                              allow_methods=["*"], allow_headers=["*"])]
+
+
+# DuplexStreamingResponse class
+# StreamingResponse that doesn't wait for the client disconnect while streaming: that wait reads the request messages,
+# and the request body is still being read (streamed speech upload)
+class DuplexStreamingResponse(StreamingResponse):
+
+    async def __call__(self, scope, receive, send):
+        await self.stream_response(send)
+        if self.background is not None:
+            await self.background()
+
+
+# Method to get the events of a streamed speech recognition as JSON lines (an exception ends the stream with an
+# "error" event, the response status is already sent)
+async def aspeech_stream_lines(events):
+    try:
+        async for event in events:
+            yield orjson.dumps(event) + b"\n"
+    except Exception as e:
+        yield orjson.dumps({"type": "error", "message": str(e)}) + b"\n"
+
+
+###############################
+## Main backend chat endpoint##
+###############################
+async def stream(request):
+
+    try:
+
+        # Record the start time to process the citizen question
+        start_time = time.time()
+
+        # Check if the request has the correct backend API key
+        if request.headers.get("api-key") != backend_api_key:
+            return JSONResponse({'error': 'Unauthorized'}, status_code=500)
+
+        # Get the request JSON
+        prompt_request = await request.json()
+
+        # Get the user prompt, language, and conversation ID from the request
+        user_prompt = prompt_request['prompt']
+        language = prompt_request['language']
+        conversation_id = request.headers.get("context-key")
+        audio_duration = prompt_request.get('audio_duration', 0)
+
+        # Create the request context (language, langchain model client object, start time and token usage)
+        request_context = model_manager.new_request_context(language, start_time)
+
+        # Stream format of the answer (legacy format for the old frontends)
+        framer = model_manager.new_stream_framer(wsgi_app.get_stream_format(prompt_request, request.headers.get('Accept')))
+
+        # Classification, history and retrieval (blocking calls, run in at most SERVER_THREADS threads)
+        generate_args = await anyio.to_thread.run_sync(wsgi_app.prepare_completion, request_context, user_prompt, language,
+                                                       conversation_id, audio_duration, limiter=prepare_limiter)
+
+        # Generate the model response and stream it to the frontend
+        return StreamingResponse(model_manager.agenerate(*generate_args, framer=framer), media_type=framer.mimetype,
+                                 headers=framer.headers)
+
+    # Handle exceptions
+    except Exception as e:
+            # Read the Azure OpenAI secrets again on the next request (they may have been rotated)
+            if isinstance(e, openai.AuthenticationError):
+                model_manager.llm_client_registry.invalidate_credentials()
+            return JSONResponse({'Error processing user question': str(e)}, status_code=500)
+
+
+##############################
+## Feedback backend endpoint##
+##############################
+async def feedback(request):
+
+    try:
+
+        # Check if the request has the correct backend API key
+        if request.headers.get("api-key") != backend_api_key:
+            return JSONResponse({'error': 'Unauthorized'}, status_code=500)
+
+        # Get the request JSON
+        prompt_request = await request.json()
+
+        # Get the message ID, feedback, and conversation ID from the request
+        message_id = prompt_request['message_id']
+        conversation_id = request.headers.get("context-key")
+
+        # Send the feedback to the backoffice (queued by the backoffice dispatcher)
+        history_feedback = wsgi_app.send_backoffice_feedback(conversation_id, message_id, prompt_request['feedback'])
+
+        if history_feedback:
+            # Only the Feedback field of the message is updated (in the background with the write-behind journal)
+            await managers.run_cosmosdb_function(history_manager.set_feedback(conversation_id, message_id, history_feedback))
+
+        return Response(status_code=200)
+
+    # Handle exceptions
+    except Exception as e:
+            return JSONResponse({'Error processing feedback': str(e)}, status_code=500)
+
+
+####################################
+## Speech to text backend endpoint##
+####################################
+async def speech_to_text(request):
+
+    try:
+
+        # Check if the request has the correct backend API key
+        if request.headers.get("api-key") != backend_api_key:
+            return JSONResponse({'error': 'Unauthorized'}, status_code=500)
+
+        form = await request.form()
+        if 'file' not in form:
+            return JSONResponse({"status": "error", "message": "No audio file provided"}, status_code=500)
+
+        if not request.headers.get("language"):
+            return JSONResponse({"status": "error", "message": "No language header provided"}, status_code=500)
+
+        # Decode the uploaded file (mono, 16-bits per sample, 16KHz PCM) and get the audio duration in seconds
+        pcm, audio_duration_seconds = await run_in_threadpool(speech_manager.decode_audio, form['file'].file)
+
+        # Get the text of the audio (the recognition session is awaited on the event loop)
+        final_transcription = await speech_manager.arecognize(pcm, request.headers.get("language"))
+
+        # Convert the audio duration to minutes
+        audio_duration_minutes_rounded = float(round(audio_duration_seconds / 60, 5))
+
+        return JSONResponse({"text": final_transcription, "audio_duration": audio_duration_minutes_rounded})
+
+    # Handle exceptions
+    except Exception as e:
+            return JSONResponse({'Error processing speech to text': str(e)}, status_code=500)
+
+
+##############################################
+## Streaming speech to text backend endpoint##
+##############################################
+# WebSocket of the browsers: the first message is {"api_key": ..., "language": ...} (browsers can't set the WebSocket
+# headers, the api-key and language headers are also accepted), then binary messages of 16KHz 16-bits mono PCM while the
+# user speaks and {"type": "end"} at the end of the audio
+# The partial and final results are sent as they arrive ({"type": "partial" | "final" | "error", ...}), then
+# {"type": "done", "text": ..., "audio_duration": ...} and the WebSocket is closed
+async def speech_to_text_stream(websocket):
+
+    await websocket.accept()
+
+    try:
+
+        # Start message of the client (the connection is accepted before the authentication, so a client that doesn't
+        # send it is closed after the idle timeout of the speech streams)
+        try:
+            start_message = await asyncio.wait_for(websocket.receive_json(), speech_manager.stream_idle_timeout_seconds)
+        except asyncio.TimeoutError:
+            await websocket.close(code=1008)
+            return
+
+        # Check if the request has the correct backend API key
+        if (start_message.get("api_key") or websocket.headers.get("api-key")) != backend_api_key:
+            await websocket.send_json({"type": "error", "message": "Unauthorized"})
+            await websocket.close(code=1008)
+            return
+
+        language = start_message.get("language") or websocket.headers.get("language")
+        if not language:
+            await websocket.send_json({"type": "error", "message": "No language provided"})
+            await websocket.close(code=1008)
+            return
+
+        # Audio chunks of the client, until the "end" message (a disconnect ends the recognition)
+        async def audio_chunks():
+            while True:
+                message = await websocket.receive()
+                if message["type"] == "websocket.disconnect":
+                    raise WebSocketDisconnect(message.get("code", 1000))
+                if message.get("bytes"):
+                    yield message["bytes"]
+                elif message.get("text") and json.loads(message["text"]).get("type") == "end":
+                    return
+
+        # Recognize the audio while it arrives and send the results
+        async for event in speech_manager.astream_recognize(audio_chunks(), language):
+            await websocket.send_json(event)
+        await websocket.close()
+
+    # The client went away
+    except WebSocketDisconnect:
+        pass
+
+    # Handle exceptions
+    except Exception as e:
+        try:
+            await websocket.send_json({"type": "error", "message": str(e)})
+            await websocket.close(code=1011)
+        except Exception:
+            pass
+
+
+# Chunked HTTP upload of the same path (same events as JSON lines, like the Flask endpoint)
+async def speech_to_text_stream_upload(request):
+
+    try:
+
+        # Check if the request has the correct backend API key
+        if request.headers.get("api-key") != backend_api_key:
+            return JSONResponse({'error': 'Unauthorized'}, status_code=500)
+
+        if not request.headers.get("language"):
+            return JSONResponse({"status": "error", "message": "No language header provided"}, status_code=500)
+
+        # Recognize the request body while it is uploaded
+        events = speech_manager.astream_recognize(request.stream(), request.headers.get("language"))
+        return DuplexStreamingResponse(aspeech_stream_lines(events), media_type='application/x-ndjson',
+                                       headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+    # Handle exceptions
+    except Exception as e:
+            return JSONResponse({'Error processing speech to text': str(e)}, status_code=500)
+
+
+####################################
+## Text to speech backend endpoint##
+####################################
+async def text_to_speech(request):
+
+    try:
+
+        # Check if the request has the correct backend API key
+        if request.headers.get("api-key") != backend_api_key:
+            return JSONResponse({'error': 'Unauthorized'}, status_code=401)
+
+        # Get the request JSON
+        request_data = await request.json()
+
+        if not request_data or 'text' not in request_data:
+            return JSONResponse({"status": "error", "message": "No text provided"}, status_code=400)
+
+        if 'language' not in request_data:
+            return JSONResponse({"status": "error", "message": "No language provided"}, status_code=400)
+
+        # Perform text-to-speech (the voice is based on the language if not provided)
+        result = await speech_manager.asynthesize(request_data.get('text'), request_data.get('language'),
+                                                  request_data.get('voice_name', None))
+
+        # Check result
+        if result.reason == speechsdk.ResultReason.SynthesizingAudioCompleted:
+            # Return audio as response
+            return Response(result.audio_data, media_type='audio/mpeg',
+                            headers={'Content-Disposition': 'inline; filename="speech.mp3"'})
+
+        elif result.reason == speechsdk.ResultReason.Canceled:
+            cancellation_details = result.cancellation_details
+            wsgi_app.logger.error(f"Speech synthesis canceled: {cancellation_details.reason}")
+            if cancellation_details.reason == speechsdk.CancellationReason.Error:
+                wsgi_app.logger.error(f"Error details: {cancellation_details.error_details}")
+            return JSONResponse({
+                "status": "error",
+                "message": f"Speech synthesis canceled: {cancellation_details.reason}"
+            }, status_code=500)
+
+        return JSONResponse({"status": "error", "message": "Unknown error in speech synthesis"}, status_code=500)
+
+    # Handle exceptions
+    except Exception as e:
+        wsgi_app.logger.error(f"Error in text-to-speech: {str(e)}")
+        return JSONResponse({'Error processing text to speech': str(e)}, status_code=500)
+
+
+# Create the ASGI app (the routes not listed here go to the Flask app)
+app = Starlette(routes=[
+    Route('/genesisai-completions', stream, methods=['POST', 'OPTIONS'], middleware=cors_middleware),
+    Route('/genesisai-feedback', feedback, methods=['POST', 'OPTIONS'], middleware=cors_middleware),
+    Route('/genesisai-speech', speech_to_text, methods=['POST', 'OPTIONS'], middleware=cors_middleware),
+    Route('/genesisai-text-to-speech', text_to_speech, methods=['POST', 'OPTIONS'], middleware=cors_middleware),
+    Route('/genesisai-speech-stream', speech_to_text_stream_upload, methods=['POST', 'OPTIONS'], middleware=cors_middleware),
+    WebSocketRoute('/genesisai-speech-stream', speech_to_text_stream),
+    Mount('/', app=WSGIMiddleware(wsgi_app.app)),
+])
@@ -0,0 +1,164 @@
+# Concurrency check of GptModelManager: many requests at the same time on a single manager (as in a gthread worker)
+# Each request gets its own RequestContext; the check fails if any language, reply, token count or elapsed time of a
+# request shows up in another request
+# The GPT model and the CosmosDB save are replaced by fakes (no tokens spent, no conversations saved), but the
+# managers package still needs the backend environment (.env and Key Vault) to be imported
+#
+# Usage (from the backend folder):
+#   python benchmarks/concurrency_check.py [--requests 200] [--threads 32]
+
+import argparse
+import os
+import random
+import re
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+BACKEND_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_FOLDER)
+os.environ["PROD_FLAG"] = "false"
+
+from langchain_core.language_models.chat_models import BaseChatModel  # noqa: E402
+from langchain_core.messages import AIMessage, AIMessageChunk  # noqa: E402
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult  # noqa: E402
+import managers  # noqa: E402
+import managers.model.gptmodelmanager  # noqa: E402
+
+REQUEST_REGEX = re.compile(r"request (\d+)")
+LANGUAGES = ("pt", "en")
+
+
+# Expected token usage of each request: the topic classification call and the streamed answer
+def get_expected_tokens(request_number):
+    return {
+        "topic": (10 + request_number, 1),
+        "answer": (1000 + request_number, 20 + request_number % 7)
+    }
+
+
+# FakeChatModel class
+# Replies with the request number and the answer language of the system prompt, after random delays, and returns the
+# token usage expected for the request
+class FakeChatModel(BaseChatModel):
+
+    @property
+    def _llm_type(self):
+        return "fake-concurrency-check"
+
+    def _reply(self, messages):
+        request_number = int(REQUEST_REGEX.search(messages[-1].content).group(1))
+        system_prompt = messages[0].content
+        if system_prompt.startswith("Please classify the message"):
+            return request_number, "4", get_expected_tokens(request_number)["topic"]
+        language = "english" if "Always answer in english" in system_prompt else "portuguese"
+        return request_number, f"Answer to request {request_number} in {language}.", get_expected_tokens(request_number)["answer"]
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        time.sleep(random.uniform(0, 0.005))
+        _, content, (input_tokens, output_tokens) = self._reply(messages)
+        message = AIMessage(content=content, usage_metadata={"input_tokens": input_tokens, "output_tokens": output_tokens,
+                                                             "total_tokens": input_tokens + output_tokens})
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        request_number, content, (input_tokens, output_tokens) = self._reply(messages)
+        for word in re.findall(r"\S+\s*", content):
+            time.sleep(random.uniform(0, 0.003))
+            yield ChatGenerationChunk(message=AIMessageChunk(content=word, id=f"chatcmpl-{request_number}"))
+        yield ChatGenerationChunk(message=AIMessageChunk(content="", usage_metadata={
+            "input_tokens": input_tokens, "output_tokens": output_tokens, "total_tokens": input_tokens + output_tokens}))
+
+
+# Method to run a single request through the GptModelManager methods used by the chat endpoint
+def run_request(model_manager, request_number):
+    language = LANGUAGES[request_number % len(LANGUAGES)]
+    user_prompt = f"Hello, this is request {request_number}"
+    delay = random.uniform(0, 0.02)
+
+    request_context = model_manager.new_request_context(language, time.time())
+    time.sleep(delay)
+    model_manager.get_prompt_topic(request_context, user_prompt)
+    chain = model_manager.get_ragChain_topics_1and2(request_context, user_prompt)
+    chunks = list(model_manager.generate(request_context, chain, user_prompt, f"conversation-{request_number}", "", 0))
+
+    return {"language": language, "user_prompt": user_prompt, "delay": delay, "chunks": chunks}
+
+
+# Method to get the problems of a request (an empty list if everything belongs to the request)
+def check_request(request_number, request, saved_items):
+    problems = []
+    if len(saved_items) != 1:
+        return [f"{len(saved_items)} saved conversation items"]
+    item = saved_items[0]
+
+    expected_language = "english" if request["language"] == "en" else "portuguese"
+    expected_reply = f"Answer to request {request_number} in {expected_language}."
+    expected_tokens = get_expected_tokens(request_number)
+    expected_prompt_tokens = expected_tokens["topic"][0] + expected_tokens["answer"][0]
+    expected_completion_tokens = expected_tokens["topic"][1] + expected_tokens["answer"][1]
+
+    if item["Query"] != request["user_prompt"]:
+        problems.append(f"query {item['Query']!r}")
+    if item["Reply"] != expected_reply:
+        problems.append(f"reply {item['Reply']!r}")
+    if item["MessageId"] != f"chatcmpl-{request_number}":
+        problems.append(f"message id {item['MessageId']!r}")
+    if item["Usage"]["PromptTokens"] != expected_prompt_tokens:
+        problems.append(f"prompt tokens {item['Usage']['PromptTokens']} (expected {expected_prompt_tokens})")
+    if item["Usage"]["CompletionTokens"] != expected_completion_tokens:
+        problems.append(f"completion tokens {item['Usage']['CompletionTokens']} (expected {expected_completion_tokens})")
+    if float(item["ElapsedTime"].split()[0]) < request["delay"]:
+        problems.append(f"elapsed time {item['ElapsedTime']} shorter than the request delay {request['delay']:.5f}")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--threads", type=int, default=32)
+    args = parser.parse_args()
+
+    model_manager = managers.GptModelManager(logger=None)
+    fake_model = FakeChatModel()
+    model_manager.get_llm_model = lambda: fake_model
+    # Every request must reach the fake GPT model
+    model_manager.memo_cache = None
+    model_manager.topic_classifier = None
+
+    # Capture the conversation items instead of saving them in CosmosDB
+    saved_items = {}
+    saved_items_lock = threading.Lock()
+
+    async def save_conversation(conversation_id, conversation_item):
+        with saved_items_lock:
+            saved_items.setdefault(conversation_id, []).append(conversation_item)
+
+    managers.model.gptmodelmanager.history_manager.save_conversation = save_conversation
+    # Saved by the request itself (not by the write-behind journal)
+    model_manager.history_journal = None
+
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.threads) as executor:
+        requests = dict(zip(range(args.requests),
+                            executor.map(lambda request_number: run_request(model_manager, request_number), range(args.requests))))
+    elapsed_time = time.perf_counter() - start_time
+
+    failures = {}
+    for request_number, request in requests.items():
+        problems = check_request(request_number, request, saved_items.get(f"conversation-{request_number}", []))
+        if problems:
+            failures[request_number] = problems
+
+    print(f"{args.requests} requests on {args.threads} threads in {elapsed_time:.2f} seconds")
+    if failures:
+        for request_number, problems in sorted(failures.items())[:20]:
+            print(f"  request {request_number}: {'; '.join(problems)}")
+        print(f"FAILED: {len(failures)} requests with state from other requests")
+        sys.exit(1)
+    print("OK: no state shared between requests")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+# Check of the order in which the write-behind journal (HistoryJournal) saves the turns of a conversation
+# With the document layout the saved items are appended to the conversation document, so a turn saved before an older
+# one (e.g. the older one waiting for a retry) would stay out of order for good
+# The CosmosDB saves are replaced by a fake history manager that fails at random; the check fails if any conversation
+# gets its turns out of order, if a newer turn is saved while an older one waits for a retry, or if a process saves a
+# turn while another process is saving an older turn of the same conversation
+# The managers package still needs the backend environment (.env and Key Vault) to be imported
+#
+# Usage (from the backend folder):
+#   python benchmarks/history_journal_check.py [--conversations 50] [--turns 10] [--failure-rate 0.3]
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+BACKEND_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_FOLDER)
+
+import managers  # noqa: E402
+
+
+# FakeHistoryManager class
+# Keeps the saved items of each conversation in the save order; a save fails with failure_rate probability (or when
+# the conversation is in fail_conversations)
+class FakeHistoryManager:
+
+    def __init__(self, failure_rate:float = 0):
+        self.failure_rate = failure_rate
+        self.fail_conversations = set()
+        self.saved = {}
+        self._lock = threading.Lock()
+
+    async def save_conversation_items(self, conversation_id, conversation_items):
+        if conversation_id in self.fail_conversations or random.random() < self.failure_rate:
+            raise ConnectionError("Fake CosmosDB error")
+        with self._lock:
+            self.saved.setdefault(conversation_id, []).extend(item["MessageId"] for item in conversation_items)
+
+    async def save_feedbacks(self, conversation_id, feedbacks):
+        return []
+
+
+# Method to get a journal in a new file, without its background worker (the check calls flush)
+def new_journal(folder, history_manager, name="journal"):
+    journal = managers.HistoryJournal(history_manager, os.path.join(folder, f"{name}.sqlite3"), flush_interval_seconds=0.01,
+                                      max_backoff_seconds=0.05)
+    journal.shutdown()
+    return journal
+
+
+# Method to get a conversation item
+def new_item(message_id):
+    return {"MessageId": message_id, "Query": "question", "Reply": "answer"}
+
+
+# Method to check that a newer turn isn't saved while an older turn of the conversation waits for a retry
+def check_retry_order(folder):
+    history_manager = FakeHistoryManager()
+    journal = new_journal(folder, history_manager, "retry")
+    history_manager.fail_conversations.add("conversation")
+    journal.append("conversation", new_item("m1"))
+    journal.flush()
+    history_manager.fail_conversations.clear()
+    journal.append("conversation", new_item("m2"))
+    journal.flush()
+    time.sleep(0.1)
+    journal.flush()
+    saved = history_manager.saved.get("conversation")
+    return [] if saved == ["m1", "m2"] else [f"retry: saved in the order {saved}"]
+
+
+# Method to check that a process doesn't save a turn while another process is saving an older turn of the conversation
+def check_claim_order(folder):
+    history_manager = FakeHistoryManager()
+    journal = new_journal(folder, history_manager, "claim")
+    other_journal = new_journal(folder, history_manager, "claim")
+    other_journal._owner = journal._owner + "-other"
+    journal.append("conversation", new_item("m1"))
+    claimed_rows, _ = journal._claim()
+    other_journal.append("conversation", new_item("m2"))
+    other_rows, _ = other_journal._claim()
+    errors = []
+    if [row[0] for row in claimed_rows] != [1]:
+        errors.append(f"claim: first process claimed {claimed_rows}")
+    if other_rows:
+        errors.append(f"claim: second process claimed {[row[0] for row in other_rows]} while the first one saves m1")
+    return errors
+
+
+# Method to check the order of many conversations saved with random failures
+def check_random_failures(folder, args):
+    history_manager = FakeHistoryManager(args.failure_rate)
+    journal = new_journal(folder, history_manager, "random")
+    expected = {}
+    for turn in range(args.turns):
+        for conversation in range(args.conversations):
+            message_id = f"c{conversation}-m{turn}"
+            journal.append(f"c{conversation}", new_item(message_id))
+            expected.setdefault(f"c{conversation}", []).append(message_id)
+        journal.flush()
+
+    deadline = time.monotonic() + 30
+    while journal.get_stats()["pending"] and time.monotonic() < deadline:
+        journal.flush()
+        time.sleep(0.01)
+
+    errors = []
+    if journal.get_stats()["pending"]:
+        errors.append(f"random failures: {journal.get_stats()['pending']} items not saved")
+    for conversation_id, message_ids in expected.items():
+        if history_manager.saved.get(conversation_id) != message_ids:
+            errors.append(f"random failures: {conversation_id} saved in the order {history_manager.saved.get(conversation_id)}")
+    print(f"{args.conversations} conversations of {args.turns} turns, {journal.get_stats()['retries']} failed saves")
+    return errors
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--conversations", type=int, default=50)
+    parser.add_argument("--turns", type=int, default=10)
+    parser.add_argument("--failure-rate", type=float, default=0.3, help="Probability of a failed CosmosDB save")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as folder:
+        errors = check_retry_order(folder) + check_claim_order(folder) + check_random_failures(folder, args)
+
+    for error in errors[:20]:
+        print(f"  {error}")
+    if errors:
+        print(f"FAILED: {len(errors)} ordering errors")
+        sys.exit(1)
+    print("OK: the turns of each conversation are saved in order")
+
+
+if __name__ == "__main__":
+    main()
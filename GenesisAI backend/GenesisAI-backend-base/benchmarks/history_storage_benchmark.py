@@ -0,0 +1,88 @@
+# Request units and latency of the CosmosDB conversation layouts ("document" and "message", COSMOSDB_STORAGE_LAYOUT)
+# Saves conversations of up to the largest turn count with each layout and reports, at each turn count, the cost of
+# saving that turn and of reading the conversation history used by the chat endpoint
+# The benchmark conversations are written to the configured container (COSMOSDB_CONTAINER, or --container) and deleted
+# at the end; the managers package needs the backend environment (.env and Key Vault)
+#
+# Usage (from the backend folder):
+#   python benchmarks/history_storage_benchmark.py [--turns 1,20,200] [--container conversations-benchmark]
+
+import argparse
+import os
+import sys
+import time
+import uuid
+from datetime import datetime
+
+BACKEND_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_FOLDER)
+
+LAYOUTS = ("document", "message")
+# A typical turn: a short question and a few paragraphs of reply
+QUERY = "Quais são os serviços da Genesis Digital Solutions na área de inteligência artificial?"
+REPLY = "A Genesis Digital Solutions disponibiliza serviços de consultoria, desenvolvimento e operação. " * 12
+
+
+# Method to get a conversation item like the ones saved by GptModelManager.save_new_conversation
+def get_conversation_item(turn):
+    return {
+        "MessageId": f"chatcmpl-{uuid.uuid4()}",
+        "Date": datetime.now().isoformat(),
+        "Query": f"{QUERY} ({turn})",
+        "Reply": REPLY,
+        "Feedback": "",
+        "ElapsedTime": "1.00000 seconds",
+        "Usage": {"CompletionTokens": 250, "PromptTokens": 1500, "TotalTokens": 1750}
+    }
+
+
+# Method to run a history manager call and get its request units and latency
+def measure(managers, history_manager, call):
+    request_charge = history_manager.get_stats()["request_charge"]
+    start_time = time.perf_counter()
+    managers.await_cosmosdb_function(call)
+    elapsed_ms = (time.perf_counter() - start_time) * 1000
+    return history_manager.get_stats()["request_charge"] - request_charge, elapsed_ms
+
+
+# Method to delete the documents of a benchmark conversation
+async def delete_conversation(history_manager, conversation_id):
+    container = history_manager._container
+    documents = [document async for document in container.query_items(query="SELECT c.id FROM c", partition_key=conversation_id)]
+    for document in documents:
+        await container.delete_item(item=document["id"], partition_key=conversation_id)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--turns", default="1,20,200", help="Turn counts to report, comma separated")
+    parser.add_argument("--container", help="CosmosDB container (default COSMOSDB_CONTAINER)")
+    args = parser.parse_args()
+
+    if args.container:
+        os.environ["COSMOSDB_CONTAINER"] = args.container
+    checkpoints = sorted(int(turns) for turns in args.turns.split(","))
+
+    import managers  # noqa: E402
+
+    results = []
+    for layout in LAYOUTS:
+        history_manager = managers.CosmosHistoryManager(logger=None, layout=layout)
+        conversation_id = f"benchmark-{layout}-{uuid.uuid4()}"
+        try:
+            for turn in range(1, checkpoints[-1] + 1):
+                save_ru, save_ms = measure(managers, history_manager,
+                                           history_manager.save_conversation(conversation_id, get_conversation_item(turn)))
+                if turn in checkpoints:
+                    read_ru, read_ms = measure(managers, history_manager, history_manager.get_last_conversation_items(conversation_id))
+                    results.append((layout, turn, save_ru, save_ms, read_ru, read_ms))
+        finally:
+            managers.await_cosmosdb_function(delete_conversation(history_manager, conversation_id))
+
+    print(f"{'layout':<10}{'turns':>7}{'save RU':>10}{'save ms':>10}{'history RU':>12}{'history ms':>12}")
+    for layout, turn, save_ru, save_ms, read_ru, read_ms in results:
+        print(f"{layout:<10}{turn:>7}{save_ru:>10.2f}{save_ms:>10.1f}{read_ru:>12.2f}{read_ms:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
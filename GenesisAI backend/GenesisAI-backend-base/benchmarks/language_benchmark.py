@@ -0,0 +1,71 @@
+# Accuracy and latency benchmark of the local language identifier against a labelled pt/en sample
+# Used to tune LANGUAGE_ID_THRESHOLD: messages below the threshold fall back to the check_language GPT prompt
+#
+# Usage (from the backend folder):
+#   python benchmarks/language_benchmark.py [--sample benchmarks/data/language_sample.jsonl]
+
+import argparse
+import importlib.util
+import json
+import os
+import time
+import numpy as np
+
+BACKEND_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+THRESHOLDS = (0.5, 0.6, 0.7, 0.8, 0.9, 0.95, 0.99)
+
+
+# Method to load the identifier module without the managers package (which connects to Azure on import)
+def load_identifier_module():
+    module_path = os.path.join(BACKEND_FOLDER, "managers", "language", "ngramlanguageidentifier.py")
+    spec = importlib.util.spec_from_file_location("ngramlanguageidentifier", module_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sample", default=os.path.join(BACKEND_FOLDER, "benchmarks", "data", "language_sample.jsonl"))
+    parser.add_argument("--repeat", type=int, default=200, help="Timed runs per message")
+    args = parser.parse_args()
+
+    with open(args.sample, encoding="utf-8") as sample_file:
+        sample = [json.loads(line) for line in sample_file if line.strip()]
+
+    module = load_identifier_module()
+
+    start_time = time.perf_counter()
+    identifier = module.NgramLanguageIdentifier()
+    print(f"Model build time: {(time.perf_counter() - start_time) * 1000:.1f} ms")
+
+    # Identify each message and time it
+    predictions = []
+    latencies = []
+    for row in sample:
+        predictions.append(identifier.identify(row["text"]))
+        for _ in range(args.repeat):
+            start_time = time.perf_counter()
+            identifier.identify(row["text"])
+            latencies.append(time.perf_counter() - start_time)
+
+    latencies_us = np.array(latencies) * 1e6
+    print(f"Latency per message: p50 {np.percentile(latencies_us, 50):.1f} us, "
+          f"p99 {np.percentile(latencies_us, 99):.1f} us ({len(sample)} messages x {args.repeat} runs)")
+
+    # Labels '' are other languages (the GPT prompt category 3), which the identifier can't answer locally
+    print(f"\n{'threshold':>9} {'local':>7} {'local accuracy':>15} {'errors':>7}")
+    for threshold in THRESHOLDS:
+        local = [(row, language) for row, (language, confidence) in zip(sample, predictions) if confidence >= threshold]
+        errors = [(row, language) for row, language in local if language != row["language"]]
+        local_accuracy = 1 - len(errors) / len(local) if local else 1.0
+        print(f"{threshold:>9} {len(local) / len(sample):>7.1%} {local_accuracy:>15.1%} {len(errors):>7}")
+
+    print("\nMisclassified messages (any confidence):")
+    for row, (language, confidence) in zip(sample, predictions):
+        if language != row["language"]:
+            print(f"  {confidence:.3f} {row['language'] or 'other':>5} -> {language or 'none':<5} {row['text']}")
+
+
+if __name__ == "__main__":
+    main()
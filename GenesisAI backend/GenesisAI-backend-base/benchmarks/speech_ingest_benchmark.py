@@ -0,0 +1,103 @@
+# Peak memory and latency of the speech to text audio ingest (SpeechManager.decode_audio)
+# Generates clips of each duration and format with ffmpeg and decodes each one in a new process, so the peak RSS of a
+# decode isn't hidden by the previous ones; "wav" clips are already 16KHz 16-bits mono PCM (WAV fast path), "webm"
+# (Opus) and "m4a" (AAC) clips are converted by ffmpeg
+# The speech manager module is loaded from its file, so the benchmark doesn't need the backend environment (only ffmpeg)
+#
+# Usage (from the backend folder):
+#   python benchmarks/speech_ingest_benchmark.py [--durations 10,60,600] [--formats wav,webm,m4a]
+
+import argparse
+import contextlib
+import importlib.util
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+BACKEND_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SPEECH_MANAGER_FILE = os.path.join(BACKEND_FOLDER, "managers", "speech", "speechmanager.py")
+
+# ffmpeg output options of each clip format (a 48KHz stereo source, like a browser recording)
+CLIP_FORMATS = {
+    "wav": ["-ar", "16000", "-ac", "1", "-c:a", "pcm_s16le"],
+    "webm": ["-c:a", "libopus", "-b:a", "32k"],
+    "m4a": ["-c:a", "aac", "-b:a", "64k"],
+}
+
+
+# Stage metrics without Prometheus
+class NoMetrics:
+    def span(self, stage):
+        return contextlib.nullcontext()
+
+
+# Method to get the peak RSS of this process or of its children in MB (ru_maxrss is in KB on Linux)
+def get_peak_rss_mb(who):
+    return resource.getrusage(who).ru_maxrss / 1024
+
+
+# Method to generate a clip: a tone with noise, so the encoders don't compress it to nothing
+def generate_clip(folder, clip_format, duration):
+    path = os.path.join(folder, f"clip-{duration}s.{clip_format}")
+    command = ["ffmpeg", "-nostdin", "-y", "-loglevel", "error",
+               "-f", "lavfi", "-i", f"sine=frequency=440:sample_rate=48000:duration={duration}",
+               "-f", "lavfi", "-i", f"anoisesrc=color=pink:amplitude=0.05:sample_rate=48000:duration={duration}",
+               "-filter_complex", "amix=inputs=2,pan=stereo|c0=c0|c1=c0"] + CLIP_FORMATS[clip_format] + [path]
+    subprocess.run(command, check=True)
+    return path
+
+
+# Method to decode a clip in this process and print its measures (child process of the benchmark)
+def measure(path):
+    spec = importlib.util.spec_from_file_location("speechmanager", SPEECH_MANAGER_FILE)
+    speechmanager = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(speechmanager)
+    speech_manager = speechmanager.SpeechManager(None, NoMetrics())
+
+    baseline_rss_mb = get_peak_rss_mb(resource.RUSAGE_SELF)
+    start_time = time.perf_counter()
+    with open(path, "rb") as file:
+        pcm, duration_seconds = speech_manager.decode_audio(file)
+    decode_ms = (time.perf_counter() - start_time) * 1000
+    print(json.dumps({
+        "decode_ms": decode_ms,
+        "duration_seconds": duration_seconds,
+        "pcm_mb": len(pcm) / 1024 / 1024,
+        "rss_growth_mb": get_peak_rss_mb(resource.RUSAGE_SELF) - baseline_rss_mb,
+        "peak_rss_mb": get_peak_rss_mb(resource.RUSAGE_SELF),
+        "ffmpeg_rss_mb": get_peak_rss_mb(resource.RUSAGE_CHILDREN)
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--durations", default="10,60,600", help="Clip durations in seconds, comma separated")
+    parser.add_argument("--formats", default="wav,webm,m4a", help="Clip formats, comma separated (wav, webm, m4a)")
+    parser.add_argument("--measure", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        measure(args.measure)
+        return
+
+    results = []
+    with tempfile.TemporaryDirectory() as folder:
+        for clip_format in args.formats.split(","):
+            for duration in (int(duration) for duration in args.durations.split(",")):
+                path = generate_clip(folder, clip_format, duration)
+                output = subprocess.run([sys.executable, os.path.abspath(__file__), "--measure", path],
+                                        check=True, capture_output=True, text=True).stdout
+                results.append((clip_format, duration, os.path.getsize(path) / 1024 / 1024, json.loads(output)))
+
+    print(f"{'format':<8}{'clip s':>7}{'file MB':>9}{'PCM MB':>8}{'decode ms':>11}{'RSS growth MB':>15}{'peak RSS MB':>13}{'ffmpeg MB':>11}")
+    for clip_format, duration, file_mb, result in results:
+        print(f"{clip_format:<8}{duration:>7}{file_mb:>9.1f}{result['pcm_mb']:>8.1f}{result['decode_ms']:>11.0f}"
+              f"{result['rss_growth_mb']:>15.1f}{result['peak_rss_mb']:>13.1f}{result['ffmpeg_rss_mb']:>11.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,385 @@
+# Check of the streaming speech to text (SpeechManager.stream_recognize and astream_recognize) with a fake recognizer
+# The audio is sent in chunks at the speed of a live microphone; the fake recognizer reads it from the push stream as
+# it arrives and returns a word every half second of audio (a partial result per word, a final result every 4 words)
+# The check fails if the partial results don't arrive before the end of the audio, if the last result takes longer
+# than --max-finish-ms after the end of the audio, if a stream gets the words of another stream, or if a recognition
+# isn't stopped (and its pool slot given back) after an error or a client that went away
+# It also fails if a client that stops sending audio (idle) or never ends the audio (endless) isn't stopped with a
+# TimeoutError after the stream timeouts
+# The speech modules are loaded from their files and the Speech SDK recognizer is replaced, so the check doesn't need
+# the backend environment or Azure access
+#
+# Usage (from the backend folder):
+#   python benchmarks/speech_stream_check.py [--seconds 4] [--streams 8] [--chunk-ms 100] [--max-finish-ms 500]
+#       [--idle-timeout 0.5]
+
+import argparse
+import asyncio
+import contextlib
+import importlib.util
+import os
+import queue
+import sys
+import threading
+import time
+import types
+
+import azure.cognitiveservices.speech as speechsdk
+
+BACKEND_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SPEECH_FOLDER = os.path.join(BACKEND_FOLDER, "managers", "speech")
+
+# Audio of a recognized word (half a second of 16KHz 16-bits mono PCM), words of a final result
+WORD_BYTES = 16000
+WORDS_PER_UTTERANCE = 4
+# Time the fake recognizer takes to return a result
+RECOGNIZER_DELAY_SECONDS = 0.02
+
+RECOGNIZERS = []
+
+
+# Signal class
+# Speech SDK event signal (connect and fire)
+class Signal:
+    def __init__(self):
+        self._callbacks = []
+
+    def connect(self, callback):
+        self._callbacks.append(callback)
+
+    def fire(self, evt):
+        for callback in self._callbacks:
+            callback(evt)
+
+
+# FakeAudioInputStream class
+# PushAudioInputStream read by the fake recognizer (like the Speech SDK, only bytes are accepted)
+class FakeAudioInputStream:
+    def __init__(self, stream_format=None):
+        self._chunks = queue.Queue()
+
+    def write(self, buffer):
+        if not isinstance(buffer, bytes):
+            raise TypeError(f"Unsupported audio buffer {type(buffer).__name__}")
+        self._chunks.put(buffer)
+
+    def close(self):
+        self._chunks.put(None)
+
+    def read(self):
+        return self._chunks.get()
+
+
+# FakeRecognizer class
+# Continuous recognition of the pushed audio: a word per WORD_BYTES, named after the first byte of the audio (the
+# stream number), so the words of a stream can't show up in another one; error_after_bytes cancels the session with an
+# error after that much audio
+class FakeRecognizer:
+    error_after_bytes = None
+
+    def __init__(self, speech_config=None, audio_config=None):
+        self._audio_input_stream = audio_config.stream
+        self.recognizing, self.recognized, self.session_started, self.session_stopped, self.canceled = (
+            Signal() for _ in range(5))
+        self.stopped = threading.Event()
+        RECOGNIZERS.append(self)
+
+    def start_continuous_recognition(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    # Method to stop the recognition (like the Speech SDK, returns after the last event)
+    def stop_continuous_recognition(self):
+        self.stopped.set()
+        self._audio_input_stream.close()
+        self._thread.join()
+
+    # Method to fire a result event (like the Speech SDK, no events after the recognition is stopped)
+    def _fire_result(self, signal, words):
+        time.sleep(RECOGNIZER_DELAY_SECONDS)
+        if not self.stopped.is_set():
+            signal.fire(types.SimpleNamespace(result=types.SimpleNamespace(text=" ".join(words))))
+
+    def _run(self):
+        words = []
+        heard_bytes = 0
+        total_bytes = 0
+        while not self.stopped.is_set():
+            chunk = self._audio_input_stream.read()
+            if chunk is None:
+                break
+            heard_bytes += len(chunk)
+            total_bytes += len(chunk)
+            while heard_bytes >= WORD_BYTES:
+                heard_bytes -= WORD_BYTES
+                words.append(f"s{chunk[0]}")
+                self._fire_result(self.recognizing, words)
+                if len(words) == WORDS_PER_UTTERANCE:
+                    self._fire_result(self.recognized, words)
+                    words = []
+            if self.error_after_bytes is not None and total_bytes >= self.error_after_bytes:
+                details = types.SimpleNamespace(reason=speechsdk.CancellationReason.Error, error_details="Fake error")
+                self.canceled.fire(types.SimpleNamespace(cancellation_details=details))
+                return
+
+        # End of the audio: the last utterance, then the end of the session
+        if words:
+            self._fire_result(self.recognized, words)
+        self.session_stopped.fire(types.SimpleNamespace(session_id="fake"))
+
+
+# Stage metrics without Prometheus
+class NoMetrics:
+    def span(self, stage):
+        return contextlib.nullcontext()
+
+    def observe(self, stage, seconds, outcome="ok"):
+        pass
+
+
+# KeyvaultManager with fixed secrets
+class FakeKeyvaultManager:
+    def get_secret(self, name):
+        return "fake-" + name
+
+
+# Method to load a speech module from its file, with the fake Speech SDK recognizer
+def load_speech_module(name):
+    spec = importlib.util.spec_from_file_location(name, os.path.join(SPEECH_FOLDER, f"{name}.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    fake_sdk = types.SimpleNamespace(**{key: getattr(speechsdk, key) for key in dir(speechsdk) if not key.startswith("__")})
+    fake_sdk.SpeechRecognizer = FakeRecognizer
+    fake_sdk.SpeechConfig = types.SimpleNamespace
+    fake_sdk.audio = types.SimpleNamespace(AudioStreamFormat=lambda *args: None, PushAudioInputStream=FakeAudioInputStream,
+                                           AudioConfig=lambda stream: types.SimpleNamespace(stream=stream))
+    module.speechsdk = fake_sdk
+    return module
+
+
+# Method to get the speech manager of a check
+def new_speech_manager(streams):
+    speechconfigpool = load_speech_module("speechconfigpool")
+    speechmanager = load_speech_module("speechmanager")
+    config_pool = speechconfigpool.SpeechConfigPool(FakeKeyvaultManager(), max_recognitions=streams)
+    return speechmanager.SpeechManager(FakeKeyvaultManager(), NoMetrics(), config_pool)
+
+
+# Method to get the audio chunks of a stream, sent at the speed of a microphone (the audio end time is kept in timing)
+def audio_chunks(stream_number, args, timing, fail_after_seconds=None):
+    chunk_bytes = int(32000 * args.chunk_ms / 1000)
+    for position in range(0, int(32000 * args.seconds), chunk_bytes):
+        if fail_after_seconds is not None and position >= 32000 * fail_after_seconds:
+            raise ConnectionError("Client went away")
+        time.sleep(args.chunk_ms / 1000)
+        yield bytes([stream_number]) * chunk_bytes
+    timing["audio_end"] = time.perf_counter()
+
+
+# Method to get the audio chunks of a stream on an event loop
+async def aaudio_chunks(stream_number, args, timing, fail_after_seconds=None):
+    chunk_bytes = int(32000 * args.chunk_ms / 1000)
+    for position in range(0, int(32000 * args.seconds), chunk_bytes):
+        if fail_after_seconds is not None and position >= 32000 * fail_after_seconds:
+            raise ConnectionError("Client went away")
+        await asyncio.sleep(args.chunk_ms / 1000)
+        yield bytes([stream_number]) * chunk_bytes
+    timing["audio_end"] = time.perf_counter()
+
+
+# Method to get the audio chunks of a client that sends a second of audio and then stops sending (idle, until
+# release is set) or sends audio until release is set (endless)
+def stalled_audio_chunks(args, release, idle):
+    chunk_bytes = int(32000 * args.chunk_ms / 1000)
+    for _ in range(int(1000 / args.chunk_ms)):
+        time.sleep(args.chunk_ms / 1000)
+        yield bytes([1]) * chunk_bytes
+    while not release.wait(None if idle else args.chunk_ms / 1000):
+        yield bytes([1]) * chunk_bytes
+
+
+# Method to get the audio chunks of an idle or endless client on an event loop
+async def astalled_audio_chunks(args, idle):
+    chunk_bytes = int(32000 * args.chunk_ms / 1000)
+    for _ in range(int(1000 / args.chunk_ms)):
+        await asyncio.sleep(args.chunk_ms / 1000)
+        yield bytes([1]) * chunk_bytes
+    if idle:
+        await asyncio.Event().wait()
+    while True:
+        await asyncio.sleep(args.chunk_ms / 1000)
+        yield bytes([1]) * chunk_bytes
+
+
+# Method to check the events of a stream; returns the errors and the time from the end of the audio to the last event
+def check_events(stream_number, args, events, timing):
+    errors = []
+    word_count = int(32000 * args.seconds) // WORD_BYTES
+    expected_text = " ".join([f"s{stream_number}"] * word_count)
+    partials = [event_time for event_time, event in events if event["type"] == "partial"]
+    if not partials or partials[0] >= timing["audio_end"]:
+        errors.append(f"stream {stream_number}: no partial result before the end of the audio")
+    if any(f"s{stream_number}" != word for _, event in events if "text" in event for word in event["text"].split()):
+        errors.append(f"stream {stream_number}: words of another stream")
+    done = events[-1][1] if events else {}
+    if done.get("type") != "done" or done.get("text") != expected_text:
+        errors.append(f"stream {stream_number}: wrong last event {done}")
+    elif done["audio_duration"] != float(round(args.seconds / 60, 5)):
+        errors.append(f"stream {stream_number}: wrong audio duration {done['audio_duration']}")
+    finish_ms = (events[-1][0] - timing["audio_end"]) * 1000 if events and "audio_end" in timing else float("nan")
+    if not finish_ms <= args.max_finish_ms:
+        errors.append(f"stream {stream_number}: last result {finish_ms:.0f} ms after the end of the audio")
+    return errors, finish_ms, (partials[0] - timing["start"]) * 1000 if partials else float("nan")
+
+
+# Method to check that the recognizers were stopped and the pool slots given back
+def check_released(speech_manager, name):
+    errors = []
+    if not all(recognizer.stopped.wait(1) for recognizer in RECOGNIZERS):
+        errors.append(f"{name}: recognition not stopped")
+    if speech_manager.config_pool.get_stats()["in_use"] != 0:
+        errors.append(f"{name}: pool slot not given back")
+    RECOGNIZERS.clear()
+    return errors
+
+
+# Method to run streams with stream_recognize, each one in its own thread (as in the Flask endpoint)
+def run_sync(args):
+    speech_manager = new_speech_manager(args.streams)
+    results = [None] * args.streams
+
+    def run_stream(stream_number):
+        timing = {"start": time.perf_counter()}
+        events = []
+        for event in speech_manager.stream_recognize(audio_chunks(stream_number, args, timing), "pt-PT"):
+            events.append((time.perf_counter(), event))
+        results[stream_number] = check_events(stream_number, args, events, timing)
+
+    threads = [threading.Thread(target=run_stream, args=(stream_number,)) for stream_number in range(args.streams)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, check_released(speech_manager, "sync")
+
+
+# Method to run streams with astream_recognize on an event loop (as in the ASGI endpoint)
+async def run_async(args):
+    speech_manager = new_speech_manager(args.streams)
+
+    async def run_stream(stream_number):
+        timing = {"start": time.perf_counter()}
+        events = []
+        async for event in speech_manager.astream_recognize(aaudio_chunks(stream_number, args, timing), "pt-PT"):
+            events.append((time.perf_counter(), event))
+        return check_events(stream_number, args, events, timing)
+
+    results = await asyncio.gather(*(run_stream(stream_number) for stream_number in range(args.streams)))
+    return results, check_released(speech_manager, "async")
+
+
+# Method to check a recognition canceled with an error: an "error" event, then "done"
+def run_error(args):
+    speech_manager = new_speech_manager(1)
+    FakeRecognizer.error_after_bytes = WORD_BYTES * 3
+    try:
+        events = list(speech_manager.stream_recognize(audio_chunks(1, args, {}), "pt-PT"))
+    finally:
+        FakeRecognizer.error_after_bytes = None
+    errors = check_released(speech_manager, "error")
+    if [event["type"] for event in events[-2:]] != ["error", "done"]:
+        errors.append(f"error: wrong last events {events[-2:]}")
+    return errors
+
+
+# Method to check clients that went away: the sync stream closed after the first result and the async audio source
+# failing; the recognition must be stopped and its slot given back
+async def run_disconnect(args):
+    errors = []
+    speech_manager = new_speech_manager(1)
+    events = speech_manager.stream_recognize(audio_chunks(1, args, {}), "pt-PT")
+    next(events)
+    events.close()
+    errors += check_released(speech_manager, "sync disconnect")
+
+    try:
+        async for _ in speech_manager.astream_recognize(aaudio_chunks(1, args, {}, fail_after_seconds=1), "pt-PT"):
+            pass
+        errors.append("async disconnect: the audio source error was not raised")
+    except ConnectionError:
+        pass
+    errors += check_released(speech_manager, "async disconnect")
+    return errors
+
+
+# Method to check the idle and endless clients: the stream must end with a TimeoutError after a second of audio plus
+# the idle timeout (idle, stream_max_seconds of 3 seconds) or after stream_max_seconds (1 second) plus
+# recognition_timeout_seconds (endless), and the recognition must be stopped and its slot given back
+async def run_timeouts(args):
+    errors = []
+    for name, idle, max_seconds, expected_message in (("idle", True, 3, "No audio"), ("endless", False, 1, "longer than")):
+        speech_manager = new_speech_manager(1)
+        speech_manager.stream_idle_timeout_seconds = args.idle_timeout
+        speech_manager.stream_max_seconds = max_seconds
+        speech_manager.recognition_timeout_seconds = args.idle_timeout
+        expected_seconds = 1 + args.idle_timeout
+
+        for mode in ("sync", "async"):
+            release = threading.Event()
+            start_time = time.perf_counter()
+            try:
+                if mode == "sync":
+                    for _ in speech_manager.stream_recognize(stalled_audio_chunks(args, release, idle), "pt-PT"):
+                        pass
+                else:
+                    async for _ in speech_manager.astream_recognize(astalled_audio_chunks(args, idle), "pt-PT"):
+                        pass
+                errors.append(f"{mode} {name} client: no TimeoutError")
+            except TimeoutError as e:
+                elapsed_seconds = time.perf_counter() - start_time
+                print(f"{mode} {name} client: {e} after {elapsed_seconds:.2f} s")
+                if not expected_seconds <= elapsed_seconds <= expected_seconds + 0.5 or expected_message not in str(e):
+                    errors.append(f"{mode} {name} client: TimeoutError {e!r} after {elapsed_seconds:.2f} s "
+                                  f"(expected {expected_message!r} after {expected_seconds:.2f} s)")
+            finally:
+                release.set()
+            errors += check_released(speech_manager, f"{mode} {name} client")
+    return errors
+
+
+# Method to print the results of a mode and get its errors
+def report(name, results, release_errors):
+    errors = [error for stream_errors, _, _ in results for error in stream_errors] + release_errors
+    finish_times = sorted(finish_ms for _, finish_ms, _ in results)
+    first_partial_times = sorted(first_partial_ms for _, _, first_partial_ms in results)
+    print(f"{name:<8}{len(results):>8}{first_partial_times[len(first_partial_times) // 2]:>18.0f}"
+          f"{finish_times[len(finish_times) // 2]:>13.0f}{finish_times[-1]:>13.0f}  {'FAIL' if errors else 'OK'}")
+    return errors
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seconds", type=float, default=4, help="Audio of each stream in seconds")
+    parser.add_argument("--streams", type=int, default=8, help="Streams at the same time")
+    parser.add_argument("--chunk-ms", type=float, default=100, help="Audio of each chunk in milliseconds")
+    parser.add_argument("--max-finish-ms", type=float, default=500,
+                        help="Maximum time from the end of the audio to the last result")
+    parser.add_argument("--idle-timeout", type=float, default=0.5,
+                        help="Idle and recognition timeouts of the idle and endless client checks, in seconds")
+    args = parser.parse_args()
+
+    print(f"{'mode':<8}{'streams':>8}{'first partial ms':>18}{'finish p50':>13}{'finish max':>13}")
+    errors = report("sync", *run_sync(args))
+    errors += report("async", *asyncio.run(run_async(args)))
+    errors += run_error(args)
+    errors += asyncio.run(run_disconnect(args))
+    errors += asyncio.run(run_timeouts(args))
+
+    for error in errors:
+        print(error)
+    print("FAIL" if errors else "OK")
+    sys.exit(1 if errors else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+# Load test of the chat endpoint: how many concurrent answer streams a container holds
+# Opens N streams at the same time on /genesisai-completions (for each concurrency level) and reports the streams that
+# finished, the errors, the time to first byte and the total time of the streams
+# Run it once against a container started with SERVER_MODE=wsgi and once with SERVER_MODE=asgi (same image, same number
+# of workers) to compare both modes; the answers are generated by the configured GPT model (tokens are spent)
+# Each stream sends the question with a different number at the end, so every request goes through the whole
+# pre-generation phase (classification, history and retrieval aren't served by the memoized results and caches of the
+# other streams); --same-prompt sends the same question (start the containers with SEMANTIC_CACHE=false then,
+# otherwise most of them get the cached answer)
+# In ASGI mode the pre-generation phase runs in at most SERVER_THREADS threads per worker, so the time to first byte
+# shows that bound; only the generation phase runs on the event loop
+#
+# Usage (from the backend folder):
+#   python benchmarks/stream_load_test.py --url http://localhost:8000 --api-key <BACKEND-API-KEY> [--concurrency 4,50,100,200]
+#       [--prompt "..."] [--same-prompt] [--language pt] [--timeout 120]
+
+import argparse
+import asyncio
+import time
+import uuid
+
+import httpx
+
+
+# Method to get a percentile of a sorted list of values
+def get_percentile(values, percentile):
+    if not values:
+        return float("nan")
+    return values[min(len(values) - 1, int(round(percentile / 100 * (len(values) - 1))))]
+
+
+# Method to open a stream and read it to the end; returns (time to first byte, total time, bytes) or the error name
+async def run_stream(client, args, start_event, number):
+    await start_event.wait()
+    headers = {"api-key": args.api_key, "context-key": f"loadtest-{uuid.uuid4()}"}
+    prompt = args.prompt if args.same_prompt else f"{args.prompt} ({number})"
+    data = {"prompt": prompt, "language": args.language}
+    start_time = time.perf_counter()
+    first_byte_time = None
+    size = 0
+    try:
+        async with client.stream("POST", f"{args.url}/genesisai-completions", json=data, headers=headers) as response:
+            if response.status_code != 200:
+                return f"HTTP {response.status_code}"
+            async for chunk in response.aiter_bytes():
+                if first_byte_time is None and chunk:
+                    first_byte_time = time.perf_counter()
+                size += len(chunk)
+    except Exception as e:
+        return type(e).__name__
+    if first_byte_time is None:
+        return "empty stream"
+    return first_byte_time - start_time, time.perf_counter() - start_time, size
+
+
+# Method to run a concurrency level (all the streams start at the same time)
+async def run_level(args, concurrency):
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(timeout=args.timeout, limits=limits) as client:
+        start_event = asyncio.Event()
+        tasks = [asyncio.create_task(run_stream(client, args, start_event, f"{concurrency}-{number}")) for number in range(concurrency)]
+        start_time = time.perf_counter()
+        start_event.set()
+        results = await asyncio.gather(*tasks)
+        wall_time = time.perf_counter() - start_time
+
+    completed = [result for result in results if isinstance(result, tuple)]
+    errors = {}
+    for result in results:
+        if isinstance(result, str):
+            errors[result] = errors.get(result, 0) + 1
+    first_byte_times = sorted(result[0] * 1000 for result in completed)
+    total_times = sorted(result[1] * 1000 for result in completed)
+    return {
+        "concurrency": concurrency,
+        "completed": len(completed),
+        "errors": errors,
+        "ttfb_p50": get_percentile(first_byte_times, 50),
+        "ttfb_p99": get_percentile(first_byte_times, 99),
+        "total_p50": get_percentile(total_times, 50),
+        "total_p99": get_percentile(total_times, 99),
+        "wall_time": wall_time
+    }
+
+
+async def main_async(args):
+    results = []
+    for concurrency in (int(level) for level in args.concurrency.split(",")):
+        results.append(await run_level(args, concurrency))
+        await asyncio.sleep(args.pause)
+
+    print(f"{'streams':>8}{'done':>7}{'TTFB p50':>11}{'TTFB p99':>11}{'total p50':>11}{'total p99':>11}{'wall s':>9}  errors")
+    for result in results:
+        errors = ", ".join(f"{error}: {count}" for error, count in result["errors"].items()) or "-"
+        print(f"{result['concurrency']:>8}{result['completed']:>7}{result['ttfb_p50']:>11.0f}{result['ttfb_p99']:>11.0f}"
+              f"{result['total_p50']:>11.0f}{result['total_p99']:>11.0f}{result['wall_time']:>9.1f}  {errors}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default="http://localhost:8000", help="Backend URL")
+    parser.add_argument("--api-key", required=True, help="Backend API key (BACKEND-API-KEY)")
+    parser.add_argument("--concurrency", default="4,50,100,200", help="Concurrent streams of each level, comma separated")
+    parser.add_argument("--prompt", default="Quais são os serviços da Genesis Digital Solutions?")
+    parser.add_argument("--same-prompt", action="store_true", help="Send the same question in all the streams")
+    parser.add_argument("--language", default="pt")
+    parser.add_argument("--timeout", type=float, default=120, help="Timeout of each stream in seconds (gunicorn --timeout)")
+    parser.add_argument("--pause", type=float, default=2, help="Seconds between the concurrency levels")
+    asyncio.run(main_async(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+# Offline evaluation of the embedding-similarity topic fast path against the check_topic GPT model labels
+# Reports, per threshold, the share of messages answered by the fast path and its agreement with the GPT model
+# The sample must be held out from managers/topic/data/topic_exemplars.json: an exemplar sits almost on its own centroid,
+# so the evaluation stops if a sample message is also an exemplar (ignoring case and punctuation)
+# Needs the same Azure access as the backend (.env and Key Vault)
+#
+# Usage (from the backend folder):
+#   python benchmarks/topic_evaluation.py [--sample benchmarks/data/topic_sample.jsonl] [--labels labels.jsonl]
+#                                         [--min-agreement 1.0]
+# The GPT model labels are saved to --labels and reused on the next runs (no tokens spent again)
+# The suggested TOPIC_SIMILARITY_THRESHOLD/TOPIC_MARGIN_THRESHOLD are the ones with the largest fast path whose
+# agreement with the GPT model is at least --min-agreement
+
+import argparse
+import json
+import os
+import re
+import sys
+
+BACKEND_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_FOLDER)
+
+import managers  # noqa: E402
+
+SIMILARITY_THRESHOLDS = (0.80, 0.84, 0.86, 0.88, 0.90, 0.92, 0.94)
+MARGIN_THRESHOLDS = (0.0, 0.02, 0.03, 0.05, 0.08)
+
+
+# Method to normalize a message for the comparison with the exemplars (case and punctuation ignored)
+def normalize_text(text:str) -> str:
+    return re.sub(r"[^\w]+", " ", text.casefold()).strip()
+
+
+# Method to get the sample messages that are also exemplars of the classifier
+def get_exemplar_overlap(texts):
+    with open(managers.topic.embeddingtopicclassifier.EXEMPLARS_PATH, encoding="utf-8") as exemplars_file:
+        exemplars = json.load(exemplars_file)
+    exemplar_texts = {normalize_text(text) for topic_exemplars in exemplars.values() for text in topic_exemplars}
+    return [text for text in texts if normalize_text(text) in exemplar_texts]
+
+
+# Method to get the GPT model labels, from the labels file or from the check_topic prompt
+def get_llm_labels(texts, labels_path):
+    labels = {}
+    if labels_path and os.path.exists(labels_path):
+        with open(labels_path, encoding="utf-8") as labels_file:
+            for line in labels_file:
+                row = json.loads(line)
+                labels[row["text"]] = row["topic"]
+
+    missing = [text for text in texts if text not in labels]
+    if missing:
+        model_manager = managers.GptModelManager(logger=None)
+        request_context = model_manager.new_request_context("pt")
+        for text in missing:
+            labels[text] = model_manager.get_prompt_topic(request_context, text).strip()
+        print(f"GPT model labels: {len(missing)} new, {request_context.get_response_prompt_tokens()} prompt tokens")
+
+        if labels_path:
+            with open(labels_path, "w", encoding="utf-8") as labels_file:
+                for text, topic in labels.items():
+                    labels_file.write(json.dumps({"text": text, "topic": topic}, ensure_ascii=False) + "\n")
+
+    return [labels[text] for text in texts]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sample", default=os.path.join(BACKEND_FOLDER, "benchmarks", "data", "topic_sample.jsonl"))
+    parser.add_argument("--labels", default=None, help="JSONL file to cache the GPT model labels")
+    parser.add_argument("--min-agreement", type=float, default=1.0, help="Fast path agreement for the suggested thresholds")
+    args = parser.parse_args()
+
+    with open(args.sample, encoding="utf-8") as sample_file:
+        texts = [json.loads(line)["text"] for line in sample_file if line.strip()]
+
+    overlap = get_exemplar_overlap(texts)
+    if overlap:
+        print(f"{len(overlap)} sample messages are also topic exemplars, replace them with held-out messages:")
+        for text in overlap:
+            print(f"  {text}")
+        sys.exit(1)
+
+    llm_labels = get_llm_labels(texts, args.labels)
+
+    knowledge_manager = managers.StorageKnowledgeManager()
+    classifier = managers.EmbeddingTopicClassifier(knowledge_manager.embeddings)
+    predictions = [classifier.predict(text) for text in texts]
+
+    # Nearest centroid vs GPT model, without thresholds
+    agreement = sum(topic == label for (topic, _, _), label in zip(predictions, llm_labels)) / len(texts)
+    print(f"Nearest-centroid agreement with the GPT model (all topics, no threshold): {agreement:.1%}")
+
+    # Fast path (topics 1 and 2 above the thresholds) vs GPT model
+    print(f"\n{'similarity':>10} {'margin':>7} {'fast path':>10} {'agreement':>10} {'errors':>7}")
+    suggested = None
+    for similarity_threshold in SIMILARITY_THRESHOLDS:
+        for margin_threshold in MARGIN_THRESHOLDS:
+            fast_path = [(topic, label) for (topic, similarity, margin), label in zip(predictions, llm_labels)
+                         if topic in managers.topic.embeddingtopicclassifier.FAST_PATH_TOPICS
+                         and similarity >= similarity_threshold and margin >= margin_threshold]
+            errors = sum(topic != label for topic, label in fast_path)
+            fast_path_agreement = 1 - errors / len(fast_path) if fast_path else 1.0
+            print(f"{similarity_threshold:>10} {margin_threshold:>7} {len(fast_path) / len(texts):>10.1%} {fast_path_agreement:>10.1%} {errors:>7}")
+            if fast_path and fast_path_agreement >= args.min_agreement and (suggested is None or len(fast_path) >= suggested[2]):
+                suggested = (similarity_threshold, margin_threshold, len(fast_path))
+
+    if suggested:
+        print(f"\nSuggested: TOPIC_SIMILARITY_THRESHOLD={suggested[0]} TOPIC_MARGIN_THRESHOLD={suggested[1]} "
+              f"(fast path {suggested[2] / len(texts):.1%}, agreement >= {args.min_agreement:.1%})")
+    else:
+        print(f"\nNo thresholds reach {args.min_agreement:.1%} agreement on this sample")
+
+    print("\nDisagreements (nearest centroid vs GPT model):")
+    for text, (topic, similarity, margin), label in zip(texts, predictions, llm_labels):
+        if topic != label:
+            print(f"  {topic} vs {label}  similarity {similarity:.3f} margin {margin:.3f}  {text}")
+
+
+if __name__ == "__main__":
+    main()
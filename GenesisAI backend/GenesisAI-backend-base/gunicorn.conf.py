@@ -0,0 +1,27 @@
+# gunicorn settings read from the working folder (the command line options of the Dockerfile still apply)
+import shutil
+import sys
+import os
+
+
+# Method to clean the Prometheus samples of a previous run before the workers start
+def on_starting(server):
+    multiprocess_dir = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+    if multiprocess_dir:
+        shutil.rmtree(multiprocess_dir, ignore_errors=True)
+        os.makedirs(multiprocess_dir, exist_ok=True)
+
+
+# Method to remove the live samples (gauges) of a stopped worker; its histograms are still added up by /metrics
+def child_exit(server, worker):
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
+
+
+# Method to send (or save in the spool file) the backoffice events of a worker when it exits; atexit isn't enough when
+# gunicorn stops the worker at the end of its graceful timeout
+def worker_exit(server, worker):
+    app_module = sys.modules.get("app")
+    if app_module is not None:
+        app_module.model_manager.backoffice_dispatcher.shutdown()
@@ -1,5 +1,23 @@
 from managers.keyvault.keyvaultmanager import KeyvaultManager
 from managers.history.cosmoshistorymanager import CosmosHistoryManager
+from managers.history.historyjournal import HistoryJournal
+from managers.language.ngramlanguageidentifier import NgramLanguageIdentifier
+from managers.topic.embeddingtopicclassifier import EmbeddingTopicClassifier
+from managers.cache.lruttlcache import LruTtlCache
+from managers.cache.semanticanswercache import SemanticAnswerCache, CachedAnswerChain
+from managers.cache.recentturnscache import RecentTurnsCache
+from managers.backoffice.contextidcache import ContextIdCache
+from managers.backoffice.backofficedispatcher import BackofficeDispatcher
+from managers.metrics.stagemetrics import StageMetrics
+from managers.model.tokencounter import TokenCounter
+from managers.model.requestcontext import RequestContext
+from managers.model.streamframer import StreamFramer
+from managers.model.streamedgeneration import StreamedGeneration
+from managers.model.llmclientregistry import LlmClientRegistry
 from managers.model.gptmodelmanager import GptModelManager
+from managers.knowledge.cachedembeddings import CachedEmbeddings
 from managers.knowledge.storageknowledgemanager import StorageKnowledgeManager
-from managers.history.cosmoshistorymanager import await_cosmosdb_function
+from managers.history.cosmoshistorymanager import await_cosmosdb_function, run_cosmosdb_function
+from managers.pipeline.stagescheduler import StageScheduler
+from managers.speech.speechconfigpool import SpeechConfigPool
+from managers.speech.speechmanager import SpeechManager
@@ -0,0 +1,253 @@
+from requests.adapters import HTTPAdapter
+import portalocker
+import threading
+import requests
+import atexit
+import queue
+import json
+import time
+import os
+
+# Status codes worth sending again (the backoffice may be restarting or throttling)
+RETRY_STATUS_CODES = (408, 425, 429, 500, 502, 503, 504)
+
+
+# BackofficeDispatcher class
+# Sends the backoffice telemetry (messages, tokens and feedback) in a background thread, so the request threads never
+# wait for the backoffice API:
+# - bounded queue (events are dropped and counted when it's full)
+# - pooled requests.Session with connect/read timeouts, and retries with exponential backoff
+# - the token events of the same project are summed into a single POST, and only the last feedback of each message is sent
+# - the events not sent at shutdown are saved in a spool file and sent again by the next process (except the event being
+#   sent, which the backoffice may have received already: sending it again would duplicate messages and token amounts)
+class BackofficeDispatcher:
+
+    def __init__(self, get_headers, max_queue_size:int = 1000, connect_timeout_seconds:float = 3.05,
+                 read_timeout_seconds:float = 10, max_retries:int = 4, backoff_seconds:float = 0.5,
+                 batch_window_seconds:float = 1.0, spool_path:str = None, context_id_cache=None):
+        self._get_headers = get_headers
+        self._context_id_cache = context_id_cache
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._timeout = (connect_timeout_seconds, read_timeout_seconds)
+        self._max_retries = max_retries
+        self._backoff_seconds = backoff_seconds
+        self._batch_window_seconds = batch_window_seconds
+        self._spool_path = spool_path
+
+        self._session = requests.Session()
+        self._session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8))
+
+        self._stats_lock = threading.Lock()
+        self._stats = {"enqueued": 0, "sent": 0, "coalesced": 0, "retries": 0, "failed": 0, "dropped": 0,
+                       "spooled": 0, "restored": 0, "unconfirmed": 0}
+
+        # Events taken from the queue and not sent yet (saved in the spool file if the process stops), and the event
+        # being sent (not saved)
+        self._pending = []
+        self._in_flight = None
+        self._pending_lock = threading.Lock()
+        self._stopping = threading.Event()
+
+        self.restore_spool()
+        self._worker = threading.Thread(target=self._run, name="backoffice-dispatcher", daemon=True)
+        self._worker.start()
+        atexit.register(self.shutdown)
+
+    # Method to update the statistics counters
+    def _count(self, name:str, value:int = 1):
+        with self._stats_lock:
+            self._stats[name] += value
+
+    # Method to queue an event; returns False if the queue is full and the event was dropped
+    # context_request (optional) is a POST whose contextId is added to the event data before sending it (and saved in the
+    # context id cache, so the next messages of the same client topic don't need it)
+    def enqueue(self, method:str, url:str, data:dict, headers:dict = None, context_request:dict = None) -> bool:
+        event = {"method": method, "url": url, "data": data, "headers": headers, "context_request": context_request,
+                 "attempts": 0}
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            self._count("dropped")
+            print(f"Backoffice queue full, event dropped: {method} {url}")
+            return False
+        self._count("enqueued")
+        return True
+
+    # Method to run the dispatcher: take the events of a batch window, coalesce and send them
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                event = self._queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+
+            batch = [event]
+            deadline = time.monotonic() + self._batch_window_seconds
+            while not self._stopping.is_set():
+                try:
+                    batch.append(self._queue.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+
+            batch = self._coalesce(batch)
+            with self._pending_lock:
+                self._pending = list(batch)
+            for event in batch:
+                if self._stopping.is_set():
+                    break
+                with self._pending_lock:
+                    self._pending.remove(event)
+                    self._in_flight = event
+                sent = self._send_with_retries(event)
+                with self._pending_lock:
+                    # Stopped while waiting for a retry, the event isn't being sent anymore
+                    if not sent:
+                        self._pending.append(event)
+                    self._in_flight = None
+
+    # Method to coalesce a batch: sum the token amounts of each project and keep the last feedback of each message
+    def _coalesce(self, batch:list) -> list:
+        coalesced = []
+        tokens_events = {}
+        feedback_events = {}
+        for event in batch:
+            data = event["data"]
+            if event["url"].endswith("/tokens") and event["method"] == "POST":
+                key = (event["url"], data.get("projectId"))
+                if key in tokens_events:
+                    tokens_events[key]["data"]["amount"] = int(tokens_events[key]["data"]["amount"]) + int(data.get("amount", 0))
+                    self._count("coalesced")
+                    continue
+                event = dict(event, data=dict(data))
+                tokens_events[key] = event
+            elif event["url"].endswith("/feedback") and event["method"] == "PATCH":
+                key = (event["url"], data.get("conversationId"), data.get("messageId"))
+                if key in feedback_events:
+                    feedback_events[key]["data"] = data
+                    self._count("coalesced")
+                    continue
+                feedback_events[key] = event
+            coalesced.append(event)
+        return coalesced
+
+    # Method to send an event, retrying connection errors, timeouts and temporary errors with exponential backoff
+    # Returns False if the process is stopping before the event is sent (it stays pending, for the spool file)
+    def _send_with_retries(self, event:dict) -> bool:
+        while True:
+            try:
+                self._send(event)
+                self._count("sent")
+                return True
+            except Exception as e:
+                event["attempts"] += 1
+                retryable = not isinstance(e, requests.HTTPError) or e.response is None or e.response.status_code in RETRY_STATUS_CODES
+                if not retryable or event["attempts"] > self._max_retries:
+                    self._count("failed")
+                    print(f"Backoffice {event['method']} {event['url']} failed after {event['attempts']} attempts: {e}")
+                    return True
+                self._count("retries")
+                # Stop waiting (the event goes to the spool file) if the process is stopping
+                if self._stopping.wait(self._backoff_seconds * 2 ** (event["attempts"] - 1)):
+                    return False
+
+    # Method to send an event (and get its context id first, if needed)
+    def _send(self, event:dict):
+        headers = event.get("headers") or self._get_headers()
+
+        context_request = event.get("context_request")
+        if context_request:
+            context_data = context_request["data"]
+            context_id = None
+            if self._context_id_cache is not None:
+                context_id = self._context_id_cache.get(context_data["projectId"], context_data["contextName"])
+            if context_id is None:
+                response = self._session.post(context_request["url"], headers=headers, data=json.dumps(context_data),
+                                              timeout=self._timeout)
+                response.raise_for_status()
+                context_id = response.json()["contextId"]
+                if self._context_id_cache is not None:
+                    self._context_id_cache.set(context_data["projectId"], context_data["contextName"], context_id)
+            event["data"]["context"] = context_id
+            event["data"].setdefault("contexts", []).append(context_id)
+            event["context_request"] = None
+
+        response = self._session.request(event["method"], event["url"], headers=headers, data=json.dumps(event["data"]),
+                                         timeout=self._timeout)
+        response.raise_for_status()
+
+    # Method to save the events not sent yet in the spool file (appended, the spool file is shared by the workers)
+    def _write_spool(self, events:list):
+        if not self._spool_path or not events:
+            return
+        with portalocker.Lock(self._spool_path, mode="a", timeout=10, encoding="utf-8") as spool_file:
+            for event in events:
+                # The headers (API key) aren't saved; the events are sent with the current headers
+                spool_file.write(json.dumps(dict(event, headers=None)) + "\n")
+        self._count("spooled", len(events))
+
+    # Method to queue the events saved in the spool file by a previous process
+    def restore_spool(self):
+        if not self._spool_path or not os.path.exists(self._spool_path):
+            return
+        try:
+            with portalocker.Lock(self._spool_path, mode="r+", timeout=10, encoding="utf-8") as spool_file:
+                lines = spool_file.readlines()
+                spool_file.seek(0)
+                spool_file.truncate()
+        except Exception as e:
+            print(f"Could not read the backoffice spool file: {e}")
+            return
+
+        events = []
+        for line in lines:
+            try:
+                events.append(json.loads(line))
+            except ValueError:
+                continue
+        for position, event in enumerate(events):
+            try:
+                self._queue.put_nowait(event)
+            except queue.Full:
+                # Keep the rest for the next process
+                self._write_spool(events[position:])
+                break
+            self._count("restored")
+
+    # Method to stop the dispatcher and save the events not sent yet
+    # Also called by the worker_exit hook of gunicorn.conf.py
+    def shutdown(self, timeout_seconds:float = 5):
+        if self._stopping.is_set():
+            return
+        # Give the worker a little time to send what's queued
+        deadline = time.monotonic() + timeout_seconds
+        while not self._queue.empty() and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self._stopping.set()
+        # Wait at least for the request in progress (connect and read timeouts)
+        self._worker.join(timeout=max(0.0, deadline - time.monotonic()) + sum(self._timeout))
+
+        with self._pending_lock:
+            events = list(self._pending)
+            self._pending = []
+            in_flight = self._in_flight
+        if in_flight is not None:
+            self._count("unconfirmed")
+            print(f"Backoffice {in_flight['method']} {in_flight['url']} still being sent at shutdown, not saved in the spool file")
+        while True:
+            try:
+                events.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        try:
+            self._write_spool(events)
+        except Exception as e:
+            print(f"Could not save {len(events)} backoffice events in the spool file: {e}")
+
+    # Method to get the dispatcher statistics
+    def get_stats(self) -> dict:
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats["queue_depth"] = self._queue.qsize()
+        with self._pending_lock:
+            stats["in_flight"] = len(self._pending) + (self._in_flight is not None)
+        return stats
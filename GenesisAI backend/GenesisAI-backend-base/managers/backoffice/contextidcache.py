@@ -0,0 +1,94 @@
+import portalocker
+import threading
+import json
+import time
+import os
+
+
+# ContextIdCache class
+# Backoffice contextId of each (project, client topic), kept for a TTL in a JSON file shared by all the workers
+# The file is read again only when another worker changes it (modification time)
+class ContextIdCache:
+
+    def __init__(self, path:str, ttl_seconds:float = 86400):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        # "project|topic" -> {"context_id": ..., "time": epoch seconds}
+        self._entries = {}
+        self._mtime = None
+        self._hits = 0
+        self._misses = 0
+
+    # Method to get the cache key of a client topic
+    def _key(self, project_id:str, topic:str) -> str:
+        return f"{project_id}|{topic.strip().lower()}"
+
+    # Method to read the shared file again if it changed
+    def _reload(self):
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime == self._mtime:
+            return
+        try:
+            with open(self.path, encoding="utf-8") as cache_file:
+                self._entries = json.load(cache_file)
+            self._mtime = mtime
+        except (OSError, ValueError) as e:
+            print(f"Could not read the context id cache: {e}")
+
+    # Method to get the contextId of a client topic (None if unknown or older than the TTL)
+    def get(self, project_id:str, topic:str):
+        with self._lock:
+            self._reload()
+            entry = self._entries.get(self._key(project_id, topic))
+            if entry is None or time.time() - entry["time"] > self.ttl_seconds:
+                self._misses += 1
+                return None
+            self._hits += 1
+            return entry["context_id"]
+
+    # Method to save the contextId of a client topic (merged with the entries saved by the other workers)
+    def set(self, project_id:str, topic:str, context_id):
+        with self._lock:
+            try:
+                with portalocker.Lock(f"{self.path}.lock", timeout=10):
+                    self._mtime = None
+                    self._reload()
+                    self._entries[self._key(project_id, topic)] = {"context_id": context_id, "time": time.time()}
+                    temporary_path = f"{self.path}.{os.getpid()}"
+                    with open(temporary_path, "w", encoding="utf-8") as cache_file:
+                        json.dump(self._entries, cache_file)
+                    os.replace(temporary_path, self.path)
+                    self._mtime = os.stat(self.path).st_mtime_ns
+            except Exception as e:
+                # Keep it in memory at least
+                self._entries[self._key(project_id, topic)] = {"context_id": context_id, "time": time.time()}
+                print(f"Could not save the context id cache: {e}")
+
+    # Method to resolve the client topics not cached yet, in a background thread (e.g. at startup)
+    # resolve is a function of the topic returning its contextId; the failed topics are resolved later, when used
+    def warm(self, project_id:str, topics, resolve):
+        def warm_topics():
+            for topic in topics:
+                if self.get(project_id, topic) is not None:
+                    continue
+                try:
+                    self.set(project_id, topic, resolve(topic))
+                except Exception as e:
+                    print(f"Could not get the backoffice context id of {topic}: {e}")
+
+        threading.Thread(target=warm_topics, name="context-id-warmup", daemon=True).start()
+
+    # Method to get the cache statistics
+    def get_stats(self) -> dict:
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "entries": len(self._entries),
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_rate": round(self._hits / lookups, 4) if lookups else 0.0
+            }
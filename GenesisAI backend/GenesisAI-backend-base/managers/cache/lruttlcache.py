@@ -0,0 +1,67 @@
+from collections import OrderedDict
+import threading
+import time
+
+
+# LruTtlCache class
+# Thread-safe key/value cache bounded by number of entries (least recently used are evicted first) and by age
+class LruTtlCache:
+
+    def __init__(self, max_entries:int = 1000, ttl_seconds:float = 3600):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        # key -> (value, expiry time), in LRU order
+        self._entries: OrderedDict = OrderedDict()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    # Method to get a cached value; returns default on a miss or if the entry expired
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[1] > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self._hits += 1
+                    return entry[0]
+                del self._entries[key]
+                self._evictions += 1
+            self._misses += 1
+            return default
+
+    # Method to cache a value (ttl_seconds overrides the cache TTL for this entry)
+    def set(self, key, value, ttl_seconds:float = None):
+        expiry_time = time.monotonic() + (self.ttl_seconds if ttl_seconds is None else ttl_seconds)
+        with self._lock:
+            self._entries[key] = (value, expiry_time)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._evictions += 1
+
+    # Method to remove a cached value
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    # Method to remove all the cached values
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    # Method to get the cache statistics
+    def get_stats(self) -> dict:
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "entries": len(self._entries),
+                "hits": self._hits,
+                "misses": self._misses,
+                "evictions": self._evictions,
+                "hit_rate": round(self._hits / lookups, 4) if lookups else 0.0
+            }
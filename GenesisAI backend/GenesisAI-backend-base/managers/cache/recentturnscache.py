@@ -0,0 +1,133 @@
+from collections import OrderedDict
+import threading
+import time
+
+# Approximate memory of an entry besides its strings (entry tuple, item dicts, OrderedDict node)
+ENTRY_OVERHEAD_BYTES = 400
+ITEM_OVERHEAD_BYTES = 250
+
+
+# RecentTurnsCache class
+# Last turns of each conversation (Query, Reply and Feedback) and their formatted conversation history string, so the
+# chat endpoint doesn't read the conversation from CosmosDB on every message
+# Bounded by number of turns per conversation, by age and by an approximate memory budget (least recently used
+# conversations are evicted first); entries are updated when a turn is saved or a feedback changes
+# head_version (optional) is a function of the conversation id returning the last message id saved by any worker (e.g.
+# the history journal): if it isn't the last cached message, the entry was changed by another worker and is read again;
+# if it's unknown (None), the entry can't be checked and is read again too
+# The heads of the history journal are only shared by the workers of a host: the turns saved by other replicas are
+# only seen when the entry expires, so ttl_seconds is short (or the replicas use sticky sessions by conversation)
+class RecentTurnsCache:
+
+    def __init__(self, format_history, max_turns:int = 2, max_bytes:int = 8 * 1024 * 1024, ttl_seconds:float = 60,
+                 head_version=None):
+        self._format_history = format_history
+        self.max_turns = max_turns
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._head_version = head_version
+        self._lock = threading.Lock()
+        # conversation id -> (turns, formatted history, size in bytes, expiry time), in LRU order
+        self._entries: OrderedDict = OrderedDict()
+        self._bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._stale = 0
+        self._evictions = 0
+
+    # Method to get the approximate memory of an entry
+    def _get_size(self, conversation_id:str, turns:list, history:str) -> int:
+        size = ENTRY_OVERHEAD_BYTES + len(conversation_id) + len(history.encode("utf-8"))
+        for turn in turns:
+            size += ITEM_OVERHEAD_BYTES + sum(len(value.encode("utf-8")) for value in turn.values())
+        return size
+
+    # Method to get a turn from a conversation item (ConversationItem or dict)
+    def _get_turn(self, item) -> dict:
+        if not isinstance(item, dict):
+            item = item.dict()
+        return {"MessageId": item["MessageId"], "Query": item["Query"], "Reply": item["Reply"],
+                "Feedback": item.get("Feedback", "")}
+
+    # Method to save an entry and evict the least recently used ones over the memory budget (lock held)
+    def _store(self, conversation_id:str, turns:list):
+        turns = turns[-self.max_turns:] if self.max_turns > 0 else []
+        history = self._format_history(turns)
+        self._remove(conversation_id)
+        size = self._get_size(conversation_id, turns, history)
+        if size > self.max_bytes:
+            return
+        self._entries[conversation_id] = (turns, history, size, time.monotonic() + self.ttl_seconds)
+        self._bytes += size
+        while self._bytes > self.max_bytes:
+            evicted_id = next(iter(self._entries))
+            self._remove(evicted_id)
+            self._evictions += 1
+
+    # Method to remove an entry (lock held)
+    def _remove(self, conversation_id:str):
+        entry = self._entries.pop(conversation_id, None)
+        if entry is not None:
+            self._bytes -= entry[2]
+
+    # Method to get the formatted conversation history; returns None on a miss (expired or changed by another worker)
+    def get(self, conversation_id:str):
+        head_version = self._head_version(conversation_id) if self._head_version is not None else None
+        with self._lock:
+            entry = self._entries.get(conversation_id)
+            if entry is not None:
+                turns, history, _, expiry_time = entry
+                last_message_id = turns[-1]["MessageId"] if turns else None
+                if expiry_time <= time.monotonic():
+                    self._remove(conversation_id)
+                    self._evictions += 1
+                elif self._head_version is not None and (head_version is None or head_version != last_message_id):
+                    self._remove(conversation_id)
+                    self._stale += 1
+                else:
+                    self._entries.move_to_end(conversation_id)
+                    self._hits += 1
+                    return history
+            self._misses += 1
+            return None
+
+    # Method to cache the last turns of a conversation read from CosmosDB (items oldest first)
+    def put(self, conversation_id:str, items:list):
+        with self._lock:
+            self._store(conversation_id, [self._get_turn(item) for item in items])
+
+    # Method to add a saved turn to a cached conversation (conversations not cached are read on their next message)
+    def add_turn(self, conversation_id:str, item):
+        with self._lock:
+            entry = self._entries.get(conversation_id)
+            if entry is not None:
+                turn = self._get_turn(item)
+                self._store(conversation_id, [cached for cached in entry[0] if cached["MessageId"] != turn["MessageId"]] + [turn])
+
+    # Method to update the feedback of a cached turn
+    def set_feedback(self, conversation_id:str, message_id:str, feedback:str):
+        with self._lock:
+            entry = self._entries.get(conversation_id)
+            if entry is not None and any(turn["MessageId"] == message_id for turn in entry[0]):
+                self._store(conversation_id, [dict(turn, Feedback=feedback) if turn["MessageId"] == message_id else turn
+                                              for turn in entry[0]])
+
+    # Method to remove a cached conversation
+    def delete(self, conversation_id:str):
+        with self._lock:
+            self._remove(conversation_id)
+
+    # Method to get the cache statistics
+    def get_stats(self) -> dict:
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self._hits,
+                "misses": self._misses,
+                "stale": self._stale,
+                "evictions": self._evictions,
+                "hit_rate": round(self._hits / lookups, 4) if lookups else 0.0
+            }
@@ -0,0 +1,147 @@
+from collections import OrderedDict
+from langchain_core.messages import AIMessageChunk
+import numpy as np
+import threading
+import time
+import uuid
+import re
+
+
+# SemanticAnswerCache class
+# Caches the final answers of the RAG chain by query embedding, language and client topic
+# An answer is reused when a new query is similar enough and the knowledge index version is the same
+class SemanticAnswerCache:
+
+    def __init__(self, similarity_threshold:float = 0.95, max_entries:int = 2000, ttl_seconds:float = 86400):
+        self.similarity_threshold = similarity_threshold
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        # entry id -> (partition key, normalized embedding, answer, creation time), in LRU order
+        self._entries: OrderedDict = OrderedDict()
+        # partition key -> (entry ids, embeddings matrix), rebuilt when the partition changes
+        self._partition_matrices: dict = {}
+        self._index_version = None
+        self._hits = 0
+        self._misses = 0
+        self._bypasses = 0
+        self._evictions = 0
+
+    # Method to normalize an embedding to unit length (cosine similarity becomes a dot product)
+    def _normalize(self, embedding) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        return vector / max(float(np.linalg.norm(vector)), 1e-12)
+
+    # Method to get the embeddings matrix of a partition (the lock must be held)
+    def _get_partition_matrix(self, partition_key):
+        if partition_key not in self._partition_matrices:
+            entry_ids = [entry_id for entry_id, entry in self._entries.items() if entry[0] == partition_key]
+            matrix = np.stack([self._entries[entry_id][1] for entry_id in entry_ids]) if entry_ids else None
+            self._partition_matrices[partition_key] = (entry_ids, matrix)
+        return self._partition_matrices[partition_key]
+
+    # Method to drop the answers of older knowledge index versions when the version changes (the lock must be held)
+    def _sync_index_version(self, index_version):
+        if index_version != self._index_version:
+            for entry_id in [entry_id for entry_id, entry in self._entries.items() if entry[0][2] != index_version]:
+                self._remove_entry(entry_id)
+            self._index_version = index_version
+
+    # Method to remove an entry (the lock must be held)
+    def _remove_entry(self, entry_id):
+        partition_key = self._entries.pop(entry_id)[0]
+        self._partition_matrices.pop(partition_key, None)
+
+    # Method to get a cached answer for a query; returns None on a miss
+    def get(self, query_embedding, language:str, client_topic:str, index_version:str):
+        partition_key = (language, client_topic.strip().lower(), index_version)
+        query_vector = self._normalize(query_embedding)
+
+        with self._lock:
+            self._sync_index_version(index_version)
+            entry_ids, matrix = self._get_partition_matrix(partition_key)
+            if matrix is not None:
+                similarities = matrix @ query_vector
+                for position in np.argsort(similarities)[::-1]:
+                    if similarities[position] < self.similarity_threshold:
+                        break
+                    entry_id = entry_ids[position]
+                    _, _, answer, created_at = self._entries[entry_id]
+                    # Expired entries are removed when found
+                    if time.time() - created_at > self.ttl_seconds:
+                        self._remove_entry(entry_id)
+                        self._evictions += 1
+                        continue
+                    self._entries.move_to_end(entry_id)
+                    self._hits += 1
+                    return answer
+
+            self._misses += 1
+            return None
+
+    # Method to cache the answer of a query
+    def put(self, query_embedding, language:str, client_topic:str, index_version:str, answer:str):
+        partition_key = (language, client_topic.strip().lower(), index_version)
+
+        with self._lock:
+            self._sync_index_version(index_version)
+            self._entries[uuid.uuid4().hex] = (partition_key, self._normalize(query_embedding), answer, time.time())
+            self._partition_matrices.pop(partition_key, None)
+
+            # Evict the least recently used entries
+            while len(self._entries) > self.max_entries:
+                self._remove_entry(next(iter(self._entries)))
+                self._evictions += 1
+
+    # Method to count a request that couldn't use the cache (e.g. with conversation history)
+    def record_bypass(self):
+        with self._lock:
+            self._bypasses += 1
+
+    # Method to remove all the cached answers
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._partition_matrices.clear()
+
+    # Method to get the cache statistics
+    def get_stats(self) -> dict:
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "entries": len(self._entries),
+                "hits": self._hits,
+                "misses": self._misses,
+                "bypasses": self._bypasses,
+                "evictions": self._evictions,
+                "hit_rate": round(self._hits / lookups, 4) if lookups else 0.0
+            }
+
+
+# CachedAnswerChain class
+# Streams a cached answer with the same interface as the RAG chain, so GptModelManager.generate can use it
+class CachedAnswerChain:
+
+    # Cached answers aren't billed by the GPT model
+    cached = True
+
+    def __init__(self, answer:str, chunk_size:int = 20):
+        self._answer = answer
+        self._chunk_size = chunk_size
+
+    # Method to stream the answer in word-aligned chunks of about chunk_size characters
+    def stream(self, _input):
+        message_id = f"cached-{uuid.uuid4()}"
+        chunk = ""
+        for word in re.findall(r"\S+\s*|\s+", self._answer):
+            chunk += word
+            if len(chunk) >= self._chunk_size:
+                yield AIMessageChunk(content=chunk, id=message_id)
+                chunk = ""
+        if chunk:
+            yield AIMessageChunk(content=chunk, id=message_id)
+
+    # Method to stream the answer on an event loop (ASGI mode)
+    async def astream(self, _input):
+        for chunk in self.stream(_input):
+            yield chunk
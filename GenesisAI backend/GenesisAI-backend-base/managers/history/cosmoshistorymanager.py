@@ -1,8 +1,11 @@
-from azure.cosmos import CosmosClient
-from azure.cosmos.exceptions import CosmosHttpResponseError
+from azure.cosmos.aio import CosmosClient
+from azure.cosmos.exceptions import CosmosHttpResponseError, CosmosResourceNotFoundError, CosmosResourceExistsError
+from azure.core import MatchConditions
 from typing import List, Optional
+import threading
 import models
 import managers
+import atexit
 import os
 import asyncio
 from dotenv import load_dotenv
@@ -12,18 +15,60 @@ load_dotenv()
 # Initialize the Keyvault manager
 keyvault_manager = managers.KeyvaultManager()
 
+# Storage layouts of the conversations (COSMOSDB_STORAGE_LAYOUT):
+# - "document": a single document per conversation with all its items (every turn reads and replaces the whole document)
+# - "message": a header document per conversation (id = conversation id, TotalTokens and MessageCount updated with patch
+#   operations) and a document per message in the same partition, so a turn never reads or rewrites the older ones
+# Conversations saved with the "document" layout are still read in the "message" layout, and moved to it on their next save
+DOCUMENT_LAYOUT = "document"
+MESSAGE_LAYOUT = "message"
+
+# Prefix of the message document ids (the header document id is the conversation id)
+MESSAGE_ID_PREFIX = "msg-"
+
+# Maximum number of operations of a CosmosDB patch request
+MAX_PATCH_OPERATIONS = 10
+
+# CosmosDB event loop: a single long-lived loop in a daemon thread, where all the CosmosDB requests of the process run
+# concurrently (the request threads wait on await_cosmosdb_function)
+_cosmosdb_loop = None
+_cosmosdb_loop_thread = None
+_cosmosdb_loop_lock = threading.Lock()
+
+# CosmosDB async client of each account, shared by all the CosmosHistoryManager instances of the process (its connections
+# are reused by all the requests)
+_cosmos_clients = {}
+_cosmos_clients_lock = threading.Lock()
+
+
 # CosmosHistoryManager class
 class CosmosHistoryManager:
     
-    def __init__(self, logger):
+    def __init__(self, logger, layout:str = None):
         self._logger = logger
+        self.layout = (layout or os.environ.get("COSMOSDB_STORAGE_LAYOUT", DOCUMENT_LAYOUT)).strip().lower()
+        # Request units and number of CosmosDB operations (from the response headers)
+        self._stats_lock = threading.Lock()
+        self._request_charge = 0.0
+        self._operations = 0
+        self._migrations = 0
+        # Write-behind journal of the conversation items not saved in CosmosDB yet (set by set_journal)
+        self._journal = None
+        # Number of previous query/reply pairs in the conversation history, and their cache (set by set_recent_turns_cache)
+        self.recent_turns = int(os.environ.get("HISTORY_RECENT_TURNS", "2"))
+        self._recent_turns_cache = None
+        # Position of each message in the Items of the "document" layout conversations (conversation id -> {message id:
+        # position}), saved with the turns, so a feedback is patched without reading the conversation
+        self._message_positions = managers.LruTtlCache(max_entries=int(os.environ.get("HISTORY_MESSAGE_INDEX_MAX_ENTRIES", "10000")),
+                                                       ttl_seconds=float(os.environ.get("HISTORY_MESSAGE_INDEX_TTL_SECONDS", "86400")))
         
-        self.azure_keyvault_client = keyvault_manager.get_azure_keyvault_client()        
-
         # Load the CosmosDB environment variables
-        url = self.azure_keyvault_client.get_secret("COSMOSDB-ENDPOINT").value
-        credential = self.azure_keyvault_client.get_secret("COSMOSDB-PRIMARY-KEY").value
-        self._cosmos = CosmosClient(url, credential)
+        url = keyvault_manager.get_secret("COSMOSDB-ENDPOINT")
+        credential = keyvault_manager.get_secret("COSMOSDB-PRIMARY-KEY")
+        with _cosmos_clients_lock:
+            if url not in _cosmos_clients:
+                _cosmos_clients[url] = await_cosmosdb_function(_create_cosmos_client(url, credential))
+        self._cosmos = _cosmos_clients[url]
         self._database = self._cosmos.get_database_client(os.environ["COSMOSDB_DATABASE"],)
         self._container = self._database.get_container_client(os.environ["COSMOSDB_CONTAINER"],)
         
@@ -31,8 +76,11 @@ class CosmosHistoryManager:
     # Each conversation in CosmosDB has a unique id and a partition key. 
     # Both are the same and should be equal to the conversation_id, which is the frontend session id.
     async def get_conversation(self, conversation_id: str) -> Optional[models.Conversation]:
+        if self.layout == MESSAGE_LAYOUT:
+            return self._add_pending_items(conversation_id, await self._get_message_conversation(conversation_id))
         try:            
-            conversation_response = self._container.read_item(item=conversation_id, partition_key=conversation_id)
+            conversation_response = await self._container.read_item(item=conversation_id, partition_key=conversation_id,
+                                                                    response_hook=self._track_request)
             items = conversation_response.get('Items', {})
 
             if isinstance(items, dict):
@@ -49,10 +97,10 @@ class CosmosHistoryManager:
                 TotalTokens=conversation_response.get('TotalTokens', 0)
             )
 
-            return conversation_instance
+            return self._add_pending_items(conversation_id, conversation_instance)
         except CosmosHttpResponseError as ex:
             if ex.status_code == 404:
-                return None
+                return self._add_pending_items(conversation_id, None)
             else:
                 print(f"Erro ao obter a conversa: {str(ex)}")
                 return None
@@ -64,76 +112,461 @@ class CosmosHistoryManager:
     # Save a conversation to CosmosDB
     async def save_conversation(self, conversation_id: str, conversation_item: dict):
         try:
-            convo_response = self._container.read_item(item=conversation_id, partition_key=conversation_id)
-            
-            items = convo_response.get('Items', {})
-            if isinstance(items, dict):
-                items = [items] 
-            elif not isinstance(items, list):
-                raise ValueError("Items field is not a list or a dictionary")
+            await self.save_conversation_items(conversation_id, [conversation_item])
+        except Exception as e:
+            print(f"Erro ao salvar a conversa: {str(e)}")
 
-            conversation_items = [models.ConversationItem(**item) for item in items]
-            conversation_item_instance = models.ConversationItem(**conversation_item)
-            conversation_items.append(conversation_item_instance)
+    # Save several items of a conversation to CosmosDB with a single write (the errors are raised, for the retries)
+    # Items already saved (same MessageId) are skipped, so the same items can be saved again after a failure
+    async def save_conversation_items(self, conversation_id: str, conversation_items: list):
+        if self.layout == MESSAGE_LAYOUT:
+            return await self._save_messages(conversation_id, conversation_items)
 
+        new_items = [models.ConversationItem(**item) for item in conversation_items]
+        try:
+            convo_response = await self._container.read_item(item=conversation_id, partition_key=conversation_id,
+                                                             response_hook=self._track_request)
+        except CosmosResourceNotFoundError:
             convo = models.Conversation(
-                id=convo_response['id'],
-                partitionKey=convo_response['partitionKey'],
-                Items=conversation_items,
-                TotalTokens=sum(item.Usage.TotalTokens for item in conversation_items)
+                id=conversation_id,
+                partitionKey=conversation_id,
+                Items=new_items,
+                TotalTokens=sum(item.Usage.TotalTokens for item in new_items)
             )
-            self._container.replace_item(item=conversation_id, body=convo.dict())
-        
-        except CosmosHttpResponseError as e:
-            if e.status_code == 404:
-                convo = models.Conversation(
-                    id=conversation_id,
-                    partitionKey=conversation_id,
-                    Items=[models.ConversationItem(**conversation_item)],
-                    TotalTokens=conversation_item['Usage']['TotalTokens']
-                )
-                self._container.create_item(body=convo.dict())
+            await self._container.create_item(body=convo.dict(), response_hook=self._track_request)
+            self._set_message_positions(conversation_id, new_items)
+            return
+
+        items = convo_response.get('Items', {})
+        if not isinstance(items, (dict, list)):
+            raise ValueError("Items field is not a list or a dictionary")
+        conversation_items = self._get_document_items(convo_response)
+        saved_message_ids = {item.MessageId for item in conversation_items}
+        new_items = [item for item in new_items if item.MessageId not in saved_message_ids]
+        if not new_items:
+            return
+        conversation_items += new_items
+
+        convo = models.Conversation(
+            id=convo_response['id'],
+            partitionKey=convo_response['partitionKey'],
+            Items=conversation_items,
+            TotalTokens=sum(item.Usage.TotalTokens for item in conversation_items)
+        )
+        # Only if the document wasn't changed since it was read (e.g. by a feedback update), otherwise it's saved again
+        await self._container.replace_item(item=conversation_id, body=convo.dict(), etag=convo_response.get('_etag'),
+                                           match_condition=MatchConditions.IfNotModified, response_hook=self._track_request)
+        self._set_message_positions(conversation_id, conversation_items)
+
+    # Update the feedback of a message (for likes and dislikes)
+    # With the write-behind journal the feedback is saved in the background, with the other feedbacks of the conversation
+    # (only the last feedback of each message is saved); otherwise it's patched right away
+    async def set_feedback(self, conversation_id: str, message_id: str, feedback: str):
+        if self._recent_turns_cache is not None:
+            self._recent_turns_cache.set_feedback(conversation_id, message_id, feedback)
+        if self._journal is not None:
+            try:
+                self._journal.append_feedback(conversation_id, message_id, feedback)
+                return
+            except Exception as e:
+                print(f"Erro ao salvar o feedback no journal: {str(e)}")
+        try:
+            await self.save_feedbacks(conversation_id, {message_id: feedback})
         except Exception as e:
-            print(f"Erro ao salvar a conversa: {str(e)}")
+            print(f"Erro ao salvar o feedback: {str(e)}")
+
+    # Save the feedback of several messages of a conversation (message id -> feedback) with patch operations that only
+    # change the Feedback fields; returns the message ids not found (the errors are raised, for the retries)
+    async def save_feedbacks(self, conversation_id: str, feedbacks: dict) -> list:
+        if self.layout == MESSAGE_LAYOUT:
+            message_ids = list(feedbacks)
+            patched = await asyncio.gather(*[self._patch_message_feedback(conversation_id, message_id, feedbacks[message_id])
+                                             for message_id in message_ids])
+            # The rest may be items of a conversation not moved to the "message" layout yet
+            feedbacks = {message_id: feedbacks[message_id] for message_id, message_patched in zip(message_ids, patched)
+                         if not message_patched}
+            if not feedbacks:
+                return []
+        return await self._patch_document_feedbacks(conversation_id, feedbacks)
 
 
     # Update a conversation to CosmosDB (for likes and dislikes)
     async def update_conversation(self, conversation_id: str, conversation: models.Conversation):
         try:
-            
-            self._container.replace_item(item=conversation_id, body=conversation.dict())
+            if self._recent_turns_cache is not None:
+                self._recent_turns_cache.put(conversation_id, conversation.Items[-self.recent_turns:])
+            if self.layout == MESSAGE_LAYOUT:
+                # Rewrite the message documents and the header (also moves a "document" layout conversation)
+                await self._write_message_conversation(conversation_id, [item.dict() for item in conversation.Items],
+                                                       conversation.TotalTokens)
+                return
+
+            await self._container.replace_item(item=conversation_id, body=conversation.dict(), response_hook=self._track_request)
         
         except CosmosHttpResponseError as e:
             if e.status_code == 404:                
-                self._container.create_item(body=conversation.dict())
+                await self._container.create_item(body=conversation.dict(), response_hook=self._track_request)
         except Exception as e:
             print(f"Erro ao salvar a conversa: {str(e)}")
 
+    # Method to set the write-behind journal, whose items not saved yet are added to the conversations read
+    def set_journal(self, journal):
+        self._journal = journal
 
-    # Method to get the conversation history from CosmosDB        
-    async def get_last_conversation_items(self, conversation_id):
-        items = []        
-        if conversation_id:
-                convo = await self.get_conversation(conversation_id)
-                max_items = 2 # Number of previous query/Reply pairs to get
-                if convo:
-                    recent_items = convo.Items[-max_items:]  # This will give the last max_items items
-                    if len(recent_items) > 0:
-                        items.append("\n# Conversation History:\n")
-                        for entry in recent_items:
-                            items.append(f"- User:\n{entry.Query}\n")
-                            items.append(f"- You:\n{entry.Reply}\n")
-                        items.append("\n# End of conversation history.")
+    # Method to set the cache of the last turns of the conversations (formatted conversation history)
+    def set_recent_turns_cache(self, recent_turns_cache):
+        self._recent_turns_cache = recent_turns_cache
+
+    # Method to add a saved turn to the recent turns cache
+    def add_recent_turn(self, conversation_id:str, conversation_item:dict):
+        if self._recent_turns_cache is not None and conversation_id:
+            self._recent_turns_cache.add_turn(conversation_id, conversation_item)
+
+    # Method to get the journal items of a conversation not in the CosmosDB items yet
+    def _get_pending_items(self, conversation_id:str, saved_items:list) -> list:
+        if self._journal is None or not conversation_id:
+            return []
+        saved_message_ids = {item.MessageId for item in saved_items}
+        return [models.ConversationItem(**item) for item in self._journal.get_pending_items(conversation_id)
+                if item['MessageId'] not in saved_message_ids]
+
+    # Method to add the journal items not saved yet to a conversation read from CosmosDB (None if it doesn't exist)
+    def _add_pending_items(self, conversation_id:str, conversation: Optional[models.Conversation]) -> Optional[models.Conversation]:
+        pending_items = self._get_pending_items(conversation_id, conversation.Items if conversation else [])
+        if not pending_items:
+            return conversation
+        if conversation is None:
+            conversation = models.Conversation(id=conversation_id, partitionKey=conversation_id, Items=[], TotalTokens=0)
+        conversation.Items += pending_items
+        conversation.TotalTokens += sum(item.Usage.TotalTokens for item in pending_items)
+        return conversation
+
+    # Method to add the request units of a CosmosDB response to the statistics
+    def _track_request(self, headers, _result=None):
+        with self._stats_lock:
+            self._request_charge += float(headers.get("x-ms-request-charge", 0) or 0)
+            self._operations += 1
+
+    # Method to save the position of the items of a "document" layout conversation in the message index
+    def _set_message_positions(self, conversation_id:str, conversation_items:list):
+        self._message_positions.set(conversation_id, {item.MessageId: position for position, item in enumerate(conversation_items)})
+
+    # Method to read the position of the items of a "document" layout conversation (None if Items is a single item)
+    async def _read_message_positions(self, conversation_id:str) -> dict:
+        try:
+            header = await self._container.read_item(item=conversation_id, partition_key=conversation_id,
+                                                     response_hook=self._track_request)
+        except CosmosResourceNotFoundError:
+            return {}
+        items = header.get('Items') or []
+        if isinstance(items, dict):
+            return {items.get('MessageId'): None}
+        positions = {item.get('MessageId'): position for position, item in enumerate(items)}
+        self._message_positions.set(conversation_id, positions)
+        return positions
+
+    # Method to patch the feedback of a message document; returns False if the message document doesn't exist
+    async def _patch_message_feedback(self, conversation_id:str, message_id:str, feedback:str) -> bool:
+        try:
+            await self._container.patch_item(item=MESSAGE_ID_PREFIX + message_id, partition_key=conversation_id,
+                                             patch_operations=[{"op": "set", "path": "/Feedback", "value": feedback}],
+                                             response_hook=self._track_request)
+            return True
+        except CosmosResourceNotFoundError:
+            return False
+
+    # Method to patch the feedback of some items of a "document" layout conversation (message id -> feedback), by position
+    # The patch only applies if the items are still at those positions (filter predicate), otherwise it raises a 412 error
+    async def _patch_items_feedback(self, conversation_id:str, positions:dict, feedbacks:dict):
+        operations = []
+        conditions = []
+        for message_id, feedback in feedbacks.items():
+            position = positions[message_id]
+            item_path, item_reference = ("/Items", "c.Items") if position is None else (f"/Items/{position}", f"c.Items[{position}]")
+            escaped_message_id = message_id.replace("\\", "\\\\").replace("'", "\\'")
+            operations.append({"op": "set", "path": f"{item_path}/Feedback", "value": feedback})
+            conditions.append(f"{item_reference}.MessageId = '{escaped_message_id}'")
+        await self._container.patch_item(item=conversation_id, partition_key=conversation_id, patch_operations=operations,
+                                         filter_predicate=f"FROM c WHERE {' AND '.join(conditions)}",
+                                         response_hook=self._track_request)
+
+    # Method to patch the feedback of the items of a "document" layout conversation (message id -> feedback), up to
+    # MAX_PATCH_OPERATIONS items per patch; the positions are read from CosmosDB only if they're not in the message index
+    # (or changed since they were saved); returns the message ids not found
+    async def _patch_document_feedbacks(self, conversation_id:str, feedbacks:dict) -> list:
+        positions = self._message_positions.get(conversation_id) or {}
+        if any(message_id not in positions for message_id in feedbacks):
+            positions = await self._read_message_positions(conversation_id)
+        missing_message_ids = [message_id for message_id in feedbacks if message_id not in positions]
+        message_ids = [message_id for message_id in feedbacks if message_id in positions]
+        for start in range(0, len(message_ids), MAX_PATCH_OPERATIONS):
+            batch = {message_id: feedbacks[message_id] for message_id in message_ids[start:start + MAX_PATCH_OPERATIONS]}
+            try:
+                await self._patch_items_feedback(conversation_id, positions, batch)
+            except CosmosHttpResponseError as e:
+                if e.status_code != 412:
+                    raise
+                # Conversation changed since its positions were saved (e.g. moved to the "message" layout): read them again
+                positions = await self._read_message_positions(conversation_id)
+                missing_message_ids += [message_id for message_id in batch if message_id not in positions]
+                batch = {message_id: feedback for message_id, feedback in batch.items() if message_id in positions}
+                if batch:
+                    await self._patch_items_feedback(conversation_id, positions, batch)
+        return missing_message_ids
+
+    # Method to get the message document of a conversation item
+    def _message_document(self, conversation_id:str, item:dict) -> dict:
+        return dict(item, id=MESSAGE_ID_PREFIX + item["MessageId"], partitionKey=conversation_id, DocType="message")
+
+    # Method to get the items of a "document" layout conversation (header document with an Items field), or only the last ones
+    def _get_document_items(self, header:dict, max_items:int = None) -> list:
+        items = header.get('Items') or []
+        if isinstance(items, dict):
+            items = [items]
+        if max_items is not None:
+            items = items[-max_items:] if max_items > 0 else []
+        return [models.ConversationItem(**item) for item in items]
+
+    # Method to get the message documents of a conversation, oldest first (only the last max_items if given)
+    async def _query_messages(self, conversation_id:str, max_items:int = None) -> list:
+        if max_items:
+            query = "SELECT TOP @max_items * FROM c WHERE c.DocType = 'message' ORDER BY c.Date DESC"
+            parameters = [{"name": "@max_items", "value": max_items}]
+        else:
+            query = "SELECT * FROM c WHERE c.DocType = 'message' ORDER BY c.Date"
+            parameters = []
+        documents = [document async for document in self._container.query_items(
+            query=query, parameters=parameters, partition_key=conversation_id, response_hook=self._track_request)]
+        if max_items:
+            documents.reverse()
+        return [models.ConversationItem(**document) for document in documents]
+
+    # Method to get a "message" layout conversation (header and message documents)
+    async def _get_message_conversation(self, conversation_id:str) -> Optional[models.Conversation]:
+        try:
+            # Header and message documents read at the same time
+            header, message_items = await asyncio.gather(
+                self._container.read_item(item=conversation_id, partition_key=conversation_id, response_hook=self._track_request),
+                self._query_messages(conversation_id))
+            # Items of a conversation not moved to the "message" layout yet, then the message documents
+            conversation_items = self._get_document_items(header) + message_items
+            return models.Conversation(
+                id=header['id'],
+                partitionKey=header['partitionKey'],
+                Items=conversation_items,
+                TotalTokens=header.get('TotalTokens', 0)
+            )
+        except CosmosResourceNotFoundError:
+            return None
+        except Exception as e:
+            print(f"Erro ao processar a conversa: {str(e)}")
+            return None
+
+    # Method to create the message document of a conversation item; returns False if it was already saved
+    async def _create_message(self, conversation_id:str, item:dict) -> bool:
+        try:
+            await self._container.create_item(body=self._message_document(conversation_id, item), response_hook=self._track_request)
+            return True
+        except CosmosResourceExistsError:
+            return False
+
+    # Method to save conversation items as message documents, and add their tokens to the header document
+    async def _save_messages(self, conversation_id:str, conversation_items:list):
+        items = [models.ConversationItem(**item).dict() for item in conversation_items]
+        created = await asyncio.gather(*[self._create_message(conversation_id, item) for item in items])
+        new_items = [item for item, item_created in zip(items, created) if item_created]
+        if not new_items:
+            return
+        total_tokens = sum(item['Usage']['TotalTokens'] for item in new_items)
+
+        header_operations = [
+            {"op": "incr", "path": "/TotalTokens", "value": total_tokens},
+            {"op": "incr", "path": "/MessageCount", "value": len(new_items)}
+        ]
+        try:
+            header = await self._container.patch_item(item=conversation_id, partition_key=conversation_id,
+                                                      patch_operations=header_operations, response_hook=self._track_request)
+        except CosmosResourceNotFoundError:
+            try:
+                await self._container.create_item(body={
+                    "id": conversation_id,
+                    "partitionKey": conversation_id,
+                    "DocType": "header",
+                    "TotalTokens": total_tokens,
+                    "MessageCount": len(new_items)
+                }, response_hook=self._track_request)
+                return
+            except CosmosResourceExistsError:
+                # Created by another request in the meantime
+                header = await self._container.patch_item(item=conversation_id, partition_key=conversation_id,
+                                                          patch_operations=header_operations, response_hook=self._track_request)
+
+        # Conversation saved with the "document" layout: move its items to message documents (once)
+        if header.get('Items'):
+            await self._migrate_document(header)
+
+    # Method to write all the message documents and the header document of a conversation
+    async def _write_message_conversation(self, conversation_id:str, items:list, total_tokens:int, etag:str = None):
+        for item in items:
+            await self._container.upsert_item(body=self._message_document(conversation_id, item), response_hook=self._track_request)
+        header = {
+            "id": conversation_id,
+            "partitionKey": conversation_id,
+            "DocType": "header",
+            "TotalTokens": total_tokens,
+            "MessageCount": len(items)
+        }
+        if etag:
+            await self._container.replace_item(item=conversation_id, body=header, etag=etag,
+                                               match_condition=MatchConditions.IfNotModified, response_hook=self._track_request)
+        else:
+            await self._container.upsert_item(body=header, response_hook=self._track_request)
+
+    # Method to move a "document" layout conversation to the "message" layout
+    # The message documents are upserted (same ids), so it can run again if it's interrupted or the header changed meanwhile
+    async def _migrate_document(self, header:dict):
+        conversation_id = header['id']
+        legacy_items = [item.dict() for item in self._get_document_items(header)]
+        try:
+            message_items = [item.dict() for item in await self._query_messages(conversation_id)]
+            items = {item['MessageId']: item for item in legacy_items + message_items}
+            await self._write_message_conversation(conversation_id, list(items.values()), header.get('TotalTokens', 0),
+                                                   etag=header.get('_etag'))
+            with self._stats_lock:
+                self._migrations += 1
+        except CosmosHttpResponseError as e:
+            # Header changed by another request: the next save tries again
+            print(f"Erro ao migrar a conversa {conversation_id}: {str(e)}")
+
+    # Method to move a conversation to the "message" layout (e.g. from a migration job); returns False if there's nothing to move
+    async def migrate_conversation(self, conversation_id:str) -> bool:
+        try:
+            header = await self._container.read_item(item=conversation_id, partition_key=conversation_id,
+                                                     response_hook=self._track_request)
+        except CosmosResourceNotFoundError:
+            return False
+        if not header.get('Items'):
+            return False
+        await self._migrate_document(header)
+        return True
+
+    # Method to get the history statistics
+    def get_stats(self) -> dict:
+        with self._stats_lock:
+            return {
+                "layout": self.layout,
+                "operations": self._operations,
+                "request_charge": round(self._request_charge, 2),
+                "migrations": self._migrations
+            }
+
+
+    # Method to format the conversation history of the GPT model prompts (turns as dicts, oldest first)
+    @staticmethod
+    def format_history(turns:list) -> str:
+        items = []
+        if len(turns) > 0:
+            items.append("\n# Conversation History:\n")
+            for entry in turns:
+                items.append(f"- User:\n{entry['Query']}\n")
+                items.append(f"- You:\n{entry['Reply']}\n")
+            items.append("\n# End of conversation history.")
 
         return ("\n".join(items)).strip()
 
-# Method to run CosmosDB async functions 
+    # Method to get the conversation history from CosmosDB (or from the recent turns cache)
+    async def get_last_conversation_items(self, conversation_id):
+        if not conversation_id:
+            return ""
+        if self._recent_turns_cache is not None:
+            history = self._recent_turns_cache.get(conversation_id)
+            if history is not None:
+                return history
+        try:
+            recent_items = await self._read_recent_items(conversation_id, self.recent_turns)
+        except Exception as e:
+            print(f"Erro ao processar a conversa: {str(e)}")
+            return ""
+        if self._recent_turns_cache is not None:
+            self._recent_turns_cache.put(conversation_id, recent_items)
+        return self.format_history([item.dict() for item in recent_items])
+
+    # Method to get the last items of a conversation
+    async def get_recent_items(self, conversation_id:str, max_items:int) -> list:
+        try:
+            return await self._read_recent_items(conversation_id, max_items)
+        except Exception as e:
+            print(f"Erro ao processar a conversa: {str(e)}")
+            return []
+
+    # Method to read the last items of a conversation (only the last message documents in the "message" layout), with
+    # the items of the write-behind journal not saved in CosmosDB yet; errors are raised
+    async def _read_recent_items(self, conversation_id:str, max_items:int) -> list:
+        if max_items <= 0:
+            return []
+        if self.layout == MESSAGE_LAYOUT:
+            recent_items = await self._query_messages(conversation_id, max_items)
+            if len(recent_items) < max_items:
+                # Possibly a conversation not moved to the "message" layout yet
+                try:
+                    header = await self._container.read_item(item=conversation_id, partition_key=conversation_id,
+                                                             response_hook=self._track_request)
+                except CosmosResourceNotFoundError:
+                    header = {}
+                recent_items = (self._get_document_items(header) + recent_items)[-max_items:]
+        else:
+            try:
+                conversation_response = await self._container.read_item(item=conversation_id, partition_key=conversation_id,
+                                                                        response_hook=self._track_request)
+            except CosmosResourceNotFoundError:
+                conversation_response = {}
+            recent_items = self._get_document_items(conversation_response, max_items)
+
+        # Add the items of the write-behind journal not saved in CosmosDB yet
+        pending_items = self._get_pending_items(conversation_id, recent_items)
+        if pending_items:
+            recent_items = sorted(recent_items + pending_items, key=lambda item: item.Date)[-max_items:]
+        return recent_items
+
+# Method to create a CosmosDB async client (on the CosmosDB event loop, where its connections are used)
+async def _create_cosmos_client(url, credential):
+    return CosmosClient(url, credential)
+
+# Method to close the CosmosDB clients and stop the CosmosDB event loop (at exit)
+def _close_cosmosdb_loop():
+    for cosmos_client in list(_cosmos_clients.values()):
+        try:
+            asyncio.run_coroutine_threadsafe(cosmos_client.close(), _cosmosdb_loop).result(timeout=5)
+        except Exception as err:
+            print(f"Could not close the CosmosDB client: {err}")
+    _cosmosdb_loop.call_soon_threadsafe(_cosmosdb_loop.stop)
+
+# Method to get the CosmosDB event loop (started on the first call)
+def get_cosmosdb_loop():
+    global _cosmosdb_loop, _cosmosdb_loop_thread
+    with _cosmosdb_loop_lock:
+        if _cosmosdb_loop is None:
+            _cosmosdb_loop = asyncio.new_event_loop()
+            _cosmosdb_loop_thread = threading.Thread(target=_cosmosdb_loop.run_forever, name="cosmosdb-loop", daemon=True)
+            _cosmosdb_loop_thread.start()
+            atexit.register(_close_cosmosdb_loop)
+    return _cosmosdb_loop
+
+# Method to run CosmosDB async functions (blocks the calling thread until the function finishes on the CosmosDB event loop)
 def await_cosmosdb_function(function):
     try:
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        function_result = loop.run_until_complete(function)
-        loop.close()
-        return function_result
+        if threading.current_thread() is _cosmosdb_loop_thread:
+            function.close()
+            raise RuntimeError("await_cosmosdb_function can't be called from the CosmosDB event loop, await the function instead")
+        future = asyncio.run_coroutine_threadsafe(function, get_cosmosdb_loop())
+        try:
+            return future.result(timeout=float(os.environ.get("COSMOSDB_TIMEOUT_SECONDS", "30")))
+        except TimeoutError:
+            future.cancel()
+            raise
     except Exception as err:
-        print(f"An error occurred: {err}")
\ No newline at end of file
+        print(f"An error occurred: {err}")
+
+# Method to await CosmosDB async functions from another event loop (e.g. an ASGI server loop)
+async def run_cosmosdb_function(function):
+    return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(function, get_cosmosdb_loop()))
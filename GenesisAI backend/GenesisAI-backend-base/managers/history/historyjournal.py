@@ -0,0 +1,346 @@
+import threading
+import managers
+import sqlite3
+import asyncio
+import atexit
+import socket
+import json
+import time
+import os
+
+
+# HistoryJournal class
+# Write-behind persistence of the conversation items: generate appends the finished turn to a local SQLite journal and
+# returns, and a background thread saves the journal items in CosmosDB
+# - the journal file is shared by the gunicorn workers; each worker claims the items it saves for a lease, so the items
+#   of a stopped process are saved by the next one (replay)
+# - the items of the same conversation are saved together (a single CosmosDB write), different conversations at the same time
+# - failed saves are retried with exponential backoff; the items stay in the journal until they are saved, and the newer
+#   items of the conversation wait for them (the items are always saved in the order of the turns)
+# - the history reads add the items not saved yet (get_pending_items), so the conversation context is always complete
+# - the last message id of each conversation is kept for a day (get_head), so the workers can check their cached turns
+# - the feedbacks are journaled too (only the last feedback of each message is kept) and saved with patch operations
+#   after the items of their conversation, all the feedbacks of a conversation at the same time
+class HistoryJournal:
+
+    def __init__(self, history_manager, path:str, flush_interval_seconds:float = 0.2, batch_size:int = 100,
+                 lease_seconds:float = 60, max_backoff_seconds:float = 300):
+        self._history_manager = history_manager
+        self.path = path
+        self._flush_interval_seconds = flush_interval_seconds
+        self._batch_size = batch_size
+        self._lease_seconds = lease_seconds
+        self._max_backoff_seconds = max_backoff_seconds
+        self._owner = f"{socket.gethostname()}:{os.getpid()}"
+
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, timeout=10, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute("""
+            CREATE TABLE IF NOT EXISTS history_journal (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                conversation_id TEXT NOT NULL,
+                item TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL DEFAULT 0,
+                claimed_by TEXT,
+                claimed_at REAL
+            )""")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS history_journal_conversation ON history_journal (conversation_id, id)")
+        self._connection.execute("""
+            CREATE TABLE IF NOT EXISTS conversation_heads (
+                conversation_id TEXT PRIMARY KEY,
+                message_id TEXT NOT NULL,
+                updated_at REAL NOT NULL
+            )""")
+        self._connection.execute("""
+            CREATE TABLE IF NOT EXISTS history_feedback (
+                conversation_id TEXT NOT NULL,
+                message_id TEXT NOT NULL,
+                feedback TEXT NOT NULL,
+                revision INTEGER NOT NULL DEFAULT 0,
+                created_at REAL NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL DEFAULT 0,
+                claimed_by TEXT,
+                claimed_at REAL,
+                PRIMARY KEY (conversation_id, message_id)
+            )""")
+        self._heads_pruned_at = 0.0
+
+        self._stats = {"appended": 0, "saved": 0, "coalesced": 0, "retries": 0, "replayed": 0,
+                       "feedback_appended": 0, "feedback_saved": 0, "feedback_coalesced": 0, "feedback_not_found": 0}
+        self._wake_up = threading.Event()
+        self._stopping = threading.Event()
+
+        self.release_stale_claims()
+        self._worker = threading.Thread(target=self._run, name="history-journal", daemon=True)
+        self._worker.start()
+        atexit.register(self.shutdown)
+
+    # Method to run a journal statement (a single connection for all the threads)
+    def _execute(self, statement:str, parameters:tuple = ()) -> list:
+        with self._lock:
+            return self._connection.execute(statement, parameters).fetchall()
+
+    # Method to release the claims of the processes of this host that are no longer running (replayed at startup)
+    def release_stale_claims(self):
+        host = socket.gethostname()
+        released = 0
+        owners = self._execute("""SELECT claimed_by FROM history_journal WHERE claimed_by IS NOT NULL
+                                  UNION SELECT claimed_by FROM history_feedback WHERE claimed_by IS NOT NULL""")
+        for (owner,) in owners:
+            owner_host, _, owner_pid = owner.rpartition(":")
+            if owner_host != host or owner == self._owner:
+                continue
+            try:
+                os.kill(int(owner_pid), 0)
+                continue
+            except ProcessLookupError:
+                pass
+            except (PermissionError, ValueError):
+                continue
+            with self._lock:
+                for table in ("history_journal", "history_feedback"):
+                    released += self._connection.execute(
+                        f"UPDATE {table} SET claimed_by = NULL, claimed_at = NULL WHERE claimed_by = ?", (owner,)).rowcount
+        if released:
+            self._stats["replayed"] += released
+            print(f"History journal: {released} items of stopped processes will be saved again")
+
+    # Method to add a finished turn to the journal (saved in CosmosDB in the background)
+    def append(self, conversation_id:str, conversation_item:dict):
+        now = time.time()
+        with self._lock:
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                self._connection.execute("INSERT INTO history_journal (conversation_id, item, created_at) VALUES (?, ?, ?)",
+                                         (conversation_id, json.dumps(conversation_item), now))
+                self._connection.execute("INSERT OR REPLACE INTO conversation_heads (conversation_id, message_id, updated_at) VALUES (?, ?, ?)",
+                                         (conversation_id, conversation_item["MessageId"], now))
+                self._connection.execute("COMMIT")
+            except BaseException:
+                self._connection.execute("ROLLBACK")
+                raise
+            self._stats["appended"] += 1
+        self._wake_up.set()
+
+    # Method to add a feedback to the journal (replaces the feedback of the same message not saved yet)
+    def append_feedback(self, conversation_id:str, message_id:str, feedback:str):
+        with self._lock:
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                coalesced = self._connection.execute("SELECT 1 FROM history_feedback WHERE conversation_id = ? AND message_id = ?",
+                                                     (conversation_id, message_id)).fetchone() is not None
+                # A new revision, so a feedback being saved by the worker doesn't remove this one when it's saved
+                self._connection.execute("""
+                    INSERT INTO history_feedback (conversation_id, message_id, feedback, created_at) VALUES (?, ?, ?, ?)
+                    ON CONFLICT (conversation_id, message_id) DO UPDATE SET
+                        feedback = excluded.feedback, revision = revision + 1, attempts = 0, next_attempt_at = 0,
+                        claimed_by = NULL, claimed_at = NULL""",
+                    (conversation_id, message_id, feedback, time.time()))
+                self._connection.execute("COMMIT")
+            except BaseException:
+                self._connection.execute("ROLLBACK")
+                raise
+            self._stats["feedback_appended"] += 1
+            self._stats["feedback_coalesced"] += coalesced
+        self._wake_up.set()
+
+    # Method to get the last message id of a conversation saved by any worker in the last day (None if unknown)
+    def get_head(self, conversation_id:str):
+        rows = self._execute("SELECT message_id FROM conversation_heads WHERE conversation_id = ?", (conversation_id,))
+        return rows[0][0] if rows else None
+
+    # Method to remove the last message ids older than a day (at most once per hour)
+    def _prune_heads(self):
+        now = time.time()
+        if now - self._heads_pruned_at < 3600:
+            return
+        self._heads_pruned_at = now
+        self._execute("DELETE FROM conversation_heads WHERE updated_at < ?", (now - 86400,))
+
+    # Method to get the journal items of a conversation (not saved in CosmosDB yet), oldest first
+    def get_pending_items(self, conversation_id:str) -> list:
+        rows = self._execute("SELECT item FROM history_journal WHERE conversation_id = ? ORDER BY id", (conversation_id,))
+        return [json.loads(item) for (item,) in rows]
+
+    # Method to claim the items and feedbacks to save: the due ones not claimed by another process (or whose lease expired)
+    # The items of a conversation are claimed only after its older items (not while one of them waits for a retry or is
+    # saved by another process), so the turns are appended in order
+    # The feedbacks of a conversation are claimed only with all its items not saved yet (they may be their feedbacks)
+    def _claim(self) -> tuple:
+        now = time.time()
+        with self._lock:
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                self._connection.execute("""
+                    UPDATE history_journal SET claimed_by = ?, claimed_at = ?
+                    WHERE id IN (
+                        SELECT id FROM history_journal
+                        WHERE next_attempt_at <= ? AND (claimed_by IS NULL OR claimed_by = ? OR claimed_at < ?)
+                        AND NOT EXISTS (SELECT 1 FROM history_journal AS older
+                                        WHERE older.conversation_id = history_journal.conversation_id
+                                        AND older.id < history_journal.id
+                                        AND (older.next_attempt_at > ?
+                                             OR (older.claimed_by IS NOT NULL AND older.claimed_by != ? AND older.claimed_at >= ?)))
+                        ORDER BY id LIMIT ?)""",
+                    (self._owner, now, now, self._owner, now - self._lease_seconds,
+                     now, self._owner, now - self._lease_seconds, self._batch_size))
+                self._connection.execute("""
+                    UPDATE history_feedback SET claimed_by = ?, claimed_at = ?
+                    WHERE rowid IN (
+                        SELECT rowid FROM history_feedback AS feedback
+                        WHERE next_attempt_at <= ? AND (claimed_by IS NULL OR claimed_by = ? OR claimed_at < ?)
+                        AND NOT EXISTS (SELECT 1 FROM history_journal AS journal
+                                        WHERE journal.conversation_id = feedback.conversation_id
+                                        AND (journal.claimed_by IS NULL OR journal.claimed_by != ?))
+                        ORDER BY created_at LIMIT ?)""",
+                    (self._owner, now, now, self._owner, now - self._lease_seconds, self._owner, self._batch_size))
+                rows = self._connection.execute(
+                    "SELECT id, conversation_id, item, attempts FROM history_journal WHERE claimed_by = ? ORDER BY id",
+                    (self._owner,)).fetchall()
+                feedback_rows = self._connection.execute(
+                    "SELECT conversation_id, message_id, feedback, revision, attempts FROM history_feedback WHERE claimed_by = ?",
+                    (self._owner,)).fetchall()
+                self._connection.execute("COMMIT")
+            except BaseException:
+                self._connection.execute("ROLLBACK")
+                raise
+        return rows, feedback_rows
+
+    # Method to save the claimed items and then the claimed feedbacks of a conversation; returns the items error (or None)
+    # and the feedbacks result (message ids not found, or the error)
+    async def _save_conversation(self, conversation_id:str, rows:list, feedback_rows:list) -> tuple:
+        try:
+            if rows:
+                await self._history_manager.save_conversation_items(conversation_id, [json.loads(row[2]) for row in rows])
+        except Exception as e:
+            return e, e
+        if not feedback_rows:
+            return None, []
+        try:
+            return None, await self._history_manager.save_feedbacks(conversation_id, {row[1]: row[2] for row in feedback_rows})
+        except Exception as e:
+            return None, e
+
+    # Method to save the claimed items and feedbacks in CosmosDB, one write per conversation (and a patch for its
+    # feedbacks), all the conversations at the same time
+    async def _save_conversations(self, conversations:dict, feedbacks:dict) -> dict:
+        conversation_ids = list(conversations.keys() | feedbacks.keys())
+        results = await asyncio.gather(*[
+            self._save_conversation(conversation_id, conversations.get(conversation_id, []), feedbacks.get(conversation_id, []))
+            for conversation_id in conversation_ids])
+        return dict(zip(conversation_ids, results))
+
+    # Method to get the next attempt time of a failed save (exponential backoff)
+    def _get_retry(self, attempts:int) -> float:
+        return time.time() + min(self._max_backoff_seconds, self._flush_interval_seconds * 2 ** attempts)
+
+    # Method to save a batch of journal items and feedbacks; returns the number of items and feedbacks claimed
+    def flush(self) -> int:
+        rows, feedback_rows = self._claim()
+        if not rows and not feedback_rows:
+            return 0
+
+        conversations = {}
+        for row in rows:
+            conversations.setdefault(row[1], []).append(row)
+        feedbacks = {}
+        for feedback_row in feedback_rows:
+            feedbacks.setdefault(feedback_row[0], []).append(feedback_row)
+        results = managers.await_cosmosdb_function(self._save_conversations(conversations, feedbacks))
+        if results is None:
+            timeout_error = TimeoutError("CosmosDB timeout")
+            results = {conversation_id: (timeout_error, timeout_error) for conversation_id in conversations.keys() | feedbacks.keys()}
+
+        for conversation_id, (items_result, feedbacks_result) in results.items():
+            if conversation_id in conversations:
+                self._finish_items(conversation_id, conversations[conversation_id], items_result)
+            if conversation_id in feedbacks:
+                self._finish_feedbacks(conversation_id, feedbacks[conversation_id], feedbacks_result)
+        return len(rows) + len(feedback_rows)
+
+    # Method to remove the saved items of a conversation from the journal, or schedule them again after an error
+    def _finish_items(self, conversation_id:str, rows:list, error):
+        row_ids = [row[0] for row in rows]
+        placeholders = ",".join("?" * len(row_ids))
+        if error is not None:
+            # Saved again later (the same items are skipped if they were saved before the error)
+            attempts = max(row[3] for row in rows) + 1
+            self._execute(f"""UPDATE history_journal SET attempts = ?, next_attempt_at = ?, claimed_by = NULL, claimed_at = NULL
+                              WHERE id IN ({placeholders})""", (attempts, self._get_retry(attempts), *row_ids))
+            with self._lock:
+                self._stats["retries"] += 1
+            print(f"History journal: could not save the conversation {conversation_id} (attempt {attempts}): {error}")
+        else:
+            self._execute(f"DELETE FROM history_journal WHERE id IN ({placeholders})", tuple(row_ids))
+            with self._lock:
+                self._stats["saved"] += len(row_ids)
+                self._stats["coalesced"] += len(row_ids) - 1
+
+    # Method to remove the saved feedbacks of a conversation from the journal (only if they weren't replaced meanwhile),
+    # or schedule them again after an error; the feedbacks of messages not found are removed
+    def _finish_feedbacks(self, conversation_id:str, feedback_rows:list, result):
+        if isinstance(result, BaseException):
+            attempts = max(feedback_row[4] for feedback_row in feedback_rows) + 1
+            for feedback_row in feedback_rows:
+                self._execute("""UPDATE history_feedback SET attempts = ?, next_attempt_at = ?, claimed_by = NULL, claimed_at = NULL
+                                 WHERE conversation_id = ? AND message_id = ? AND revision = ?""",
+                              (attempts, self._get_retry(attempts), conversation_id, feedback_row[1], feedback_row[3]))
+            with self._lock:
+                self._stats["retries"] += 1
+            print(f"History journal: could not save the feedbacks of the conversation {conversation_id} (attempt {attempts}): {result}")
+            return
+        for feedback_row in feedback_rows:
+            self._execute("DELETE FROM history_feedback WHERE conversation_id = ? AND message_id = ? AND revision = ?",
+                          (conversation_id, feedback_row[1], feedback_row[3]))
+        if result:
+            print(f"History journal: messages of the conversation {conversation_id} not found for their feedback: {result}")
+        with self._lock:
+            self._stats["feedback_saved"] += len(feedback_rows) - len(result)
+            self._stats["feedback_not_found"] += len(result)
+
+    # Method to run the journal worker: save the new items after a short batching delay, and poll for the items of the
+    # other processes and the retries
+    def _run(self):
+        while not self._stopping.is_set():
+            woken_up = self._wake_up.wait(timeout=1)
+            if self._stopping.is_set():
+                break
+            if woken_up:
+                # Batch the turns finished at about the same time
+                self._stopping.wait(self._flush_interval_seconds)
+                self._wake_up.clear()
+            try:
+                while self.flush() >= self._batch_size and not self._stopping.is_set():
+                    pass
+                self._prune_heads()
+            except Exception as e:
+                print(f"History journal error: {e}")
+
+    # Method to stop the journal worker; the items not saved yet stay in the journal for the next process
+    def shutdown(self, timeout_seconds:float = 5):
+        if self._stopping.is_set():
+            return
+        self._stopping.set()
+        self._wake_up.set()
+        self._worker.join(timeout=timeout_seconds)
+        try:
+            for table in ("history_journal", "history_feedback"):
+                self._execute(f"UPDATE {table} SET claimed_by = NULL, claimed_at = NULL WHERE claimed_by = ?", (self._owner,))
+        except Exception as e:
+            print(f"History journal error: {e}")
+
+    # Method to get the journal statistics
+    def get_stats(self) -> dict:
+        pending, oldest = self._execute("SELECT COUNT(*), MIN(created_at) FROM history_journal")[0]
+        (pending_feedbacks,) = self._execute("SELECT COUNT(*) FROM history_feedback")[0]
+        with self._lock:
+            stats = dict(self._stats)
+        stats["pending"] = pending
+        stats["pending_feedbacks"] = pending_feedbacks
+        stats["oldest_pending_seconds"] = round(time.time() - oldest, 1) if oldest else 0.0
+        return stats
@@ -1,20 +1,60 @@
 from azure.keyvault.secrets import SecretClient
 from azure.identity import DefaultAzureCredential
+from managers.keyvault.secretcache import SecretCache
+import threading
 import os
 from dotenv import load_dotenv
 
 load_dotenv()
 
+# Key Vault client and secret cache of each vault, shared by all the KeyvaultManager instances of the process
+_keyvault_clients = {}
+_secret_caches = {}
+_keyvault_lock = threading.Lock()
+
+
+# Method to parse the per-secret TTLs ("NAME=seconds,NAME=seconds")
+def parse_secret_ttls(secret_ttls:str) -> dict:
+    ttls = {}
+    for item in secret_ttls.split(","):
+        if "=" in item:
+            name, seconds = item.split("=", 1)
+            ttls[name.strip()] = float(seconds)
+    return ttls
+
+
 # KeyvaultManager class
 class KeyvaultManager:
 
     def __init__(self):
 
         #Set the keyvault parameters and client
-        keyvault_credential = DefaultAzureCredential()
         keyvault_name = os.environ['KEYVAULT_NAME']
         KVUri = f"https://{keyvault_name}.vault.azure.net"
-        self.azure_keyvault_client = SecretClient(vault_url=KVUri, credential=keyvault_credential)
+
+        with _keyvault_lock:
+            if KVUri not in _keyvault_clients:
+                keyvault_credential = DefaultAzureCredential()
+                _keyvault_clients[KVUri] = SecretClient(vault_url=KVUri, credential=keyvault_credential)
+                _secret_caches[KVUri] = SecretCache(
+                    _keyvault_clients[KVUri],
+                    default_ttl_seconds=float(os.environ.get("KEYVAULT_SECRET_TTL_SECONDS", "3600")),
+                    secret_ttls=parse_secret_ttls(os.environ.get("KEYVAULT_SECRET_TTLS", "")),
+                    refresh_ahead_seconds=float(os.environ.get("KEYVAULT_REFRESH_AHEAD_SECONDS", "300")),
+                    max_stale_seconds=float(os.environ.get("KEYVAULT_MAX_STALE_SECONDS", "86400")))
+                # The first instance of the process fetches the boot-time secrets in parallel
+                _secret_caches[KVUri].prefetch(os.environ.get("KEYVAULT_PREFETCH_SECRETS", "").split(","))
+
+        self.azure_keyvault_client = _keyvault_clients[KVUri]
+        self.secret_cache = _secret_caches[KVUri]
 
     def get_azure_keyvault_client(self) -> SecretClient:
-        return self.azure_keyvault_client
\ No newline at end of file
+        return self.azure_keyvault_client
+
+    # Method to get a secret value (cached)
+    def get_secret(self, name:str) -> str:
+        return self.secret_cache.get(name)
+
+    # Method to refresh a secret value on the next get (e.g. after an authentication error)
+    def expire_secret(self, name:str):
+        self.secret_cache.expire(name)
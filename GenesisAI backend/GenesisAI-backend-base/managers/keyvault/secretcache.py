@@ -0,0 +1,135 @@
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+
+
+# SecretCache class
+# Key Vault secret values cached for a TTL (per secret), refreshed in the background shortly before they expire
+# After the TTL the old value is still returned while a background refresh runs (stale-while-revalidate), so a slow
+# Key Vault never blocks a request; only values fetched more than max_stale_seconds ago are fetched again before
+# returning (if the Key Vault is still unavailable then, the error is raised instead of serving the old value)
+class SecretCache:
+
+    def __init__(self, secret_client, default_ttl_seconds:float = 3600, secret_ttls:dict = None,
+                 refresh_ahead_seconds:float = 300, max_stale_seconds:float = 86400, retry_seconds:float = 30,
+                 max_workers:int = 8):
+        self._secret_client = secret_client
+        self._default_ttl_seconds = default_ttl_seconds
+        self._secret_ttls = secret_ttls or {}
+        self._refresh_ahead_seconds = refresh_ahead_seconds
+        self._max_stale_seconds = max_stale_seconds
+        self._retry_seconds = retry_seconds
+        self._lock = threading.Lock()
+        # name -> (value, fetch time, expiry time)
+        self._entries = {}
+        # Locks of the secrets being fetched, so concurrent misses of the same secret make a single Key Vault call
+        self._fetch_locks = {}
+        self._refreshing = set()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="keyvault")
+        self._hits = 0
+        self._fetches = 0
+        self._stale_hits = 0
+        self._errors = 0
+
+    # Method to get the TTL of a secret
+    def _get_ttl(self, name:str) -> float:
+        return self._secret_ttls.get(name, self._default_ttl_seconds)
+
+    # Method to fetch a secret from the Key Vault and cache it
+    def _fetch(self, name:str) -> str:
+        value = self._secret_client.get_secret(name).value
+        now = time.monotonic()
+        with self._lock:
+            self._entries[name] = (value, now, now + self._get_ttl(name))
+            self._fetches += 1
+        return value
+
+    # Method to fetch a secret not cached yet (or too old), once for all the threads waiting for it
+    def _fetch_once(self, name:str) -> str:
+        with self._lock:
+            fetch_lock = self._fetch_locks.setdefault(name, threading.Lock())
+        with fetch_lock:
+            entry = self._entries.get(name)
+            if entry is not None and time.monotonic() - entry[1] < self._max_stale_seconds:
+                return entry[0]
+            try:
+                return self._fetch(name)
+            except Exception as e:
+                # Not cached, or too old to be used
+                if entry is not None:
+                    self._on_refresh_error(name, entry, e)
+                raise
+
+    # Method to refresh a secret in the background (at most one refresh per secret at a time)
+    def _refresh_in_background(self, name:str):
+        with self._lock:
+            if name in self._refreshing:
+                return
+            self._refreshing.add(name)
+
+        def refresh():
+            try:
+                self._fetch(name)
+            except Exception as e:
+                self._on_refresh_error(name, self._entries.get(name), e)
+            finally:
+                with self._lock:
+                    self._refreshing.discard(name)
+
+        self._executor.submit(refresh)
+
+    # Method to keep a secret value after a failed refresh, and try again after retry_seconds (the fetch time isn't
+    # changed, so the value still gets too old after max_stale_seconds)
+    def _on_refresh_error(self, name:str, entry, error):
+        print(f"Could not refresh the Key Vault secret {name}: {error}")
+        with self._lock:
+            self._errors += 1
+            if entry is not None:
+                self._entries[name] = (entry[0], entry[1], time.monotonic() + self._retry_seconds)
+
+    # Method to get a secret value
+    def get(self, name:str) -> str:
+        entry = self._entries.get(name)
+        if entry is None:
+            return self._fetch_once(name)
+
+        now = time.monotonic()
+        value, fetch_time, expiry_time = entry
+        if now - fetch_time >= self._max_stale_seconds:
+            return self._fetch_once(name)
+
+        with self._lock:
+            if now >= expiry_time:
+                self._stale_hits += 1
+            else:
+                self._hits += 1
+        if now >= expiry_time - self._refresh_ahead_seconds:
+            self._refresh_in_background(name)
+        return value
+
+    # Method to fetch several secrets at the same time (e.g. at boot); errors are only logged
+    def prefetch(self, names):
+        names = [name for name in dict.fromkeys(names) if name and name not in self._entries]
+        for name, future in [(name, self._executor.submit(self._fetch_once, name)) for name in names]:
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Could not prefetch the Key Vault secret {name}: {e}")
+
+    # Method to mark a secret as expired, so it's refreshed on the next get (e.g. after an authentication error)
+    def expire(self, name:str):
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is not None:
+                self._entries[name] = (entry[0], entry[1], time.monotonic() - 1)
+
+    # Method to get the cache statistics
+    def get_stats(self) -> dict:
+        with self._lock:
+            return {
+                "secrets": len(self._entries),
+                "hits": self._hits,
+                "stale_hits": self._stale_hits,
+                "keyvault_fetches": self._fetches,
+                "refresh_errors": self._errors
+            }
@@ -0,0 +1,269 @@
+from langchain_core.embeddings import Embeddings
+from concurrent.futures import Future
+import managers
+import numpy as np
+import portalocker
+import threading
+import hashlib
+import time
+import os
+
+# Maximum number of hash index slots checked for a key
+MAX_PROBES = 64
+
+
+# DiskEmbeddingStore class
+# Embeddings stored in memory-mapped float32 arrays, shared by all the workers and kept across restarts
+# Files: vectors.f32 (capacity x dimensions), keys.u64 (key of each row), index.u64 (open addressing hash index
+# of key -> row) and state.u64 (next row). Rows are reused in a ring when the store is full.
+class DiskEmbeddingStore:
+
+    def __init__(self, folder:str, capacity:int = 100000):
+        self.folder = folder
+        self.capacity = capacity
+        self.index_size = 1 << (2 * capacity - 1).bit_length()
+        self._vectors = None
+        self._keys = None
+        self._index = None
+        self._state = None
+        self._lock = threading.Lock()
+        os.makedirs(folder, exist_ok=True)
+        self._lock_path = os.path.join(folder, "lock")
+
+        # Open the files if they already exist (the dimensions are known after the first vector)
+        if os.path.exists(os.path.join(folder, "state.u64")):
+            state = np.memmap(os.path.join(folder, "state.u64"), dtype=np.uint64, mode="r", shape=(3,))
+            if int(state[1]) and int(state[2]) == self.capacity:
+                self._open(int(state[1]))
+
+    # Method to open (or create) the memory-mapped files for vectors with the given dimensions
+    def _open(self, dimensions:int):
+        def memmap(name, dtype, shape):
+            path = os.path.join(self.folder, name)
+            mode = "r+" if os.path.exists(path) and os.path.getsize(path) == np.dtype(dtype).itemsize * int(np.prod(shape)) else "w+"
+            return np.memmap(path, dtype=dtype, mode=mode, shape=shape)
+
+        with portalocker.Lock(self._lock_path, timeout=10):
+            self._state = memmap("state.u64", np.uint64, (3,))
+            # A store with other dimensions or capacity (e.g. other embeddings model) is started again
+            if int(self._state[1]) not in (0, dimensions) or int(self._state[2]) not in (0, self.capacity):
+                for name in ("vectors.f32", "keys.u64", "index.u64"):
+                    if os.path.exists(os.path.join(self.folder, name)):
+                        os.remove(os.path.join(self.folder, name))
+                self._state[:] = 0
+            self._vectors = memmap("vectors.f32", np.float32, (self.capacity, dimensions))
+            self._keys = memmap("keys.u64", np.uint64, (self.capacity,))
+            self._index = memmap("index.u64", np.uint64, (self.index_size, 2))
+            self._state[1] = dimensions
+            self._state[2] = self.capacity
+            self._state.flush()
+
+    # Method to get the hash index slots of a key
+    def _slots(self, key:int):
+        for probe in range(MAX_PROBES):
+            yield (key + probe) & (self.index_size - 1)
+
+    # Method to get a stored vector (None on a miss)
+    def get(self, key:int):
+        if self._index is None:
+            return None
+        for slot in self._slots(key):
+            slot_key, slot_row = int(self._index[slot, 0]), int(self._index[slot, 1])
+            if slot_key == 0:
+                return None
+            if slot_key == key:
+                row = slot_row - 1
+                # The row may have been reused for another key, or be in the middle of a write
+                if int(self._keys[row]) != key:
+                    return None
+                vector = np.array(self._vectors[row])
+                return vector if int(self._keys[row]) == key else None
+        return None
+
+    # Method to store a vector
+    def set(self, key:int, vector:np.ndarray):
+        with self._lock:
+            if self._index is None:
+                self._open(len(vector))
+            if len(vector) != self._vectors.shape[1]:
+                return
+
+            with portalocker.Lock(self._lock_path, timeout=10):
+                row = int(self._state[0]) % self.capacity
+                self._state[0] = int(self._state[0]) + 1
+
+                # Clear the row key first, so readers don't take the new vector for the old key
+                self._keys[row] = 0
+                self._vectors[row] = vector
+                self._keys[row] = key
+
+                # Use the first empty, same key or stale slot (otherwise the first slot is overwritten)
+                target_slot = None
+                for slot in self._slots(key):
+                    slot_key, slot_row = int(self._index[slot, 0]), int(self._index[slot, 1])
+                    if slot_key == 0 or slot_key == key or int(self._keys[slot_row - 1]) != slot_key:
+                        target_slot = slot
+                        break
+                if target_slot is None:
+                    target_slot = key & (self.index_size - 1)
+                self._index[target_slot] = (key, row + 1)
+
+
+# CachedEmbeddings class
+# Wraps the Azure OpenAI embeddings with an in-memory LRU cache, an optional on-disk cache and batching of misses
+class CachedEmbeddings(Embeddings):
+
+    def __init__(self, embeddings, max_entries:int = 10000, disk_folder:str = None, disk_capacity:int = 100000,
+                 batch_window_seconds:float = 0.002, max_batch_size:int = 16):
+        self._embeddings = embeddings
+        self._memory_cache = managers.LruTtlCache(max_entries=max_entries, ttl_seconds=float("inf"))
+        self._batch_window_seconds = batch_window_seconds
+        self._max_batch_size = max_batch_size
+
+        # On-disk cache, one folder per embeddings deployment
+        self._disk_store = None
+        if disk_folder:
+            try:
+                self._disk_store = DiskEmbeddingStore(os.path.join(disk_folder, str(self.deployment)), capacity=disk_capacity)
+            except Exception as e:
+                print(f"On-disk embeddings cache disabled: {e}")
+
+        # Misses waiting for the next embeddings call, and the futures of the texts being embedded
+        self._pending_lock = threading.Lock()
+        self._pending_texts = []
+        self._inflight: dict[str, Future] = {}
+        self._batch_running = False
+
+        # Statistics
+        self._stats_lock = threading.Lock()
+        self._memory_hits = 0
+        self._disk_hits = 0
+        self._misses = 0
+        self._calls = 0
+        self._coalesced = 0
+        self._miss_seconds = 0.0
+
+    # Name of the wrapped embeddings deployment
+    @property
+    def deployment(self):
+        return getattr(self._embeddings, "deployment", "")
+
+    # Method to get the cache key of a text (64-bit, never 0 since 0 marks empty on-disk slots)
+    def _key(self, text:str) -> int:
+        digest = hashlib.blake2b(text.encode("utf-8"), digest_size=8, person=b"genesisai-embed").digest()
+        return int.from_bytes(digest, "little") or 1
+
+    # Method to embed a query
+    def embed_query(self, text:str) -> list[float]:
+        return self.embed_documents([text])[0]
+
+    # Method to embed a list of texts, from the caches when possible
+    def embed_documents(self, texts:list[str]) -> list[list[float]]:
+        vectors = [None] * len(texts)
+        missing = []
+        for position, text in enumerate(texts):
+            key = self._key(text)
+            vector = self._memory_cache.get(key)
+            if vector is not None:
+                self._count(memory_hits=1)
+            elif self._disk_store is not None and (vector := self._disk_store.get(key)) is not None:
+                self._memory_cache.set(key, vector)
+                self._count(disk_hits=1)
+            else:
+                missing.append(position)
+            vectors[position] = vector
+
+        if missing:
+            for position, vector in zip(missing, self._embed_misses([texts[position] for position in missing])):
+                vectors[position] = vector
+
+        return [vector.tolist() for vector in vectors]
+
+    # Method to embed the cache misses; concurrent misses are embedded together in a single call
+    def _embed_misses(self, texts:list[str]) -> list[np.ndarray]:
+        futures = []
+        leader = False
+        coalesced = 0
+        with self._pending_lock:
+            for text in texts:
+                future = self._inflight.get(text)
+                if future is None:
+                    future = Future()
+                    self._inflight[text] = future
+                    self._pending_texts.append(text)
+                else:
+                    coalesced += 1
+                futures.append(future)
+            if not self._batch_running:
+                self._batch_running = True
+                leader = True
+
+        self._count(coalesced=coalesced)
+
+        # The first thread waits a little for other misses, then embeds all the pending texts
+        if leader:
+            if self._batch_window_seconds:
+                time.sleep(self._batch_window_seconds)
+            self._run_batches()
+
+        return [future.result() for future in futures]
+
+    # Method to embed the pending texts in batches until there are none left
+    def _run_batches(self):
+        while True:
+            with self._pending_lock:
+                batch = self._pending_texts[:self._max_batch_size]
+                del self._pending_texts[:len(batch)]
+                if not batch:
+                    self._batch_running = False
+                    return
+
+            start_time = time.perf_counter()
+            try:
+                batch_vectors = [np.asarray(vector, dtype=np.float32) for vector in self._embeddings.embed_documents(batch)]
+            except Exception as e:
+                with self._pending_lock:
+                    for text in batch:
+                        self._inflight.pop(text).set_exception(e)
+                continue
+            self._count(misses=len(batch), calls=1, miss_seconds=time.perf_counter() - start_time)
+
+            for text, vector in zip(batch, batch_vectors):
+                key = self._key(text)
+                self._memory_cache.set(key, vector)
+                if self._disk_store is not None:
+                    try:
+                        self._disk_store.set(key, vector)
+                    except Exception as e:
+                        print(f"Could not store the embedding on disk: {e}")
+
+            with self._pending_lock:
+                for text, vector in zip(batch, batch_vectors):
+                    self._inflight.pop(text).set_result(vector)
+
+    # Method to update the statistics counters
+    def _count(self, memory_hits=0, disk_hits=0, misses=0, calls=0, coalesced=0, miss_seconds=0.0):
+        with self._stats_lock:
+            self._coalesced += coalesced
+            self._memory_hits += memory_hits
+            self._disk_hits += disk_hits
+            self._misses += misses
+            self._calls += calls
+            self._miss_seconds += miss_seconds
+
+    # Method to get the cache statistics; the saved latency assumes each hit would cost an average embeddings call
+    def get_stats(self) -> dict:
+        with self._stats_lock:
+            hits = self._memory_hits + self._disk_hits
+            lookups = hits + self._misses
+            average_call_seconds = self._miss_seconds / self._calls if self._calls else 0.0
+            return {
+                "memory_hits": self._memory_hits,
+                "disk_hits": self._disk_hits,
+                "misses": self._misses,
+                "coalesced_misses": self._coalesced,
+                "embeddings_calls": self._calls,
+                "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+                "average_call_seconds": round(average_call_seconds, 5),
+                "saved_seconds": round(hits * average_call_seconds, 3)
+            }
@@ -4,6 +4,9 @@ from langchain_openai import AzureOpenAIEmbeddings
 from langchain.retrievers import EnsembleRetriever
 import managers
 import logging
+import tempfile
+import unicodedata
+from datetime import datetime, timezone
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -19,28 +22,33 @@ class StorageKnowledgeManager:
         
         self._logger = logging.getLogger(__name__)
         
-        self.azure_keyvault_client = keyvault_manager.get_azure_keyvault_client()        
-        
         # Azure Open Ai credentials and embedding model; load some environment variables              
-        self.azure_endpoint = self.azure_keyvault_client.get_secret("AZURE-OPENAI-ENDPOINT").value
-        self.azure_openai_api_key = self.azure_keyvault_client.get_secret("AZURE-OPENAI-API-KEY").value
+        self.azure_endpoint = keyvault_manager.get_secret("AZURE-OPENAI-ENDPOINT")
+        self.azure_openai_api_key = keyvault_manager.get_secret("AZURE-OPENAI-API-KEY")
         self.azure_openai_api_version = os.environ["AZURE_OPENAI_VERSION"]
         self.azure_deployment = os.environ['AZURE_OPENAI_EMBEDDINGS_NAME']
         
         #Azure Ai Search credentials; load some environment variables
-        self.vector_store_address = self.azure_keyvault_client.get_secret("AZURE-SEARCH-SERVICE-ENDPOINT").value
-        self.vector_store_password = self.azure_keyvault_client.get_secret("AZURE-SEARCH-API-KEY").value
+        self.vector_store_address = keyvault_manager.get_secret("AZURE-SEARCH-SERVICE-ENDPOINT")
+        self.vector_store_password = keyvault_manager.get_secret("AZURE-SEARCH-API-KEY")
                
         #Azure Ai Search Indexes; load some environment variables
         index_name = os.environ["AZURE_SEARCH_INDEX_NAME"]
+        self.index_name = index_name
         #index_name_hardcoded = os.environ["AZURE_SEARCH_HARDCODED_INDEX_NAME"]                  
         
-        #Azure Open Ai Embeddings instance
-        self.embeddings: AzureOpenAIEmbeddings = AzureOpenAIEmbeddings(
-            azure_deployment=self.azure_deployment,
-            openai_api_version=self.azure_openai_api_version,
-            azure_endpoint=self.azure_endpoint,
-            api_key=self.azure_openai_api_key            
+        #Azure Open Ai Embeddings instance, with in-memory (and optional on-disk) cache of the embeddings
+        self.embeddings: managers.CachedEmbeddings = managers.CachedEmbeddings(
+            AzureOpenAIEmbeddings(
+                azure_deployment=self.azure_deployment,
+                openai_api_version=self.azure_openai_api_version,
+                azure_endpoint=self.azure_endpoint,
+                api_key=self.azure_openai_api_key            
+            ),
+            max_entries=int(os.environ.get("EMBEDDINGS_CACHE_MAX_ENTRIES", "10000")),
+            disk_folder=os.environ.get("EMBEDDINGS_CACHE_DIR") or None,
+            disk_capacity=int(os.environ.get("EMBEDDINGS_CACHE_DISK_CAPACITY", "100000")),
+            batch_window_seconds=float(os.environ.get("EMBEDDINGS_BATCH_WINDOW_MS", "2")) / 1000
         )
 
         #Azure Ai Search index instances
@@ -56,6 +64,18 @@ class StorageKnowledgeManager:
         #                                                 embedding_function=self.embeddings.embed_query,
         #                                                 additional_search_client_options={"retry_total": 4}, 
         #                                                 semantic_configuration_name="semantic-config")
+
+        # Knowledge index version file, shared by all the workers (a new version is set after each reindexing)
+        self.index_version_file = os.environ.get("KNOWLEDGE_INDEX_VERSION_FILE", os.path.join(tempfile.gettempdir(), "genesisai-knowledge-index-version"))
+        self._index_version = ""
+        self._index_version_mtime = None
+
+        # Cache of the knowledge context retrieved for each question (invalidated by a new index version)
+        self.retrieval_cache = None
+        if 'true' in os.environ.get("RETRIEVAL_CACHE", "true").lower():
+            self.retrieval_cache = managers.LruTtlCache(
+                max_entries=int(os.environ.get("RETRIEVAL_CACHE_MAX_ENTRIES", "5000")),
+                ttl_seconds=float(os.environ.get("RETRIEVAL_CACHE_TTL_SECONDS", "3600")))
         
                      
                 
@@ -68,6 +88,51 @@ class StorageKnowledgeManager:
         return main_retriever
         #return ensemble_retriever
         #return [main_retriever,hardcoded_retriever]
-    
-        
-        
+
+    # Get the knowledge index version (used to invalidate the cached answers and retrievals after reindexing)
+    def get_index_version(self):
+        try:
+            index_version_mtime = os.stat(self.index_version_file).st_mtime_ns
+            if index_version_mtime != self._index_version_mtime:
+                with open(self.index_version_file, encoding="utf-8") as index_version_file:
+                    self._index_version = index_version_file.read().strip()
+                self._index_version_mtime = index_version_mtime
+        except FileNotFoundError:
+            self._index_version = ""
+            self._index_version_mtime = None
+
+        return f"{self.index_name}:{os.environ.get('AZURE_SEARCH_INDEX_VERSION', '0')}:{self._index_version}"
+
+    # Set a new knowledge index version for all the workers
+    def bump_index_version(self):
+        index_version = datetime.now(timezone.utc).strftime("%Y%m%d%H%M%S%f")
+        temporary_file = f"{self.index_version_file}.{os.getpid()}"
+        with open(temporary_file, "w", encoding="utf-8") as index_version_file:
+            index_version_file.write(index_version)
+        os.replace(temporary_file, self.index_version_file)
+        return self.get_index_version()
+
+    # Get the retrieval cache key of a question: normalized question, number of documents and index snapshot
+    def get_retrieval_cache_key(self, question, top_n):
+        normalized_question = " ".join(unicodedata.normalize("NFC", question).lower().split())
+        return (normalized_question, str(top_n), self.index_name, self.get_index_version())
+
+    # Get the knowledge context of a question from the retrieval cache, or from the retrieve function on a miss
+    def get_knowledge_context(self, question, top_n, retrieve):
+        if self.retrieval_cache is None:
+            return retrieve()
+
+        key = self.get_retrieval_cache_key(question, top_n)
+        context_string = self.retrieval_cache.get(key)
+        if context_string is None:
+            context_string = retrieve()
+            self.retrieval_cache.set(key, context_string)
+
+        return context_string
+
+    # Purge the cached retrievals after reindexing (a new index version also invalidates them in the other workers)
+    def purge_caches(self):
+        index_version = self.bump_index_version()
+        if self.retrieval_cache is not None:
+            self.retrieval_cache.clear()
+        return index_version
@@ -0,0 +1,77 @@
+import os
+import re
+import unicodedata
+import numpy as np
+
+# Languages known by the identifier (same codes returned by GptModelManager.get_prompt_language)
+# Each language is trained from the data/<language>.txt file shipped with the package
+LANGUAGES = ('pt', 'en')
+
+# Words of the message (letters only, so digits and punctuation don't count as evidence)
+WORDS_REGEX = re.compile(r"[^\W\d_]+")
+
+# Multiplier for the n-gram rolling hash and for the hash buckets (64-bit golden ratio)
+HASH_PRIME = np.uint64(1000003)
+HASH_MIX = np.uint64(0x9E3779B97F4A7C15)
+
+
+# NgramLanguageIdentifier class
+# Identifies portuguese and english messages in-process with character n-gram profiles
+class NgramLanguageIdentifier:
+
+    def __init__(self, max_ngram:int = 4, hash_bits:int = 16, smoothing:float = 0.1):
+        self._max_ngram = max_ngram
+        self._hash_bits = np.uint64(hash_bits)
+        hash_size = 2 ** hash_bits
+
+        # Count the n-grams of each training file
+        data_folder = os.path.join(os.path.dirname(__file__), "data")
+        counts = np.zeros((len(LANGUAGES), hash_size), dtype=np.float64)
+        for index, language in enumerate(LANGUAGES):
+            with open(os.path.join(data_folder, f"{language}.txt"), encoding="utf-8") as training_file:
+                counts[index] = np.bincount(self._ngram_hashes(training_file.read()), minlength=hash_size)
+
+        # Log probability of each n-gram bucket for each language (additive smoothing for unseen n-grams)
+        totals = counts.sum(axis=1, keepdims=True)
+        self._log_probs = np.log((counts + smoothing) / (totals + smoothing * hash_size))
+        self._seen = counts > 0
+
+    # Method to get the hash buckets of all the character n-grams (1 to max_ngram) of a text
+    def _ngram_hashes(self, text:str) -> np.ndarray:
+        words = WORDS_REGEX.findall(unicodedata.normalize("NFC", text).lower())
+        if not words:
+            return np.zeros(0, dtype=np.intp)
+
+        # Code points of the words separated (and surrounded) by a single space
+        padded_text = " " + " ".join(words) + " "
+        code_points = np.frombuffer(padded_text.encode("utf-32-le"), dtype=np.uint32).astype(np.uint64)
+
+        # Rolling hash: the n-gram starting at i is the (n-1)-gram starting at i extended with code_points[i+n-1]
+        hashes = []
+        rolling_hash = np.zeros(len(code_points) + 1, dtype=np.uint64)
+        for ngram_size in range(1, min(self._max_ngram, len(code_points)) + 1):
+            rolling_hash = rolling_hash[:len(code_points) - ngram_size + 1] * HASH_PRIME + code_points[ngram_size - 1:]
+            hashes.append((rolling_hash * HASH_MIX) >> (np.uint64(64) - self._hash_bits))
+
+        return np.concatenate(hashes).astype(np.intp)
+
+    # Method to identify the language of a text
+    # Returns the language code ('pt', 'en' or '' when the text has no words) and the confidence (0 to 1)
+    def identify(self, text:str) -> tuple[str, float]:
+        hashes = self._ngram_hashes(text)
+        if hashes.size == 0:
+            return '', 1.0
+
+        # Log likelihood of the text under each language
+        scores = self._log_probs[:, hashes].sum(axis=1)
+        best = int(np.argmax(scores))
+
+        # Overlapping n-grams of different sizes aren't independent, so the margin is scaled by the number of sizes
+        margin = (scores[best] - np.delete(scores, best).max()) / self._max_ngram
+        posterior = 1.0 / (1.0 + np.exp(-margin))
+
+        # Many n-grams never seen in the training text mean the message is likely in another language
+        unseen_fraction = 1.0 - self._seen[best, hashes].mean()
+        confidence = float(posterior * (1.0 - unseen_fraction) ** 2)
+
+        return LANGUAGES[best], confidence
@@ -0,0 +1,53 @@
+from prometheus_client import CollectorRegistry, Histogram, generate_latest, CONTENT_TYPE_LATEST
+from prometheus_client import multiprocess
+from contextlib import contextmanager
+import time
+import os
+
+# Latency buckets of the request stages, in seconds (from the local classifiers to a full GPT model answer)
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 0.75, 1.0, 1.5, 2.5, 5.0, 7.5, 10.0, 15.0, 30.0, 60.0)
+
+# With gunicorn, PROMETHEUS_MULTIPROC_DIR must be set before this module is imported: each worker writes its samples
+# in that folder and /metrics adds up the samples of all the workers (see gunicorn.conf.py)
+MULTIPROCESS_DIR = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+if MULTIPROCESS_DIR:
+    os.makedirs(MULTIPROCESS_DIR, exist_ok=True)
+
+# Registered once per process (the managers may be created more than once, e.g. by the benchmarks)
+STAGE_SECONDS = Histogram("genesisai_stage_seconds", "Duration of the request stages", ["stage", "outcome"],
+                          buckets=STAGE_BUCKETS)
+
+
+# StageMetrics class
+# Timing spans of the request stages (classifiers, history, retrieval, generation, speech...), exported as Prometheus
+# histograms by stage and outcome ("ok" or "error")
+class StageMetrics:
+
+    # Method to record the duration of a stage
+    def observe(self, stage:str, seconds:float, outcome:str = "ok"):
+        STAGE_SECONDS.labels(stage=stage, outcome=outcome).observe(seconds)
+
+    # Method to time a block of code as a stage; the duration is also added to timings (dict, optional) by stage
+    @contextmanager
+    def span(self, stage:str, timings:dict = None):
+        start_time = time.perf_counter()
+        outcome = "ok"
+        try:
+            yield
+        except BaseException:
+            outcome = "error"
+            raise
+        finally:
+            seconds = time.perf_counter() - start_time
+            self.observe(stage, seconds, outcome)
+            if timings is not None:
+                timings[stage] = timings.get(stage, 0.0) + seconds
+
+    # Method to get the metrics in the Prometheus text format, and its content type
+    # With PROMETHEUS_MULTIPROC_DIR, the samples of all the workers are added up
+    def export(self) -> tuple:
+        if MULTIPROCESS_DIR:
+            registry = CollectorRegistry()
+            multiprocess.MultiProcessCollector(registry)
+            return generate_latest(registry), CONTENT_TYPE_LATEST
+        return generate_latest(), CONTENT_TYPE_LATEST
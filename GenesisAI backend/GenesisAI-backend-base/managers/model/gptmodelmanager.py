@@ -1,6 +1,5 @@
 import os
 import logging
-import tiktoken
 from langchain_openai import AzureChatOpenAI
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.prompts import PromptTemplate
@@ -15,6 +14,11 @@ import requests
 from requests.exceptions import HTTPError
 import time
 import uuid
+import hashlib
+import asyncio
+import tempfile
+import threading
+import queue
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -28,6 +32,9 @@ history_manager = managers.CosmosHistoryManager(logger=None)
 # Initialize the prompts variable
 gpt_prompts = gptprompts.prompts
 
+# Backoffice API URL of the client topic context ids
+BACKOFFICE_CONTEXTS_URL = "https://genhelpbackoffice-api.azurewebsites.net/v1/gpt/contexts"
+
 
 # GPT model manager class
 class GptModelManager:
@@ -35,42 +42,108 @@ class GptModelManager:
     def __init__(self, logger):
         self._logger = logger
         self._logger = logging.getLogger(__name__)
-        self._language = ""
-        self.response_prompt_tokens = 0
-        self.response_completion_tokens = 0      
-        self.model = None
-        self.context_list = []
-        self.start_time = None
-        self.azure_keyvault_client = keyvault_manager.get_azure_keyvault_client()
+        # Timing spans of the request stages (Prometheus histograms, exported on /metrics)
+        self.stage_metrics = managers.StageMetrics()
+        # Default stream format of the answers (legacy, ndjson or sse) and chunk coalescing of the framed formats
+        self.stream_format = os.environ.get("STREAM_FORMAT", "legacy").strip().lower()
+        self.stream_flush_ms = float(os.environ.get("STREAM_FLUSH_MS", "40"))
+        self.stream_flush_bytes = int(os.environ.get("STREAM_FLUSH_BYTES", "512"))
+        # Local language identifier (the check_language GPT prompt is only used when it isn't confident enough)
+        self.language_identifier = None
+        if 'true' in os.environ.get("LOCAL_LANGUAGE_ID", "true").lower():
+            self.language_identifier = managers.NgramLanguageIdentifier()
+        self.language_id_threshold = float(os.environ.get("LANGUAGE_ID_THRESHOLD", "0.7"))
+        # Embedding-similarity classifier for topics 1 and 2 (set by set_topic_classifier)
+        self.topic_classifier = None
+        # Memoized classifier and translation results (keyed by prompt template, so prompt edits invalidate them)
+        self.memo_cache = None
+        if 'true' in os.environ.get("CLASSIFIER_MEMO_CACHE", "true").lower():
+            self.memo_cache = managers.LruTtlCache(max_entries=int(os.environ.get("CLASSIFIER_MEMO_MAX_ENTRIES", "5000")),
+                                                   ttl_seconds=float(os.environ.get("CLASSIFIER_MEMO_TTL_SECONDS", "86400")))
+        # Local token counter (only used when the GPT model response has no usage numbers)
+        self.token_counter = managers.TokenCounter(os.environ.get("TOKEN_COUNTER_MODEL", "gpt-4o"))
+        self.precompute_prompt_tokens()
+        # GPT model clients with pooled connections, shared by all the requests (the per-request state is kept in a RequestContext)
+        self.llm_client_registry = managers.LlmClientRegistry(
+            keyvault_manager,
+            max_connections=int(os.environ.get("LLM_MAX_CONNECTIONS", "100")),
+            max_keepalive_connections=int(os.environ.get("LLM_MAX_KEEPALIVE_CONNECTIONS", "20")),
+            keepalive_expiry=float(os.environ.get("LLM_KEEPALIVE_EXPIRY_SECONDS", "60")),
+            http2='true' in os.environ.get("LLM_HTTP2", "true").lower(),
+            retired_close_seconds=float(os.environ.get("LLM_RETIRED_CLIENT_CLOSE_SECONDS", "300")))
         # Dashboard api key for feedback endpoint
-        self.dashboard_api_key = self.azure_keyvault_client.get_secret("DASHBOARD-API-KEY").value               
+        self.dashboard_api_key = keyvault_manager.get_secret("DASHBOARD-API-KEY")               
+        # Write-behind journal of the finished turns (saved in CosmosDB by a background thread, not by the request)
+        self.history_journal = None
+        if 'true' in os.environ.get("HISTORY_WRITE_BEHIND", "true").lower():
+            self.history_journal = managers.HistoryJournal(
+                history_manager,
+                os.environ.get("HISTORY_JOURNAL_FILE", os.path.join(tempfile.gettempdir(), "genesisai-history-journal.sqlite3")),
+                flush_interval_seconds=float(os.environ.get("HISTORY_JOURNAL_FLUSH_SECONDS", "0.2")),
+                batch_size=int(os.environ.get("HISTORY_JOURNAL_BATCH_SIZE", "100")),
+                max_backoff_seconds=float(os.environ.get("HISTORY_JOURNAL_MAX_BACKOFF_SECONDS", "300")))
+            history_manager.set_journal(self.history_journal)
+        # Last turns of the recent conversations (formatted conversation history), checked against the journal, which
+        # has the last message of each conversation saved by any worker of the host (the turns saved by other replicas
+        # are seen when the entry expires)
+        self.recent_turns_cache = None
+        if 'true' in os.environ.get("HISTORY_RECENT_TURNS_CACHE", "true").lower():
+            self.recent_turns_cache = managers.RecentTurnsCache(
+                history_manager.format_history,
+                max_turns=history_manager.recent_turns,
+                max_bytes=int(os.environ.get("HISTORY_RECENT_TURNS_CACHE_MAX_BYTES", "8388608")),
+                ttl_seconds=float(os.environ.get("HISTORY_RECENT_TURNS_CACHE_TTL_SECONDS", "60")),
+                head_version=self.history_journal.get_head if self.history_journal is not None else None)
+            history_manager.set_recent_turns_cache(self.recent_turns_cache)
+        # Backoffice context id of each client topic, shared by the gunicorn workers through a local file
+        self.context_id_cache = managers.ContextIdCache(
+            os.environ.get("BACKOFFICE_CONTEXT_CACHE_FILE", os.path.join(tempfile.gettempdir(), "genesisai-backoffice-contexts.json")),
+            ttl_seconds=float(os.environ.get("BACKOFFICE_CONTEXT_TTL_SECONDS", "86400")))
+        # Background sender of the backoffice telemetry (messages, tokens and feedback)
+        self.backoffice_dispatcher = managers.BackofficeDispatcher(
+            self.get_backoffice_headers,
+            max_queue_size=int(os.environ.get("BACKOFFICE_QUEUE_SIZE", "1000")),
+            connect_timeout_seconds=float(os.environ.get("BACKOFFICE_CONNECT_TIMEOUT_SECONDS", "3.05")),
+            read_timeout_seconds=float(os.environ.get("BACKOFFICE_READ_TIMEOUT_SECONDS", "10")),
+            max_retries=int(os.environ.get("BACKOFFICE_MAX_RETRIES", "4")),
+            batch_window_seconds=float(os.environ.get("BACKOFFICE_BATCH_WINDOW_SECONDS", "1")),
+            spool_path=os.environ.get("BACKOFFICE_SPOOL_FILE", os.path.join(tempfile.gettempdir(), "genesisai-backoffice-spool.jsonl")),
+            context_id_cache=self.context_id_cache)
+        # Get the context ids of the known client topics in the background (the others are got when first used)
+        if 'true' in (os.environ['PROD_FLAG']).lower():
+            self.context_id_cache.warm(keyvault_manager.get_secret("PROJECT-ID"), self.get_client_topics(),
+                                       self.get_backoffice_context_id)
       
     
-    # Method to set the conversation context
-    def add_element_to_context_list(self, context):
-        self.context_list.append(str(context))
-    
-    # Method to clear the conversation context
-    def clear_context_list(self):
-        self.context_list.clear()        
-
-    # Method to set the language model; load some environment variables
-    def set_llm_model(self):        
-        self.model = AzureChatOpenAI(                         
-             api_version=os.environ["AZURE_OPENAI_VERSION"],
-             azure_deployment=os.environ["AZURE_OPENAI_GPTMODEL_NAME"],
-             azure_endpoint=self.azure_keyvault_client.get_secret("AZURE-OPENAI-ENDPOINT").value,
-             api_key=self.azure_keyvault_client.get_secret("AZURE-OPENAI-API-KEY").value,
-             temperature=0,             
-             streaming=True                        
-            )           
+    # Method to create the context of a new user request (frontend language, GPT model client and start time)
+    def new_request_context(self, language, start_time:float = None):
+        return managers.RequestContext(self.get_language(language), self.get_llm_model(), start_time, self.stage_metrics)
+
+    # Method to get the language model (long-lived client, rebuilt only when the Azure OpenAI secrets change)
+    def get_llm_model(self):
+        return self.llm_client_registry.get_model(temperature=0, streaming=True,
+                                                  stream_usage='true' in os.environ.get("STREAM_USAGE", "true").lower())
+
+    # Method to count the tokens of the static prompts once (for each frontend language)
+    def precompute_prompt_tokens(self):
+        static_prompts = [gpt_prompts.check_topic, gpt_prompts.check_language, "Responsible AI Policy Violation"]
+        for language in ("portuguese from Portugal (pt-PT)", "english"):
+            client_topic_others = self.get_client_topic_others('pt' if 'pt-PT' in language else 'en')
+            static_prompts += [
+                gpt_prompts.check_client_topic.format(client_topic_others=client_topic_others),
+                gpt_prompts.translate_language.format(language=language),
+                gpt_prompts.pre_classify.format(client_topic_others=client_topic_others, language=language),
+                gpt_prompts.main_chat_prompt.format(language=language)
+            ]
+        self.token_counter.precompute(static_prompts)
     
-    # Method to set the language based on the frontend
-    def set_language(self, language):
+    # Method to get the language based on the frontend
+    def get_language(self, language):
         if 'pt' in language:
-            self._language = "portuguese from Portugal (pt-PT)"        
+            return "portuguese from Portugal (pt-PT)"        
         elif 'en' in language:
-            self._language = "english"
+            return "english"
+        return ""
     
     def get_client_topic_others(self, language):
         if 'pt' in language:
@@ -81,40 +154,56 @@ class GptModelManager:
         else:
             return 'Others'
 
-    # Method to Record the start time
-    def set_start_time(self):
-        self.start_time = time.time()            
-    
-    # Method to get the response prompt tokens    
-    def get_response_prompt_tokens(self):
-        return self.response_prompt_tokens
-    
-    # Method to set the response prompt tokens
-    def set_response_prompt_tokens(self, tokens):
-        self.response_prompt_tokens = int(self.response_prompt_tokens)+int(tokens)
+    # Method to get the client topics of the classification prompts (for every frontend language)
+    def get_client_topics(self):
+        client_topics = ["Responsible AI Policy Violation"]
+        for language in ("pt", "en"):
+            prompt = gpt_prompts.check_client_topic.format(client_topic_others=self.get_client_topic_others(language))
+            client_topics += [line.strip()[2:].strip() for line in prompt.splitlines() if line.strip().startswith("- ")]
+        return list(dict.fromkeys(client_topics))
+
+    # Method to set the prompt and completion tokens of a GPT model call
+    # Uses the usage returned by Azure OpenAI, or local estimates if the response has no usage (or there's no response)
+    def set_call_tokens(self, request_context, system_prompt:str, user_prompt:str, llm_response=None, completion:str = ""):
+        usage = getattr(llm_response, "usage_metadata", None)
+        if usage:
+            request_context.set_response_prompt_tokens(usage["input_tokens"])
+            request_context.set_response_completion_tokens(usage["output_tokens"])
+        else:
+            request_context.set_response_prompt_tokens(self.token_counter.count_batch([system_prompt, user_prompt]))
+            request_context.set_response_completion_tokens(self.token_counter.count(llm_response.content if llm_response is not None else completion))
     
-    # Method to clear the response prompt tokens    
-    def clear_response_prompt_tokens(self):
-        self.response_prompt_tokens = 0
+    # Method to get the memoization key of a classifier/translation call
+    # The formatted system prompt is hashed, so template, language or client topic changes use new keys
+    def get_memo_key(self, method:str, system_prompt:str, user_prompt:str, case_sensitive:bool = False):
+        normalized_prompt = " ".join(user_prompt.split())
+        if not case_sensitive:
+            normalized_prompt = normalized_prompt.casefold()
+        return (method, hashlib.sha256(system_prompt.encode("utf-8")).hexdigest(), normalized_prompt)
+
+    # Method to get a memoized result (None on a miss); hits aren't billed, so no tokens are recorded
+    def get_memoized(self, memo_key):
+        if self.memo_cache is None:
+            return None
+        return self.memo_cache.get(memo_key)
+
+    # Method to memoize a result
+    def set_memoized(self, memo_key, result):
+        if self.memo_cache is not None:
+            self.memo_cache.set(memo_key, result)
 
-    # Method to get the completion response prompt tokens    
-    def get_response_completion_tokens(self):
-        return self.response_completion_tokens
-    
-    # Method to set the completion response prompt tokens
-    def set_response_completion_tokens(self, tokens):
-        self.response_completion_tokens = int(self.response_completion_tokens)+int(tokens)
-    
-    # Method to clear the completion response prompt tokens    
-    def clear_response_completion_tokens(self):
-        self.response_completion_tokens = 0
-    
     # Method to get the prompt topic based on the user prompt
-    def get_prompt_topic(self, user_prompt:str):
+    def get_prompt_topic(self, request_context, user_prompt:str):
 
         # Get the check_topic prompt from the prompts file        
         system_prompt = gpt_prompts.check_topic
 
+        # Get the memoized topic of the same user prompt
+        memo_key = self.get_memo_key("topic", system_prompt, user_prompt)
+        memoized_topic = self.get_memoized(memo_key)
+        if memoized_topic is not None:
+            return memoized_topic
+
         # Create the custom prompt template
         prompt = ChatPromptTemplate.from_messages(
                 [
@@ -124,41 +213,56 @@ class GptModelManager:
         )
 
         # Create the chain
-        chain = prompt | self.model
+        chain = prompt | request_context.model
 
         try:
 
             # Get the user prompt topic from the GPT model
             llm_response = chain.invoke({"input": user_prompt})
 
-            # Get and set the response prompt and completion tokens        
-            tokens_system_prompt = self.get_token_usage(system_prompt)
-            tokens_user_prompt = self.get_token_usage(user_prompt)
-            tokens_completion = self.get_token_usage(llm_response.content)        
-            self.set_response_prompt_tokens(int(tokens_system_prompt)+int(tokens_user_prompt))        
-            self.set_response_completion_tokens(int(tokens_completion))
+            # Get and set the response prompt and completion tokens
+            self.set_call_tokens(request_context, system_prompt, user_prompt, llm_response)
 
         except Exception as e:
             
             if "responsibleaipolicyviolation" in str(e).lower().strip():
 
-                # Get and set the response prompt and completion tokens        
-                tokens_system_prompt = self.get_token_usage(system_prompt)
-                tokens_user_prompt = self.get_token_usage(user_prompt)
-                tokens_completion = self.get_token_usage("Responsible AI Policy Violation")        
-                self.set_response_prompt_tokens(int(tokens_system_prompt)+int(tokens_user_prompt))        
-                self.set_response_completion_tokens(int(tokens_completion))
+                # Get and set the response prompt and completion tokens (estimated, there's no response)
+                self.set_call_tokens(request_context, system_prompt, user_prompt, completion="Responsible AI Policy Violation")
                 
+                self.set_memoized(memo_key, "Responsible AI Policy Violation")
                 return "Responsible AI Policy Violation"
          
+        self.set_memoized(memo_key, llm_response.content)
         return llm_response.content
     
+    # Method to set the embedding-similarity topic classifier
+    def set_topic_classifier(self, topic_classifier):
+        self.topic_classifier = topic_classifier
+
+    # Method to get the prompt topic without a GPT model call
+    # Returns '1' or '2' if the embedding-similarity classifier is confident enough, otherwise None (use get_prompt_topic)
+    def get_prompt_topic_fast(self, user_prompt:str):
+        if self.topic_classifier is None:
+            return None
+        try:
+            return self.topic_classifier.classify(user_prompt)
+        except Exception as e:
+            print(f"Topic fast path failed, using the GPT model: {e}")
+            return None
+
     # Method to get the client topic based on the user prompt
-    def get_client_topic(self, user_prompt:str, client_topic_others:str):
+    def get_client_topic(self, request_context, user_prompt:str, client_topic_others:str):
                        
         # Get the client prompt from the prompts file        
         system_prompt = gpt_prompts.check_client_topic.format(client_topic_others = client_topic_others)
 
+        # Get the memoized client topic of the same user prompt
+        memo_key = self.get_memo_key("client_topic", system_prompt, user_prompt)
+        memoized_client_topic = self.get_memoized(memo_key)
+        if memoized_client_topic is not None:
+            return memoized_client_topic
+
         # Create the custom prompt template
         prompt = ChatPromptTemplate.from_messages(
                 [
@@ -168,26 +272,35 @@ class GptModelManager:
         )
 
         # Create the chain
-        chain = prompt | self.model
+        chain = prompt | request_context.model
 
         # Get the user prompt topic from the GPT model
         llm_response = chain.invoke({"input": user_prompt})
 
-        # Get and set the response prompt and completion tokens        
-        tokens_system_prompt = self.get_token_usage(system_prompt)
-        tokens_user_prompt = self.get_token_usage(user_prompt)
-        tokens_completion = self.get_token_usage(llm_response.content)        
-        self.set_response_prompt_tokens(int(tokens_system_prompt)+int(tokens_user_prompt))        
-        self.set_response_completion_tokens(int(tokens_completion))
+        # Get and set the response prompt and completion tokens
+        self.set_call_tokens(request_context, system_prompt, user_prompt, llm_response)
          
+        self.set_memoized(memo_key, llm_response.content)
         return llm_response.content
             
     # Method to get the user prompt language
-    def get_prompt_language(self, user_prompt:str):                
+    def get_prompt_language(self, request_context, user_prompt:str):                
+
+        # Identify the user prompt language locally, without a GPT model call (if confident enough)
+        if self.language_identifier is not None:
+            language, confidence = self.language_identifier.identify(user_prompt)
+            if confidence >= self.language_id_threshold:
+                return language
         
         # Get the check_language prompt from the prompts file        
         system_prompt = gpt_prompts.check_language
 
+        # Get the memoized language of the same user prompt
+        memo_key = self.get_memo_key("language", system_prompt, user_prompt)
+        memoized_language = self.get_memoized(memo_key)
+        if memoized_language is not None:
+            return memoized_language
+
         # Create the custom prompt template
         prompt = ChatPromptTemplate.from_messages(
                 [
@@ -197,32 +310,37 @@ class GptModelManager:
         )
 
         # Create the chain
-        chain = prompt | self.model
+        chain = prompt | request_context.model
 
         # Get the user prompt language from the GPT model
         llm_response = chain.invoke({"input": user_prompt})
 
-        # Get and set the response prompt and completion tokens        
-        tokens_system_prompt = self.get_token_usage(system_prompt)
-        tokens_user_prompt = self.get_token_usage(user_prompt)
-        tokens_completion = self.get_token_usage(llm_response.content)        
-        self.set_response_prompt_tokens(int(tokens_system_prompt)+int(tokens_user_prompt))        
-        self.set_response_completion_tokens(int(tokens_completion))
+        # Get and set the response prompt and completion tokens
+        self.set_call_tokens(request_context, system_prompt, user_prompt, llm_response)
         
         # Return the user prompt language
         if '1' in llm_response.content.strip():
-            return 'pt'        
+            prompt_language = 'pt'        
         elif '2' in llm_response.content.strip():
-            return 'en'        
+            prompt_language = 'en'        
         else:
-            return ''
+            prompt_language = ''
+
+        self.set_memoized(memo_key, prompt_language)
+        return prompt_language
 
     # Method to translate the user prompt if the frontend language is different from the user language
-    def translate_prompt(self, user_prompt):
+    def translate_prompt(self, request_context, user_prompt):
         
         # Get the translate_language prompt from the prompts file
         system_prompt = gpt_prompts.translate_language
 
+        # Get the memoized translation of the same user prompt (case sensitive, the translation keeps the case)
+        memo_key = self.get_memo_key("translation", system_prompt.format(language=request_context.language), user_prompt, case_sensitive=True)
+        memoized_translation = self.get_memoized(memo_key)
+        if memoized_translation is not None:
+            return memoized_translation
+
         # Create the custom prompt template
         prompt = ChatPromptTemplate.from_messages(
                 [
@@ -232,22 +350,103 @@ class GptModelManager:
         )
 
         # Create the chain
-        chain = prompt | self.model
+        chain = prompt | request_context.model
 
         # Get the translated user prompt from the GPT model
-        llm_response = chain.invoke({"input": user_prompt,"language": self._language})
+        llm_response = chain.invoke({"input": user_prompt,"language": request_context.language})
 
-        # Get and set the response prompt and completion tokens        
-        tokens_system_prompt = self.get_token_usage(system_prompt.format(language=self._language))
-        tokens_user_prompt = self.get_token_usage(user_prompt)
-        tokens_completion = self.get_token_usage(llm_response.content)        
-        self.set_response_prompt_tokens(int(tokens_system_prompt)+int(tokens_user_prompt))        
-        self.set_response_completion_tokens(int(tokens_completion))               
+        # Get and set the response prompt and completion tokens
+        self.set_call_tokens(request_context, system_prompt.format(language=request_context.language), user_prompt, llm_response)
+
+        self.set_memoized(memo_key, llm_response.content)
+        return llm_response.content
+
+    # Method to get the prompt topic, prompt language, client topic and translated prompt in a single GPT model call
+    # Returns None if the GPT model response can't be used, so the caller can fall back to the per-step methods
+    def get_prompt_classification(self, request_context, user_prompt:str, client_topic_others:str):
+
+        # Get the pre_classify prompt from the prompts file
+        system_prompt = gpt_prompts.pre_classify.format(client_topic_others=client_topic_others, language=request_context.language)
+
+        # Get the memoized classification of the same user prompt (case sensitive, it includes the translation)
+        memo_key = self.get_memo_key("classification", system_prompt, user_prompt, case_sensitive=True)
+        memoized_classification = self.get_memoized(memo_key)
+        if memoized_classification is not None:
+            return dict(memoized_classification)
+
+        # Create the custom prompt template
+        prompt = ChatPromptTemplate.from_messages(
+                [
+                    ("system", system_prompt),
+                    ("human", "{input}"),
+                ]
+        )
+
+        # Create the chain (JSON mode, so the reply can be parsed)
+        chain = prompt | request_context.model.bind(response_format={"type": "json_object"})
+
+        try:
+
+            # Get the user prompt classification from the GPT model
+            llm_response = chain.invoke({"input": user_prompt})
+
+        except Exception as e:
+
+            if "responsibleaipolicyviolation" in str(e).lower().strip():
+
+                # Get and set the response prompt and completion tokens (estimated, there's no response)
+                self.set_call_tokens(request_context, system_prompt, user_prompt, completion="Responsible AI Policy Violation")
+
+                classification = {
+                    "topic": "Responsible AI Policy Violation",
+                    "language": "",
+                    "client_topic": client_topic_others,
+                    "translated_prompt": ""
+                }
+                self.set_memoized(memo_key, classification)
+                return dict(classification)
+
+            print(f"Prompt classification failed, using the per-step classifiers: {e}")
+            return None
+
+        # Get and set the response prompt and completion tokens (the call is billed even if the reply can't be used)
+        self.set_call_tokens(request_context, system_prompt, user_prompt, llm_response)
+
+        try:
+            llm_classification = json.loads(llm_response.content)
+
+            topic = str(llm_classification["topic"]).strip()
+            language = str(llm_classification["language"]).strip()
+            client_topic = str(llm_classification["client_topic"]).strip()
+            translated_prompt = str(llm_classification.get("translated_prompt") or "").strip()
+
+        except Exception as e:
+            print(f"Invalid prompt classification, using the per-step classifiers: {e}")
+            return None
+
+        if topic not in ('1', '2', '3', '4') or not client_topic:
+            print(f"Invalid prompt classification, using the per-step classifiers: {llm_response.content}")
+            return None
+
+        # Map the language category the same way as get_prompt_language
+        if '1' in language:
+            language = 'pt'
+        elif '2' in language:
+            language = 'en'
+        else:
+            language = ''
+
+        classification = {
+            "topic": topic,
+            "language": language,
+            "client_topic": client_topic,
+            "translated_prompt": translated_prompt
+        }
+        self.set_memoized(memo_key, classification)
+        return dict(classification)
 
-        return llm_response.content 
-        
     # Method to translate the user prompt if the frontend language is different from the user language
-    def rewrite_user_prompt(self, user_prompt:str, conversation_history:str):
+    def rewrite_user_prompt(self, request_context, user_prompt:str, conversation_history:str):
         
         if conversation_history:
             # Get the translate_language prompt from the prompts file            
@@ -263,24 +462,20 @@ class GptModelManager:
             )
 
             # Create the chain
-            chain = prompt | self.model
+            chain = prompt | request_context.model
 
             # Get the translated user prompt from the GPT model
-            llm_response = chain.invoke({"input": user_prompt,"conversation_history": conversation_history, "language": self._language})
+            llm_response = chain.invoke({"input": user_prompt,"conversation_history": conversation_history, "language": request_context.language})
 
-            # Get and set the response prompt and completion tokens        
-            tokens_system_prompt = self.get_token_usage(system_prompt.format(conversation_history=conversation_history, language=self._language))            
-            tokens_user_prompt = self.get_token_usage(user_prompt)
-            tokens_completion = self.get_token_usage(llm_response.content)        
-            self.set_response_prompt_tokens(int(tokens_system_prompt)+int(tokens_user_prompt))        
-            self.set_response_completion_tokens(int(tokens_completion))
+            # Get and set the response prompt and completion tokens
+            self.set_call_tokens(request_context, system_prompt.format(conversation_history=conversation_history, language=request_context.language), user_prompt, llm_response)
 
             user_prompt = llm_response.content            
         
         return user_prompt
     
     # Method to get the RAG chain for topics 1 and 2
-    def get_ragChain_topics_1and2(self, user_prompt):
+    def get_ragChain_topics_1and2(self, request_context, user_prompt):
 
         # Get the current datetime in Portugal timezone
         now = datetime.now()
@@ -288,7 +483,7 @@ class GptModelManager:
         timestamp_now_str = now.strftime("%Y-%m-%d %H-%M-%S")
 
         # Get the prompt_header from the prompts file
-        system_prompt = gpt_prompts.prompt_header.format(language=self._language, present_date = timestamp_now_str)
+        system_prompt = gpt_prompts.prompt_header.format(language=request_context.language, present_date = timestamp_now_str)
                 
         # Create the custom RAG prompt template
         prompt = ChatPromptTemplate.from_messages(
@@ -299,17 +494,29 @@ class GptModelManager:
         )
 
         # Create the RAG chain
-        chain = {"input": RunnablePassthrough()} | prompt | self.model
+        chain = {"input": RunnablePassthrough()} | prompt | request_context.model
           
-        # Get and set the response prompt tokens        
-        tokens_system_prompt = self.get_token_usage(system_prompt)
-        tokens_user_prompt = self.get_token_usage(user_prompt)
-        self.set_response_prompt_tokens(int(tokens_system_prompt)+int(tokens_user_prompt))
+        # Keep the prompt texts, to estimate the prompt tokens if the stream has no usage
+        request_context.generation_prompt_texts = [system_prompt, user_prompt]
         
         return chain
 
+    # Method to get the knowledge context string for a question
+    def get_context_string(self, question, retriever):
+        # Two options to build the context_string
+        # 1 - From a common/ensembled retriever:
+        context_string = (retriever | self.format_docs).invoke(question)
+        context_string = "# Context:\n\n"+context_string
+        # 2 - From a list of retrievers: 
+        # context_main = (retriever[0] | self.format_docs).invoke(question)        
+        # context_hardcoded = (retriever[1] | self.format_docs).invoke(question)
+        # context_string = "# Context:\n\n"+context_main+"\n\n"+context_hardcoded        
+
+        return context_string
+
     # Method to get the main RAG chain for topics
-    def get_main_rag_chain(self, rewriten_user_prompt, conversation_history, retriever):                
+    # The context_string can be passed if it was already retrieved for the same question
+    def get_main_rag_chain(self, request_context, rewriten_user_prompt, conversation_history, retriever, context_string=None):                
         
         # Get the current datetime in Portugal timezone
         now = datetime.now()
@@ -317,20 +524,15 @@ class GptModelManager:
         timestamp_now_str = now.strftime("%Y-%m-%d %H-%M-%S")
 
         # Get the prompt_header and main_chat_prompt
-        prompt_header = gpt_prompts.prompt_header.format(language=self._language, present_date = timestamp_now_str)     
-        main_chat_prompt = gpt_prompts.main_chat_prompt.format(language=self._language)
+        prompt_header = gpt_prompts.prompt_header.format(language=request_context.language, present_date = timestamp_now_str)     
+        main_chat_prompt = gpt_prompts.main_chat_prompt.format(language=request_context.language)
     
         # Create the custom RAG prompt template
         template = "{prompt_header}\n\n{system_prompt}\n\n{conversation_context}\n\n{context}\n\nQuestion: {question}"
 
-        # Two options to build the context_string
-        # 1 - From a common/ensembled retriever:
-        context_string = (retriever | self.format_docs).invoke(rewriten_user_prompt)
-        context_string = "# Context:\n\n"+context_string
-        # 2 - From a list of retrievers: 
-        # context_main = (retriever[0] | self.format_docs).invoke(rewriten_user_prompt)        
-        # context_hardcoded = (retriever[1] | self.format_docs).invoke(rewriten_user_prompt)
-        # context_string = "# Context:\n\n"+context_main+"\n\n"+context_hardcoded        
+        # Get the knowledge context (if not already retrieved)
+        if context_string is None:
+            context_string = self.get_context_string(rewriten_user_prompt, retriever)
 
         # Create the custom RAG prompt based on the template        
         custom_rag_prompt = PromptTemplate.from_template(template)
@@ -342,16 +544,12 @@ class GptModelManager:
              "conversation_context": lambda x: conversation_history,
              "context": lambda x: context_string,
              "question": RunnablePassthrough()
-            } | custom_rag_prompt | self.model
+            } | custom_rag_prompt | request_context.model
         )
         
-        # Methods to get and set the response prompt tokens                
-        response_prompt_tokens = self.get_token_usage(template.format(prompt_header=prompt_header,
-                                                    system_prompt=main_chat_prompt,
-                                                    conversation_context=conversation_history, context=context_string,
-                                                    question=rewriten_user_prompt
-                                                    ))
-        self.set_response_prompt_tokens(int(response_prompt_tokens))
+        # Keep the prompt texts, to estimate the prompt tokens if the stream has no usage (the empty template counts the separators)
+        request_context.generation_prompt_texts = [template.format(prompt_header="", system_prompt="", conversation_context="", context="", question=""),
+                                        prompt_header, main_chat_prompt, conversation_history, context_string, rewriten_user_prompt]
 
         # Print to check the header and main system prompt sent to gpt (Uncomment for testing purposes if necessary)
         # print(template.format(prompt_header=prompt_header,
@@ -372,143 +570,255 @@ class GptModelManager:
         #context = "\n\n".join((doc.page_content) for doc in docs)          
         return context
     
-    # Method to generate the model response and stream it to the frontend
-    def generate(self, chain, user_prompt:str, conversation_id, client_topic, audio_duration:float):
+    # Method to create the framer of a streamed answer (legacy, ndjson or sse stream format)
+    def new_stream_framer(self, stream_format:str = None):
+        return managers.StreamFramer(stream_format or self.stream_format, flush_interval_ms=self.stream_flush_ms,
+                                     flush_bytes=self.stream_flush_bytes)
+
+    # Method to get the Responsible AI Policy Violation reply of the request language, and its completion tokens
+    def get_policy_violation_reply(self, request_context) -> tuple:
+        if 'portuguese from Portugal (pt-PT)' in request_context.language:
+            return ("Lamentamos, mas não foi possível processar o seu pedido, pois este poderá conter conteúdo que contraria as nossas políticas de utilização responsável de inteligência artificial. Se desejar, pode reformular a sua pergunta e tentar novamente.\n\nO nosso sistema foi concebido para seguir diretrizes de utilização responsável de IA, garantindo uma comunicação segura e respeitosa. Diga-nos de que outra forma o podemos ajudar.", 110)
+        return ("I'm sorry, but I couldn't process your request because it may contain content that goes against our Responsible AI use policies. If you’d like, feel free to rephrase your question and try again.\n\nOur system is designed to follow responsible AI guidelines to ensure safe and respectful communication. Let me know how I can assist you differently.", 75)
+
+    # Method to start a streamed answer (framed in the legacy format by default)
+    def new_generation(self, request_context, framer=None):
+        return managers.StreamedGeneration(request_context, framer or managers.StreamFramer(),
+                                           self.get_policy_violation_reply(request_context))
+
+    # Method to get the frames of the GPT model chunks; when the framer coalesces the chunks, the GPT model stream is read
+    # in a thread and the buffered content is sent when the flush interval passes without a new chunk
+    def stream_frames(self, generation, chunks):
+        if not generation.framer.coalesces:
+            for chunk in chunks:
+                yield from generation.add_chunk(chunk)
+            return
+
+        events = queue.Queue()
+        stopping = threading.Event()
+
+        def read_chunks():
+            try:
+                for chunk in chunks:
+                    # Stop reading if the client went away
+                    if stopping.is_set():
+                        break
+                    events.put(("chunk", chunk))
+                events.put(("end", None))
+            except Exception as e:
+                events.put(("end", e))
 
-        # Initialize variables  
-        full_response = ""        
-        response_tokens = 0
-        message_id = ""
-        client_topic_id = None
+        threading.Thread(target=read_chunks, name="gpt-stream", daemon=True).start()
+        try:
+            while True:
+                try:
+                    kind, value = events.get(timeout=generation.framer.flush_delay())
+                except queue.Empty:
+                    yield from generation.flush()
+                    continue
+                if kind == "end":
+                    if value is not None:
+                        raise value
+                    return
+                yield from generation.add_chunk(value)
+        finally:
+            stopping.set()
+
+    # Method to get the frames of the GPT model chunks on an event loop (see stream_frames); the GPT model stream is read
+    # by a single task, so it's never cancelled by the flush timer
+    async def astream_frames(self, generation, chunks):
+        if not generation.framer.coalesces:
+            async for chunk in chunks:
+                for frame in generation.add_chunk(chunk):
+                    yield frame
+            return
+
+        events = asyncio.Queue()
+
+        async def read_chunks():
+            try:
+                async for chunk in chunks:
+                    events.put_nowait(("chunk", chunk))
+                events.put_nowait(("end", None))
+            except Exception as e:
+                events.put_nowait(("end", e))
 
-        response_json = {             
-             "content" : "",
-             "message_id" : ""
-        }
+        reader = asyncio.create_task(read_chunks())
+        try:
+            while True:
+                try:
+                    kind, value = await asyncio.wait_for(events.get(), generation.framer.flush_delay())
+                except asyncio.TimeoutError:
+                    for frame in generation.flush():
+                        yield frame
+                    continue
+                if kind == "end":
+                    if value is not None:
+                        raise value
+                    return
+                for frame in generation.add_chunk(value):
+                    yield frame
+        finally:
+            reader.cancel()
+
+    # Method to generate the model response and stream it to the frontend
+    # on_complete is called with the full response when the GPT model answer finishes (e.g. to cache it)
+    # framer (optional) frames the chunks in the stream format of the request (legacy format by default)
+    def generate(self, request_context, chain, user_prompt:str, conversation_id, client_topic, audio_duration:float, on_complete=None,
+                 framer=None):
 
-        if (chain is not None) and ('Responsible AI Policy Violation' not in client_topic):            
+        generation = self.new_generation(request_context, framer)
+
+        if (chain is not None) and ('Responsible AI Policy Violation' not in client_topic):
             try:
                 # Stream the response to the frontend
-                for chunk in chain.stream(user_prompt):                                    
-                            if chunk.content:
-                                    if chunk.id and not message_id:
-                                        message_id = chunk.id
-                                        response_json['message_id'] = message_id
-                                        # Record the end time (when the answer starts to show on frontend)
-                                        end_time = time.time()
-                                    response_tokens += 1
-                                    full_response += chunk.content
-                                    response_json['content'] = chunk.content                                                        
-                                    yield json.dumps(response_json)
-            
+                yield from self.stream_frames(generation, chain.stream(user_prompt))
             except Exception as e:
-                if "responsibleaipolicyviolation" in str(e).lower().strip():
-                    if 'portuguese from Portugal (pt-PT)' in self._language:
-                        response_json = {             
-                        "content" : "Lamentamos, mas não foi possível processar o seu pedido, pois este poderá conter conteúdo que contraria as nossas políticas de utilização responsável de inteligência artificial. Se desejar, pode reformular a sua pergunta e tentar novamente.\n\nO nosso sistema foi concebido para seguir diretrizes de utilização responsável de IA, garantindo uma comunicação segura e respeitosa. Diga-nos de que outra forma o podemos ajudar.",
-                        "message_id" : str(uuid.uuid4())
-                        }
-                        full_response = "Lamentamos, mas não foi possível processar o seu pedido, pois este poderá conter conteúdo que contraria as nossas políticas de utilização responsável de inteligência artificial. Se desejar, pode reformular a sua pergunta e tentar novamente.\n\nO nosso sistema foi concebido para seguir diretrizes de utilização responsável de IA, garantindo uma comunicação segura e respeitosa. Diga-nos de que outra forma o podemos ajudar."
-                        response_tokens = 110
-                    else:
-                        response_json = {             
-                        "content" : "I'm sorry, but I couldn't process your request because it may contain content that goes against our Responsible AI use policies. If you’d like, feel free to rephrase your question and try again.\n\nOur system is designed to follow responsible AI guidelines to ensure safe and respectful communication. Let me know how I can assist you differently.",
-                        "message_id" : str(uuid.uuid4())
-                        }
-                        full_response = "I'm sorry, but I couldn't process your request because it may contain content that goes against our Responsible AI use policies. If you’d like, feel free to rephrase your question and try again.\n\nOur system is designed to follow responsible AI guidelines to ensure safe and respectful communication. Let me know how I can assist you differently."
-                        response_tokens = 75
-
-                    end_time = time.time()
-                    yield json.dumps(response_json)
-
+                yield from generation.add_error(e)
         else:
-            if 'portuguese from Portugal (pt-PT)' in self._language:
-                response_json = {             
-                "content" : "Lamentamos, mas não foi possível processar o seu pedido, pois este poderá conter conteúdo que contraria as nossas políticas de utilização responsável de inteligência artificial. Se desejar, pode reformular a sua pergunta e tentar novamente.\n\nO nosso sistema foi concebido para seguir diretrizes de utilização responsável de IA, garantindo uma comunicação segura e respeitosa. Diga-nos de que outra forma o podemos ajudar.",
-                "message_id" : str(uuid.uuid4())
-                }
-                full_response = "Lamentamos, mas não foi possível processar o seu pedido, pois este poderá conter conteúdo que contraria as nossas políticas de utilização responsável de inteligência artificial. Se desejar, pode reformular a sua pergunta e tentar novamente.\n\nO nosso sistema foi concebido para seguir diretrizes de utilização responsável de IA, garantindo uma comunicação segura e respeitosa. Diga-nos de que outra forma o podemos ajudar."
-                response_tokens = 110
-            else:
-                response_json = {             
-                "content" : "I'm sorry, but I couldn't process your request because it may contain content that goes against our Responsible AI use policies. If you’d like, feel free to rephrase your question and try again.\n\nOur system is designed to follow responsible AI guidelines to ensure safe and respectful communication. Let me know how I can assist you differently.",
-                "message_id" : str(uuid.uuid4())
-                }
-                full_response = "I'm sorry, but I couldn't process your request because it may contain content that goes against our Responsible AI use policies. If you’d like, feel free to rephrase your question and try again.\n\nOur system is designed to follow responsible AI guidelines to ensure safe and respectful communication. Let me know how I can assist you differently."
-                response_tokens = 75
+            yield from generation.add_policy_violation_reply()
+
+        yield from generation.close()
+        self.finish_generation(generation, chain, user_prompt, conversation_id, client_topic, audio_duration, on_complete)
+
+    # Method to generate the model response and stream it to the frontend on an event loop (ASGI mode)
+    # The GPT model stream doesn't hold a thread; the turn is saved in a worker thread (journal or CosmosDB)
+    async def agenerate(self, request_context, chain, user_prompt:str, conversation_id, client_topic, audio_duration:float,
+                        on_complete=None, framer=None):
 
-            end_time = time.time()
-            yield json.dumps(response_json)
-                            
+        generation = self.new_generation(request_context, framer)
+
+        if (chain is not None) and ('Responsible AI Policy Violation' not in client_topic):
+            try:
+                # Stream the response to the frontend
+                async for frame in self.astream_frames(generation, chain.astream(user_prompt)):
+                    yield frame
+            except Exception as e:
+                for frame in generation.add_error(e):
+                    yield frame
+        else:
+            for frame in generation.add_policy_violation_reply():
+                yield frame
+
+        for frame in generation.close():
+            yield frame
+        await asyncio.to_thread(self.finish_generation, generation, chain, user_prompt, conversation_id, client_topic,
+                                audio_duration, on_complete)
+
+    # Method to finish a streamed answer: token usage, elapsed time, conversation history, answer cache and backoffice
+    def finish_generation(self, generation, chain, user_prompt:str, conversation_id, client_topic, audio_duration:float, on_complete=None):
+
+        request_context = generation.request_context
+        full_response = generation.full_response
+        message_id = generation.message_id
+        response_tokens = generation.response_tokens
+        usage = generation.usage
         
-        # Calculate the elapsed time between question and answer
-        elapsed_time = end_time - self.start_time
+        # Get the generation prompt and completion tokens (usage returned by Azure OpenAI, or local estimates)
+        if getattr(chain, 'cached', False):
+            # Cached answers aren't billed by the GPT model
+            response_tokens = 0
+        elif usage:
+            request_context.set_response_prompt_tokens(usage["input_tokens"])
+            response_tokens = usage["output_tokens"]
+        else:
+            if request_context.generation_prompt_texts:
+                request_context.set_response_prompt_tokens(self.token_counter.count_batch(request_context.generation_prompt_texts))
+            if not response_tokens:
+                response_tokens = self.token_counter.count(full_response)
+
+        # Calculate the elapsed time between question and answer (until the end of the stream if nothing was streamed)
+        elapsed_time = (generation.first_token_time or time.time()) - request_context.start_time
         print(f"Elapsed time: {elapsed_time:.5f} seconds")
 
         # Get the full response prompt and completion tokens        
-        prompt_tokens = self.get_response_prompt_tokens()
-        response_tokens = int(self.get_response_completion_tokens()) + int(response_tokens)
+        prompt_tokens = request_context.get_response_prompt_tokens()
+        response_tokens = int(request_context.get_response_completion_tokens()) + int(response_tokens)
         
         print("PromptTokens: "+str(prompt_tokens)+ "\nResponse Tokens: "+str(response_tokens))  
         
-        # Save the new conversation in CosmosDB
-        managers.await_cosmosdb_function(self.save_new_conversation(user_prompt, full_response, conversation_id, prompt_tokens, response_tokens, elapsed_time, message_id))                
-       
+        # Save the new conversation in the write-behind journal (saved in CosmosDB in the background), or in CosmosDB
+        with request_context.span("persistence"):
+            conversation_item = self.get_conversation_item(user_prompt, full_response, prompt_tokens, response_tokens, elapsed_time, message_id)
+            journaled = False
+            if self.history_journal is not None and conversation_item is not None:
+                try:
+                    self.history_journal.append(conversation_id, conversation_item)
+                    journaled = True
+                except Exception as e:
+                    print(f"History journal error, saving in CosmosDB: {e}")
+            if not journaled:
+                managers.await_cosmosdb_function(self.save_new_conversation(user_prompt, full_response, conversation_id, prompt_tokens, response_tokens, elapsed_time, message_id))
+            if conversation_item is not None:
+                history_manager.add_recent_turn(conversation_id, conversation_item)
+
+        # Hand the full GPT model response to the caller (not for answers cut by a stream error or policy violation
+        # replies, so they aren't cached)
+        if on_complete is not None and generation.completed and message_id and full_response:
+            try:
+                with request_context.span("answer_cache_store"):
+                    on_complete(full_response)
+            except Exception as e:
+                print(f"Error on response completion: {e}")
+
         # If prod environment, the stats are sent to backoffice endpoints
         if 'true' in (os.environ['PROD_FLAG']).lower():
-            
-            # Headers
-            headers = {
-                "X-API-KEY": self.dashboard_api_key,
-                "Content-Type": "application/json"
-            }
-
-            if client_topic:
+            with request_context.span("telemetry"):
+                self.send_backoffice_telemetry(request_context, user_prompt, full_response, conversation_id, message_id,
+                                               client_topic, audio_duration, prompt_tokens, response_tokens)
 
-                client_topic_dash = {
-                    "projectId": self.azure_keyvault_client.get_secret("PROJECT-ID").value,
-                    "contextName": client_topic
-                }
+        request_context.observe("request", time.time() - request_context.start_time)
+        print(f"Stage timings (ms): {request_context.get_timings()}")
 
-                get_context_url = "https://genhelpbackoffice-api.azurewebsites.net/v1/gpt/contexts"
+    # Method to queue the backoffice messages and tokens of a finished turn (sent in the background)
+    def send_backoffice_telemetry(self, request_context, user_prompt, full_response, conversation_id, message_id,
+                                  client_topic, audio_duration, prompt_tokens, response_tokens):
+        client_topic_id = None
 
-                # Get the client topic id from backoffice API (Uncomment for production stage)
-                client_topic_id = self.post_data_get_context_id(get_context_url, client_topic_dash, headers)['contextId']
+        # Headers
+        headers = {
+            "X-API-KEY": self.dashboard_api_key,
+            "Content-Type": "application/json"
+        }
 
-                self.context_list.append(client_topic_id)
-            
-            mensagem_dashboard = {
-                "projectId": self.azure_keyvault_client.get_secret("PROJECT-ID").value,
-                "conversationId": conversation_id,
-                "messageId": message_id,
-                "amount": 1,
-                "prompt": user_prompt,
-                "reply": full_response,
-                "contexts": self.context_list,
-                "context": client_topic_id,
-                "audioDuration": audio_duration               
-            }
-            
-            totaltokens_dashboard = {
-                "projectId": self.azure_keyvault_client.get_secret("PROJECT-ID").value,
-                "amount": int(response_tokens)+int(prompt_tokens)
-            }        
-
-            # Backoffice API URLs
-            messages_url = "https://genhelpbackoffice-api.azurewebsites.net/v1/gpt/messages"
-            tokens_url = "https://genhelpbackoffice-api.azurewebsites.net/v1/gpt/tokens"        
-
-            # Make the POST requests for backoffice API (Uncomment for production stage)
-            self.post_data(messages_url, mensagem_dashboard, headers)
-            self.post_data(tokens_url, totaltokens_dashboard, headers)
-
-        # Reset variables for the next interaction between user and gpt        
-        self.clear_response_prompt_tokens()
-        self.clear_response_completion_tokens()
-        self.clear_context_list()   
-            
-    # Method to save the new conversation in CosmosDB
-    async def save_new_conversation(self, user_prompt, full_message, conversation_id, prompt_tokens, response_tokens, elapsed_time, message_id):
+        project_id = keyvault_manager.get_secret("PROJECT-ID")
+        context_request = None
+        if client_topic:
+            # Client topic id from the local cache; if it isn't there, the dispatcher gets it from the backoffice API
+            # before posting the message (and adds it to the message context and contexts)
+            client_topic_id = self.context_id_cache.get(project_id, client_topic)
+            if client_topic_id is None:
+                context_request = {"url": BACKOFFICE_CONTEXTS_URL, "data": {"projectId": project_id, "contextName": client_topic}}
+            else:
+                request_context.add_element_to_context_list(client_topic_id)
+        
+        mensagem_dashboard = {
+            "projectId": project_id,
+            "conversationId": conversation_id,
+            "messageId": message_id,
+            "amount": 1,
+            "prompt": user_prompt,
+            "reply": full_response,
+            "contexts": list(request_context.context_list),
+            "context": client_topic_id,
+            "audioDuration": audio_duration               
+        }
+        
+        totaltokens_dashboard = {
+            "projectId": project_id,
+            "amount": int(response_tokens)+int(prompt_tokens)
+        }        
+
+        # Backoffice API URLs
+        messages_url = "https://genhelpbackoffice-api.azurewebsites.net/v1/gpt/messages"
+        tokens_url = "https://genhelpbackoffice-api.azurewebsites.net/v1/gpt/tokens"        
+
+        # Queue the POST requests for backoffice API (sent in the background)
+        self.backoffice_dispatcher.enqueue("POST", messages_url, mensagem_dashboard, headers, context_request=context_request)
+        self.backoffice_dispatcher.enqueue("POST", tokens_url, totaltokens_dashboard, headers)
+        
+    # Method to get the conversation item of a new turn (None if there's no GPT model reply)
+    def get_conversation_item(self, user_prompt, full_message, prompt_tokens, response_tokens, elapsed_time, message_id):
         
         # Create a new conversation item with the date, user prompt, GPT model reply, and usage stats
         if full_message:                
@@ -525,36 +835,36 @@ class GptModelManager:
                         TotalTokens = int(response_tokens)+int(prompt_tokens)
                     )                    
                 )
+                return item.dict()
+        return None
+
+    # Method to save the new conversation in CosmosDB
+    async def save_new_conversation(self, user_prompt, full_message, conversation_id, prompt_tokens, response_tokens, elapsed_time, message_id):
+        item = self.get_conversation_item(user_prompt, full_message, prompt_tokens, response_tokens, elapsed_time, message_id)
         # Save the conversation in CosmosDB
-        await history_manager.save_conversation(conversation_id, conversation_item=item.dict())
+        if item is not None:
+            await history_manager.save_conversation(conversation_id, conversation_item=item)
+
+    # Method to get the backoffice API headers
+    def get_backoffice_headers(self):
+        return {
+            "X-API-KEY": keyvault_manager.get_secret("DASHBOARD-API-KEY"),
+            "Content-Type": "application/json"
+        }
 
-    # Method to make POST requests
+    # Method to make POST requests (queued, sent in the background by the backoffice dispatcher)
     def post_data(self, url, data, headers):
-        try:
-            response = requests.post(url, headers=headers, data=json.dumps(data))
-            response.raise_for_status()  # Raise exception for HTTP errors
-            print(f"Successfully posted to {url}")
-        except HTTPError as http_err:
-            print(f"HTTP error occurred: {http_err}")
-        except Exception as err:
-            print(f"Other error occurred: {err}")
+        self.backoffice_dispatcher.enqueue("POST", url, data, headers)
 
-    # Method to make PATCH requests
+    # Method to make PATCH requests (queued, sent in the background by the backoffice dispatcher)
     def patch_data(self, url, data, headers):
-        try:
-            response = requests.patch(url, headers=headers, data=json.dumps(data))
-            response.raise_for_status()  # Raise exception for HTTP errors
-            print(f"Successfully posted to {url}")
-        except HTTPError as http_err:
-            print(f"HTTP error occurred: {http_err}")
-        except Exception as err:
-            print(f"Other error occurred: {err}")
+        self.backoffice_dispatcher.enqueue("PATCH", url, data, headers)
 
 
     # Method to make POST requests of context id
     def post_data_get_context_id(self, url, data, headers):
         try:
-            response = requests.post(url, headers=headers, data=json.dumps(data))
+            response = requests.post(url, headers=headers, data=json.dumps(data), timeout=(3.05, 10))
             result = response.json()
             response.raise_for_status()  # Raise exception for HTTP errors
             print(f"Successfully posted to {url}")
@@ -564,9 +874,15 @@ class GptModelManager:
         except Exception as err:
             print(f"Other error occurred: {err}")
 
+    # Method to get the backoffice context id of a client topic (raises an error if the backoffice API doesn't return it)
+    def get_backoffice_context_id(self, client_topic):
+        data = {"projectId": keyvault_manager.get_secret("PROJECT-ID"), "contextName": client_topic}
+        result = self.post_data_get_context_id(BACKOFFICE_CONTEXTS_URL, data, self.get_backoffice_headers())
+        if not result or "contextId" not in result:
+            raise ValueError(f"no context id returned for {client_topic}")
+        return result["contextId"]
+
     # Method to calculate the token usage of a text
     def get_token_usage(self, text):
-        encoding = tiktoken.encoding_for_model("gpt-4o")
-        tokens = len(encoding.encode(text))
-        return tokens    
+        return self.token_counter.count(text)    
         
@@ -0,0 +1,134 @@
+from langchain_openai import AzureChatOpenAI
+import importlib.util
+import threading
+import asyncio
+import httpx
+import os
+
+
+# LlmClientRegistry class
+# Process-wide Azure OpenAI chat clients: one client per configuration (deployment, temperature, streaming, ...),
+# all sharing the same pooled HTTP connections (keep-alive, HTTP/2 when the h2 package is installed)
+# The endpoint and api key come from the KeyvaultManager secret cache; the clients and the connection pools are only
+# rebuilt when one of them changes (secret rotation); the replaced HTTP clients are closed after retired_close_seconds,
+# so the streams still running on them can finish
+class LlmClientRegistry:
+
+    def __init__(self, keyvault_manager, max_connections:int = 100,
+                 max_keepalive_connections:int = 20, keepalive_expiry:float = 60, timeout_seconds:float = 60,
+                 http2:bool = True, retired_close_seconds:float = 300):
+        self._keyvault_manager = keyvault_manager
+        self._limits = httpx.Limits(max_connections=max_connections,
+                                    max_keepalive_connections=max_keepalive_connections,
+                                    keepalive_expiry=keepalive_expiry)
+        # Short connect timeout, long read timeout (the answers are streamed)
+        self._timeout = httpx.Timeout(timeout_seconds, connect=10.0)
+        self._http2 = http2 and importlib.util.find_spec("h2") is not None
+        self._lock = threading.Lock()
+        self._credentials = None
+        self._http_client = None
+        self._http_async_client = None
+        # Event loop of the last request of the async HTTP client (its connections must be closed on that loop)
+        self._http_async_loop = None
+        self._retired_close_seconds = retired_close_seconds
+        self._retired_http_clients = 0
+        self._clients = {}
+        self._rebuilds = 0
+
+    # Method to get the endpoint and api key (cached secrets)
+    def _get_credentials(self):
+        credentials = (self._keyvault_manager.get_secret("AZURE-OPENAI-ENDPOINT"),
+                       self._keyvault_manager.get_secret("AZURE-OPENAI-API-KEY"))
+
+        # New secrets: drop the clients (and connections) created with the old ones
+        if credentials != self._credentials:
+            if self._credentials is not None:
+                print("Azure OpenAI secrets changed, rebuilding the GPT model clients")
+                self._rebuilds += 1
+            self._retire_http_clients()
+            self._clients = {}
+            self._credentials = credentials
+
+        return self._credentials
+
+    # Method to replace the pooled HTTP clients: the old ones are closed later (not now, the streams still running on
+    # them finish normally)
+    def _retire_http_clients(self):
+        if self._http_client is not None:
+            timer = threading.Timer(self._retired_close_seconds, self._close_http_clients,
+                                    args=(self._http_client, self._http_async_client, self._http_async_loop))
+            timer.daemon = True
+            timer.start()
+            self._retired_http_clients += 1
+        self._http_client = None
+        self._http_async_client = None
+        self._http_async_loop = None
+
+    # Method to close retired HTTP clients and their pooled connections (the async client on its event loop)
+    def _close_http_clients(self, http_client, http_async_client, http_async_loop):
+        try:
+            http_client.close()
+            loop = http_async_loop[0]
+            if loop is not None and not loop.is_closed():
+                asyncio.run_coroutine_threadsafe(http_async_client.aclose(), loop)
+        except Exception as e:
+            print(f"Could not close the retired Azure OpenAI HTTP clients: {e}")
+        with self._lock:
+            self._retired_http_clients -= 1
+
+    # Method to get the pooled HTTP clients
+    def _get_http_clients(self):
+        if self._http_client is None:
+            http_async_loop = [None]
+
+            async def record_loop(request):
+                http_async_loop[0] = asyncio.get_running_loop()
+
+            self._http_client = httpx.Client(limits=self._limits, timeout=self._timeout, http2=self._http2)
+            self._http_async_client = httpx.AsyncClient(limits=self._limits, timeout=self._timeout, http2=self._http2,
+                                                        event_hooks={"request": [record_loop]})
+            self._http_async_loop = http_async_loop
+        return self._http_client, self._http_async_client
+
+    # Method to get the chat client of a configuration; load some environment variables
+    def get_model(self, temperature:float = 0, streaming:bool = True, stream_usage:bool = True,
+                  deployment:str = None, api_version:str = None):
+        deployment = deployment or os.environ["AZURE_OPENAI_GPTMODEL_NAME"]
+        api_version = api_version or os.environ["AZURE_OPENAI_VERSION"]
+        configuration = (deployment, api_version, temperature, streaming, stream_usage)
+
+        with self._lock:
+            azure_endpoint, api_key = self._get_credentials()
+            model = self._clients.get(configuration)
+            if model is None:
+                http_client, http_async_client = self._get_http_clients()
+                model = AzureChatOpenAI(
+                    api_version=api_version,
+                    azure_deployment=deployment,
+                    azure_endpoint=azure_endpoint,
+                    api_key=api_key,
+                    temperature=temperature,
+                    streaming=streaming,
+                    # Ask Azure OpenAI for the token usage at the end of each stream
+                    model_kwargs={"stream_options": {"include_usage": True}} if streaming and stream_usage else {},
+                    http_client=http_client,
+                    http_async_client=http_async_client
+                )
+                self._clients[configuration] = model
+
+        return model
+
+    # Method to refresh the secrets from the Key Vault (e.g. after an authentication error)
+    def invalidate_credentials(self):
+        self._keyvault_manager.expire_secret("AZURE-OPENAI-ENDPOINT")
+        self._keyvault_manager.expire_secret("AZURE-OPENAI-API-KEY")
+
+    # Method to get the registry statistics
+    def get_stats(self) -> dict:
+        with self._lock:
+            return {
+                "clients": len(self._clients),
+                "http2": self._http2,
+                "secret_rebuilds": self._rebuilds,
+                "retired_http_clients": self._retired_http_clients
+            }
@@ -0,0 +1,67 @@
+import contextlib
+import threading
+import time
+
+
+# RequestContext class
+# State of a single user request (language, GPT model, timings and token usage), passed through the GptModelManager
+# methods so concurrent requests in the same worker don't share it
+class RequestContext:
+
+    def __init__(self, language:str, model, start_time:float = None, stage_metrics=None):
+        self.language = language
+        self.model = model
+        self.start_time = time.time() if start_time is None else start_time
+        self.response_prompt_tokens = 0
+        self.response_completion_tokens = 0
+        self.context_list = []
+        # Prompt texts of the streamed generation, counted after the stream if Azure OpenAI doesn't return the usage
+        self.generation_prompt_texts = None
+        # Lock for the token counters (the pre-generation stages may run concurrently)
+        self._tokens_lock = threading.Lock()
+        # Duration of each stage of the request in seconds (also recorded in the stage metrics, if given)
+        self.timings = {}
+        self._stage_metrics = stage_metrics
+
+    # Method to get the response prompt tokens
+    def get_response_prompt_tokens(self):
+        return self.response_prompt_tokens
+
+    # Method to set the response prompt tokens
+    def set_response_prompt_tokens(self, tokens):
+        with self._tokens_lock:
+            self.response_prompt_tokens = int(self.response_prompt_tokens)+int(tokens)
+
+    # Method to get the completion response prompt tokens
+    def get_response_completion_tokens(self):
+        return self.response_completion_tokens
+
+    # Method to set the completion response prompt tokens
+    def set_response_completion_tokens(self, tokens):
+        with self._tokens_lock:
+            self.response_completion_tokens = int(self.response_completion_tokens)+int(tokens)
+
+    # Method to set the conversation context
+    def add_element_to_context_list(self, context):
+        self.context_list.append(str(context))
+
+    # Method to time a stage of the request (with statement)
+    def span(self, stage:str):
+        if self._stage_metrics is None:
+            return contextlib.nullcontext()
+        return self._stage_metrics.span(stage, self.timings)
+
+    # Method to run a function as a stage of the request and get its result
+    def timed(self, stage:str, function, *args):
+        with self.span(stage):
+            return function(*args)
+
+    # Method to record the duration of a stage measured by the caller (e.g. the time to the first token)
+    def observe(self, stage:str, seconds:float, outcome:str = "ok"):
+        if self._stage_metrics is not None:
+            self._stage_metrics.observe(stage, seconds, outcome)
+            self.timings[stage] = self.timings.get(stage, 0.0) + seconds
+
+    # Method to get the stage durations in milliseconds (for the logs)
+    def get_timings(self) -> dict:
+        return {stage: round(seconds * 1000, 1) for stage, seconds in list(self.timings.items())}
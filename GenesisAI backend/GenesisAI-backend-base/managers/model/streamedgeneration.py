@@ -0,0 +1,74 @@
+import uuid
+import time
+
+
+# StreamedGeneration class
+# State of a streamed GPT model answer (chunks, message id, token usage and timings), shared by the sync and async
+# generate methods of GptModelManager; the add and close methods return the frames to send to the frontend
+class StreamedGeneration:
+
+    def __init__(self, request_context, framer, policy_violation_reply:tuple):
+        self.request_context = request_context
+        self.framer = framer
+        # Reply and completion tokens of a Responsible AI Policy Violation, in the request language
+        self._policy_violation_reply = policy_violation_reply
+        # Chunks of the answer, joined at the end of the stream
+        self.response_parts = []
+        self.response_tokens = 0
+        self.usage = None
+        self.message_id = ""
+        # Time when the answer starts to show on frontend (first content chunk, or the policy violation reply)
+        self.first_token_time = None
+        self.start_time = time.time()
+        self.outcome = "ok"
+        self.policy_violation = False
+
+    # Method to add a chunk of the GPT model stream
+    def add_chunk(self, chunk) -> list:
+        # Token usage of the generation (last chunk of the stream, without content)
+        if getattr(chunk, 'usage_metadata', None):
+            self.usage = chunk.usage_metadata
+        if not chunk.content:
+            return []
+        if self.first_token_time is None:
+            self.first_token_time = time.time()
+            self.request_context.observe("time_to_first_token", self.first_token_time - self.request_context.start_time)
+        if chunk.id and not self.message_id:
+            self.message_id = chunk.id
+        self.response_parts.append(chunk.content)
+        return self.framer.write(chunk.content, self.message_id)
+
+    # Method to send the content buffered by the framer (the GPT model didn't send a chunk within the flush interval)
+    def flush(self) -> list:
+        return self.framer.flush()
+
+    # Method to handle an error of the GPT model stream (the content filter errors get the policy violation reply)
+    def add_error(self, error:Exception) -> list:
+        if "responsibleaipolicyviolation" in str(error).lower().strip():
+            return self.add_policy_violation_reply()
+        self.outcome = "error"
+        print(f"Error streaming the GPT model response: {error}")
+        return []
+
+    # Method to reply with the Responsible AI Policy Violation message (it has no GPT model message id)
+    def add_policy_violation_reply(self) -> list:
+        content, self.response_tokens = self._policy_violation_reply
+        self.response_parts = [content]
+        self.policy_violation = True
+        self.first_token_time = time.time()
+        return self.framer.write(content, str(uuid.uuid4()))
+
+    # Method to end the stream (buffered content of the framed formats)
+    def close(self) -> list:
+        self.request_context.observe("generation", time.time() - self.start_time, self.outcome)
+        return self.framer.close()
+
+    # Method to get the full answer
+    @property
+    def full_response(self) -> str:
+        return "".join(self.response_parts)
+
+    # Method to check if the GPT model answer is complete (not cut by an error, not a policy violation reply)
+    @property
+    def completed(self) -> bool:
+        return self.outcome == "ok" and not self.policy_violation
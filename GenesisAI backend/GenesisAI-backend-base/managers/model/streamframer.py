@@ -0,0 +1,99 @@
+import orjson
+import json
+import time
+
+# Stream formats of the chat endpoint:
+# - "legacy": a JSON object per GPT model chunk, without delimiter (text/plain, the format of the old frontends)
+# - "ndjson": a JSON object per line (application/x-ndjson)
+# - "sse": Server-Sent Events, a JSON object per "data:" event (text/event-stream)
+# The ndjson and sse streams end with a {"content": "", "message_id": ..., "done": true} object ("done" event in sse)
+LEGACY_FORMAT = "legacy"
+NDJSON_FORMAT = "ndjson"
+SSE_FORMAT = "sse"
+STREAM_MIMETYPES = {
+    LEGACY_FORMAT: "text/plain",
+    NDJSON_FORMAT: "application/x-ndjson",
+    SSE_FORMAT: "text/event-stream"
+}
+
+
+# StreamFramer class
+# Frames the chunks of a streamed answer in one of the stream formats
+# In the ndjson and sse formats the chunks are coalesced: the content is sent when flush_interval_ms passed since the
+# last frame or flush_bytes were buffered (the first chunk is sent right away, so the time to first token doesn't change)
+# When the GPT model stalls, the buffered content is sent by the flush timer of GptModelManager (flush_delay and flush)
+# A framer is used by a single request
+class StreamFramer:
+
+    def __init__(self, stream_format:str = LEGACY_FORMAT, flush_interval_ms:float = 0, flush_bytes:int = 0):
+        self.stream_format = stream_format if stream_format in STREAM_MIMETYPES else LEGACY_FORMAT
+        self._flush_interval_seconds = flush_interval_ms / 1000
+        self._flush_bytes = flush_bytes
+        self._buffer = []
+        self._buffered_bytes = 0
+        self._last_flush_time = None
+        self._message_id = ""
+
+    # Method to get the response mimetype of the stream format
+    @property
+    def mimetype(self) -> str:
+        return STREAM_MIMETYPES[self.stream_format]
+
+    # Method to check if the chunks are coalesced (and the stream needs the flush timer)
+    @property
+    def coalesces(self) -> bool:
+        return self.stream_format != LEGACY_FORMAT and self._flush_interval_seconds > 0
+
+    # Method to get the seconds until the buffered content must be sent (None if nothing is buffered)
+    def flush_delay(self):
+        if not self._buffer:
+            return None
+        return max(0.0, self._last_flush_time + self._flush_interval_seconds - time.monotonic())
+
+    # Method to get the response headers of the stream format (no proxy buffering for the framed formats)
+    @property
+    def headers(self) -> dict:
+        if self.stream_format == LEGACY_FORMAT:
+            return {}
+        return {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+    # Method to encode a frame
+    def _encode(self, data:dict, event:str = None) -> bytes:
+        payload = orjson.dumps(data)
+        if self.stream_format == SSE_FORMAT:
+            return (b"event: " + event.encode("utf-8") + b"\n" if event else b"") + b"data: " + payload + b"\n\n"
+        return payload + b"\n"
+
+    # Method to get the frame of the buffered content
+    def _flush(self) -> bytes:
+        frame = self._encode({"content": "".join(self._buffer), "message_id": self._message_id})
+        self._buffer = []
+        self._buffered_bytes = 0
+        self._last_flush_time = time.monotonic()
+        return frame
+
+    # Method to add a chunk of the answer; returns the frames to send now (none if the chunk is buffered)
+    def write(self, content:str, message_id:str) -> list:
+        if self.stream_format == LEGACY_FORMAT:
+            return [json.dumps({"content": content, "message_id": message_id})]
+
+        self._buffer.append(content)
+        self._buffered_bytes += len(content.encode("utf-8"))
+        self._message_id = message_id
+        if (self._last_flush_time is None
+                or time.monotonic() - self._last_flush_time >= self._flush_interval_seconds
+                or (self._flush_bytes and self._buffered_bytes >= self._flush_bytes)):
+            return [self._flush()]
+        return []
+
+    # Method to send the buffered content now (flush timer); returns its frame (none if nothing is buffered)
+    def flush(self) -> list:
+        return [self._flush()] if self._buffer else []
+
+    # Method to end the stream; returns the frames of the buffered content and the end of the stream
+    def close(self) -> list:
+        if self.stream_format == LEGACY_FORMAT:
+            return []
+        frames = [self._flush()] if self._buffer else []
+        frames.append(self._encode({"content": "", "message_id": self._message_id, "done": True}, event="done"))
+        return frames
@@ -0,0 +1,67 @@
+import threading
+import tiktoken
+
+# Encodings already loaded, shared by all the token counters of the process (loading one takes tens of milliseconds)
+_encodings = {}
+_encodings_lock = threading.Lock()
+
+
+# Method to get the tiktoken encoding of a model, loaded only once per process
+def get_encoding(model_name:str):
+    encoding = _encodings.get(model_name)
+    if encoding is None:
+        with _encodings_lock:
+            encoding = _encodings.get(model_name)
+            if encoding is None:
+                encoding = tiktoken.encoding_for_model(model_name)
+                _encodings[model_name] = encoding
+    return encoding
+
+
+# TokenCounter class
+# Local token estimates, used when the GPT model response has no usage numbers
+# The static prompts (templates already formatted for each language) are counted once and looked up afterwards
+class TokenCounter:
+
+    def __init__(self, model_name:str = "gpt-4o"):
+        self.model_name = model_name
+        self._encoding = get_encoding(model_name)
+        self._static_counts: dict[str, int] = {}
+
+    # Method to count and keep the tokens of static texts (e.g. system prompts)
+    def precompute(self, texts):
+        texts = [text for text in dict.fromkeys(texts) if text and text not in self._static_counts]
+        for text, tokens in zip(texts, self._encode_batch(texts)):
+            self._static_counts[text] = len(tokens)
+
+    # Method to count the tokens of a text
+    def count(self, text) -> int:
+        if not text:
+            return 0
+        tokens = self._static_counts.get(text)
+        if tokens is None:
+            # Special tokens in the user text are counted as ordinary text (instead of raising an error)
+            tokens = len(self._encoding.encode(text, disallowed_special=()))
+        return tokens
+
+    # Method to count the total tokens of several texts (the texts not precomputed are encoded in a single batch)
+    def count_batch(self, texts) -> int:
+        total = 0
+        missing = []
+        for text in texts:
+            if not text:
+                continue
+            tokens = self._static_counts.get(text)
+            if tokens is None:
+                missing.append(text)
+            else:
+                total += tokens
+        if missing:
+            total += sum(len(tokens) for tokens in self._encode_batch(missing))
+        return total
+
+    # Method to encode several texts in parallel (tiktoken batch encoding)
+    def _encode_batch(self, texts):
+        if len(texts) == 1:
+            return [self._encoding.encode(texts[0], disallowed_special=())]
+        return self._encoding.encode_batch(texts, disallowed_special=())
@@ -0,0 +1,92 @@
+from concurrent.futures import ThreadPoolExecutor, Future
+import threading
+
+
+# StageScheduler class
+# Runs the independent pre-generation stages of a request at the same time on a shared thread pool
+class StageScheduler:
+
+    def __init__(self, max_workers:int, timeout_seconds:float = 30):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="genesisai-stage")
+        self.max_workers = max_workers
+        self.timeout_seconds = timeout_seconds
+
+    # Method to create the stages run of a new request
+    def new_run(self):
+        return StageRun(self._executor, self.timeout_seconds)
+
+    # Method to stop the thread pool (the queued stages are cancelled)
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+# StageRun class
+# Each stage is a function of the results of the stages it depends on, and starts as soon as they are finished
+# An inline stage isn't queued on the pool: it runs on the thread that asks for its result (the request thread, which
+# would otherwise wait idle), so it never waits behind the stages of other requests
+class StageRun:
+
+    def __init__(self, executor:ThreadPoolExecutor, timeout_seconds:float = None):
+        self._executor = executor
+        self._timeout_seconds = timeout_seconds
+        self._stages: dict[str, Future] = {}
+        self._inline_stages = {}
+
+    # Method to add a stage; the function receives the dependencies results as positional arguments
+    def add(self, name:str, function, depends_on:tuple = (), inline:bool = False) -> Future:
+        stage_future = Future()
+        dependencies = [self._stages[dependency] for dependency in depends_on]
+        self._stages[name] = stage_future
+
+        def run_stage():
+            if not stage_future.set_running_or_notify_cancel():
+                return
+            try:
+                result = function(*[dependency.result(timeout=self._timeout_seconds) for dependency in dependencies])
+            except BaseException as e:
+                stage_future.set_exception(e)
+            else:
+                stage_future.set_result(result)
+
+        if inline:
+            self._inline_stages[name] = run_stage
+            return stage_future
+
+        if not dependencies:
+            self._submit(stage_future, run_stage)
+            return stage_future
+
+        # Start the stage when the last dependency finishes (without holding a pool thread while waiting)
+        pending_dependencies = [len(dependencies)]
+        pending_lock = threading.Lock()
+
+        def on_dependency_done(_):
+            with pending_lock:
+                pending_dependencies[0] -= 1
+                ready = pending_dependencies[0] == 0
+            if ready:
+                self._submit(stage_future, run_stage)
+
+        for dependency in dependencies:
+            dependency.add_done_callback(on_dependency_done)
+
+        return stage_future
+
+    # Method to queue a stage on the pool; a stage that can't be queued or is dropped by the pool shutdown ends with
+    # an error or cancelled (otherwise its result would never come)
+    def _submit(self, stage_future:Future, run_stage):
+        try:
+            pool_future = self._executor.submit(run_stage)
+        except RuntimeError as e:
+            if stage_future.set_running_or_notify_cancel():
+                stage_future.set_exception(e)
+            return
+        pool_future.add_done_callback(lambda pool_future: pool_future.cancelled() and stage_future.cancel())
+
+    # Method to wait for a stage and get its result (raises the stage exception, if any, or TimeoutError)
+    # An inline stage runs now, on the calling thread
+    def result(self, name:str, timeout:float = None):
+        inline_stage = self._inline_stages.pop(name, None)
+        if inline_stage is not None:
+            inline_stage()
+        return self._stages[name].result(timeout=self._timeout_seconds if timeout is None else timeout)
@@ -0,0 +1,150 @@
+import azure.cognitiveservices.speech as speechsdk
+from contextlib import contextmanager, asynccontextmanager
+import threading
+import asyncio
+
+
+# SpeechConfigPool class
+# Speech recognition configurations of each language, reused by the next recognitions (up to max_configs_per_language
+# idle configurations per language), and a cap on the recognitions running at the same time in the process
+# The recognitions over the cap wait in line (up to queue_timeout_seconds, then TimeoutError), so a worker doesn't
+# open an unbounded number of Speech SDK sessions
+# The key and region come from the KeyvaultManager secret cache; the idle configurations are dropped when they change
+class SpeechConfigPool:
+
+    def __init__(self, keyvault_manager, max_recognitions:int = 16, max_configs_per_language:int = 4,
+                 queue_timeout_seconds:float = 30):
+        self._keyvault_manager = keyvault_manager
+        self.max_recognitions = max_recognitions
+        self.max_configs_per_language = max_configs_per_language
+        self.queue_timeout_seconds = queue_timeout_seconds
+        self._slots = threading.BoundedSemaphore(max_recognitions)
+        self._lock = threading.Lock()
+        self._credentials = None
+        # language -> idle configurations (last released first)
+        self._idle = {}
+        self._stats = {"in_use": 0, "waiting": 0, "created": 0, "reused": 0, "queued": 0, "queue_timeouts": 0,
+                       "queue_canceled": 0}
+
+    # Method to get the key and region (cached secrets)
+    def _get_credentials(self) -> tuple:
+        return (self._keyvault_manager.get_secret("AISPEECH-KEY"), self._keyvault_manager.get_secret("AISPEECH-REGION"))
+
+    # Method to take an idle configuration of a language, or create one
+    def _take(self, language:str):
+        credentials = self._get_credentials()
+        with self._lock:
+            # New secrets: drop the configurations created with the old ones
+            if credentials != self._credentials:
+                self._idle = {}
+                self._credentials = credentials
+            idle = self._idle.get(language)
+            if idle:
+                self._stats["reused"] += 1
+                return idle.pop(), credentials
+            self._stats["created"] += 1
+
+        speech_config = speechsdk.SpeechConfig(subscription=credentials[0], region=credentials[1])
+        speech_config.speech_recognition_language = language
+        return speech_config, credentials
+
+    # Method to give back a configuration and its recognition slot
+    def _give_back(self, language:str, speech_config, credentials:tuple):
+        with self._lock:
+            self._stats["in_use"] -= 1
+            if credentials == self._credentials:
+                idle = self._idle.setdefault(language, [])
+                if len(idle) < self.max_configs_per_language:
+                    idle.append(speech_config)
+        self._slots.release()
+
+    # Method to count a recognition that got its slot
+    def _count_start(self, queued:bool):
+        with self._lock:
+            self._stats["in_use"] += 1
+            if queued:
+                self._stats["queued"] += 1
+                self._stats["waiting"] -= 1
+
+    # Method to count a recognition that has to wait for a slot
+    def _count_wait(self):
+        with self._lock:
+            self._stats["waiting"] += 1
+
+    # Method to count a recognition that waited too long for a slot
+    def _count_timeout(self):
+        with self._lock:
+            self._stats["waiting"] -= 1
+            self._stats["queue_timeouts"] += 1
+
+    # Method to get a configuration of a language for a recognition (blocks while the pool is full)
+    @contextmanager
+    def lease(self, language:str):
+        queued = not self._slots.acquire(blocking=False)
+        if queued:
+            self._count_wait()
+            if not self._slots.acquire(timeout=self.queue_timeout_seconds):
+                self._count_timeout()
+                raise TimeoutError("Too many speech recognitions at the same time, try again later")
+        self._count_start(queued)
+
+        try:
+            speech_config, credentials = self._take(language)
+        except Exception:
+            with self._lock:
+                self._stats["in_use"] -= 1
+            self._slots.release()
+            raise
+
+        try:
+            yield speech_config
+        finally:
+            self._give_back(language, speech_config, credentials)
+
+    # Method to get a configuration of a language for a recognition on an event loop (waits in a worker thread while
+    # the pool is full)
+    @asynccontextmanager
+    async def alease(self, language:str):
+        queued = not self._slots.acquire(blocking=False)
+        if queued:
+            self._count_wait()
+            future = asyncio.get_running_loop().run_in_executor(None, self._slots.acquire, True, self.queue_timeout_seconds)
+            try:
+                acquired = await asyncio.shield(future)
+            except asyncio.CancelledError:
+                # The slot may still be acquired by the worker thread after the request is gone: give it back
+                future.add_done_callback(self._release_abandoned)
+                raise
+            if not acquired:
+                self._count_timeout()
+                raise TimeoutError("Too many speech recognitions at the same time, try again later")
+        self._count_start(queued)
+
+        try:
+            speech_config, credentials = await asyncio.to_thread(self._take, language)
+        except BaseException:
+            with self._lock:
+                self._stats["in_use"] -= 1
+            self._slots.release()
+            raise
+
+        try:
+            yield speech_config
+        finally:
+            self._give_back(language, speech_config, credentials)
+
+    # Method to give back the slot of a canceled wait
+    def _release_abandoned(self, future):
+        with self._lock:
+            self._stats["waiting"] -= 1
+            self._stats["queue_canceled"] += 1
+        if not future.cancelled() and future.exception() is None and future.result():
+            self._slots.release()
+
+    # Method to get the pool statistics
+    def get_stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["idle"] = sum(len(idle) for idle in self._idle.values())
+        stats["max_recognitions"] = self.max_recognitions
+        return stats
@@ -0,0 +1,467 @@
+import azure.cognitiveservices.speech as speechsdk
+import subprocess
+import threading
+import tempfile
+import queue
+import asyncio
+import shutil
+import ctypes
+import struct
+import time
+import os
+
+# Audio format of the recognizer: mono, 16-bits per sample, 16KHz PCM
+SAMPLE_RATE = 16000
+BITS_PER_SAMPLE = 16
+CHANNELS = 1
+BYTES_PER_SECOND = SAMPLE_RATE * BITS_PER_SAMPLE // 8 * CHANNELS
+# Audio pushed to the recognizer at a time (1 second)
+PUSH_CHUNK_BYTES = BYTES_PER_SECOND
+# Reads of the uploaded file and of the ffmpeg output
+READ_CHUNK_BYTES = 1024 * 1024
+# Reads of a streamed upload (100 milliseconds, so the partial results follow the audio)
+STREAM_CHUNK_BYTES = BYTES_PER_SECOND // 10
+
+# Azure voice of each language, when the text to speech request has no voice name
+VOICE_MAP = {
+    'pt-PT': 'pt-PT-DuarteNeural',  # Portuguese (Portugal) - Male
+    'pt-BR': 'pt-BR-AntonioNeural',  # Portuguese (Brazil) - Male
+    'en-US': 'en-US-JennyNeural',    # English (US) - Female
+    'en-GB': 'en-GB-RyanNeural',     # English (UK) - Male
+    'es-ES': 'es-ES-AlvaroNeural',   # Spanish (Spain) - Male
+    'fr-FR': 'fr-FR-DeniseNeural',   # French - Female
+}
+DEFAULT_VOICE = 'pt-PT-DuarteNeural'
+
+
+# SpeechManager class
+# Speech to text and text to speech with Azure AI Speech, for the WSGI (blocking) and ASGI (awaitable) endpoints
+# The uploaded audio is decoded once to the recognizer format (16KHz 16-bits mono PCM): WAV files already in that format
+# are read as they are, the others are converted by ffmpeg from a spool file
+# Clips up to recognize_once_max_seconds are recognized with single-shot recognitions; the longer ones with a continuous
+# recognition, whose end (session stopped or canceled) is signaled by the Speech SDK events, up to
+# recognition_timeout_seconds plus the audio duration
+# The speech configurations come from a SpeechConfigPool, that also caps the recognitions running at the same time
+# The awaitable recognition waits for the Speech SDK events on the event loop, without holding a thread
+# Streamed audio (PCM chunks sent while the user speaks) is recognized as it arrives, with the partial and final results
+# returned as events; the audio after stream_max_seconds is ignored, a stream without audio for
+# stream_idle_timeout_seconds or longer than stream_max_seconds plus recognition_timeout_seconds ends with a TimeoutError
+# (so an idle client doesn't hold a recognition of the pool)
+class SpeechManager:
+
+    def __init__(self, keyvault_manager, stage_metrics, config_pool=None, ffmpeg_path:str = "ffmpeg", spool_folder:str = None,
+                 recognize_once_max_seconds:float = 15, recognition_timeout_seconds:float = 30, stream_max_seconds:float = 300,
+                 stream_idle_timeout_seconds:float = 10):
+        self._keyvault_manager = keyvault_manager
+        self._stage_metrics = stage_metrics
+        self.config_pool = config_pool
+        self._ffmpeg_path = ffmpeg_path
+        self._spool_folder = spool_folder
+        self.recognize_once_max_seconds = recognize_once_max_seconds
+        self.recognition_timeout_seconds = recognition_timeout_seconds
+        self.stream_max_seconds = stream_max_seconds
+        self.stream_idle_timeout_seconds = stream_idle_timeout_seconds
+        self.stream_chunk_bytes = STREAM_CHUNK_BYTES
+
+    # Method to decode an uploaded audio file; returns the recognizer PCM samples (bytearray) and the audio duration in seconds
+    def decode_audio(self, file) -> tuple:
+        with self._stage_metrics.span('speech_decode'):
+            pcm = self._read_pcm_wav(file)
+            if pcm is None:
+                file.seek(0)
+                pcm = self._decode_ffmpeg(file)
+
+        return pcm, len(pcm) / BYTES_PER_SECOND
+
+    # Method to read the samples of a WAV file already in the recognizer format (None for other files and formats)
+    def _read_pcm_wav(self, file):
+        header = file.read(12)
+        if len(header) < 12 or header[:4] != b"RIFF" or header[8:12] != b"WAVE":
+            return None
+
+        pcm_format = False
+        while True:
+            chunk_header = file.read(8)
+            if len(chunk_header) < 8:
+                return None
+            chunk_id, chunk_size = struct.unpack("<4sI", chunk_header)
+            if chunk_id == b"fmt ":
+                fmt = file.read(chunk_size + chunk_size % 2)
+                if len(fmt) < 16:
+                    return None
+                audio_format, channels, sample_rate, _, _, bits_per_sample = struct.unpack("<HHIIHH", fmt[:16])
+                pcm_format = (audio_format == 1 and channels == CHANNELS and sample_rate == SAMPLE_RATE
+                              and bits_per_sample == BITS_PER_SAMPLE)
+                if not pcm_format:
+                    return None
+            elif chunk_id == b"data":
+                if not pcm_format:
+                    return None
+                # Streamed WAV files may have an unknown data size (0 or 0xFFFFFFFF): read to the end
+                if chunk_size in (0, 0xFFFFFFFF):
+                    return self._read_all(file)
+                pcm = bytearray(chunk_size)
+                view = memoryview(pcm)
+                position = 0
+                while position < chunk_size:
+                    read_size = file.readinto(view[position:position + READ_CHUNK_BYTES])
+                    if not read_size:
+                        break
+                    position += read_size
+                # Whole samples only (truncated uploads)
+                del view
+                del pcm[position - position % 2:]
+                return pcm
+            else:
+                file.seek(chunk_size + chunk_size % 2, os.SEEK_CUR)
+
+    # Method to read a file (or pipe) to the end in a bytearray, keeping whole samples only
+    def _read_all(self, file) -> bytearray:
+        pcm = bytearray()
+        while True:
+            data = file.read(READ_CHUNK_BYTES)
+            if not data:
+                break
+            pcm += data
+        del pcm[len(pcm) - len(pcm) % 2:]
+        return pcm
+
+    # Method to convert an audio file to the recognizer format with ffmpeg (the upload is spooled to disk first, so
+    # formats that need to seek, like MP4, can be decoded and large uploads aren't kept in memory)
+    def _decode_ffmpeg(self, file) -> bytearray:
+        with tempfile.NamedTemporaryFile(dir=self._spool_folder, suffix=".audio") as spool_file, \
+                tempfile.TemporaryFile(dir=self._spool_folder) as error_file:
+            shutil.copyfileobj(file, spool_file, READ_CHUNK_BYTES)
+            spool_file.flush()
+
+            command = [self._ffmpeg_path, "-nostdin", "-hide_banner", "-loglevel", "error", "-i", spool_file.name,
+                       "-vn", "-f", "s16le", "-acodec", "pcm_s16le", "-ac", str(CHANNELS), "-ar", str(SAMPLE_RATE), "pipe:1"]
+            # The ffmpeg errors go to a file, so a long error output can't block the PCM pipe
+            with subprocess.Popen(command, stdout=subprocess.PIPE, stderr=error_file) as process:
+                pcm = self._read_all(process.stdout)
+            if process.returncode != 0:
+                error_file.seek(0)
+                raise RuntimeError(f"Could not decode the audio file: {error_file.read().decode(errors='replace').strip()}")
+        return pcm
+
+    # Method to write PCM samples to the recognizer input stream, in chunks and without copying them
+    def _push_audio(self, audio_input_stream, pcm:bytearray):
+        view = memoryview(pcm)
+        for position in range(0, len(view), PUSH_CHUNK_BYTES):
+            chunk = view[position:position + PUSH_CHUNK_BYTES]
+            # ctypes array over the bytearray memory (the Speech SDK copies it into its own buffer)
+            audio_input_stream.write((ctypes.c_char * len(chunk)).from_buffer(chunk))
+
+    # Method to get a recognizer of PCM samples and its input stream
+    def _new_recognizer(self, speech_config) -> tuple:
+        wave_format = speechsdk.audio.AudioStreamFormat(SAMPLE_RATE, BITS_PER_SAMPLE, CHANNELS)
+        audio_input_stream = speechsdk.audio.PushAudioInputStream(stream_format=wave_format)
+        audio_config = speechsdk.audio.AudioConfig(stream=audio_input_stream)
+
+        return speechsdk.SpeechRecognizer(speech_config=speech_config, audio_config=audio_config), audio_input_stream
+
+    # Method to get the maximum time of a recognition
+    def _get_timeout(self, pcm:bytearray) -> float:
+        return self.recognition_timeout_seconds + len(pcm) / BYTES_PER_SECOND
+
+    # Method to get the text of a short clip with single-shot recognitions (one per utterance, until the end of the audio)
+    def _recognize_once(self, speech_config, pcm:bytearray) -> str:
+        speech_recognizer, audio_input_stream = self._new_recognizer(speech_config)
+
+        # Stream the samples to the sdk
+        self._push_audio(audio_input_stream, pcm)
+        audio_input_stream.close()
+
+        all_results = []
+        deadline = time.monotonic() + self._get_timeout(pcm)
+        while True:
+            result = speech_recognizer.recognize_once()
+            if result.reason == speechsdk.ResultReason.RecognizedSpeech:
+                all_results.append(result.text)
+            elif result.reason == speechsdk.ResultReason.Canceled:
+                # End of the audio, or an error
+                if result.cancellation_details.reason == speechsdk.CancellationReason.Error:
+                    print('CANCELED {}'.format(result.cancellation_details))
+                break
+            # No match (silence or noise): go on with the rest of the audio
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Speech recognition timed out after {self._get_timeout(pcm):.0f} seconds")
+
+        return ' '.join(all_results)
+
+    # Method to start the continuous recognition of the PCM samples; on_stopped is called when the session stops or
+    # is canceled (from a Speech SDK thread); returns the recognizer and the list of recognized texts
+    def _start_recognition(self, speech_config, pcm:bytearray, on_stopped) -> tuple:
+        all_results = []
+
+        speech_recognizer, audio_input_stream = self._new_recognizer(speech_config)
+
+        def stop_cb(evt: speechsdk.SessionEventArgs):
+            """callback that signals to stop continuous transcription upon receiving an event `evt`"""
+            print('CLOSING {}'.format(evt))
+            on_stopped()
+        
+        # Subscribe to the events fired by the conversation transcriber
+        speech_recognizer.recognizing.connect(lambda evt: print('RECOGNIZING: {}'.format(evt)))
+        speech_recognizer.recognized.connect(lambda evt: all_results.append(evt.result.text))          
+        speech_recognizer.session_started.connect(lambda evt: print('SESSION STARTED: {}'.format(evt)))
+        speech_recognizer.session_stopped.connect(lambda evt: print('SESSION STOPPED {}'.format(evt)))
+        speech_recognizer.canceled.connect(lambda evt: print('CANCELED {}'.format(evt)))
+        # stop continuous transcription on either session stopped or canceled events
+        speech_recognizer.session_stopped.connect(stop_cb)
+        speech_recognizer.canceled.connect(stop_cb)
+
+        # Start continuous speech recognition
+        speech_recognizer.start_continuous_recognition()
+
+        # Stream the samples to the sdk
+        self._push_audio(audio_input_stream, pcm)
+        audio_input_stream.close()
+
+        return speech_recognizer, all_results
+
+    # Method to get the text of the PCM samples (blocks the calling thread until the recognition ends)
+    def recognize(self, pcm:bytearray, language:str) -> str:
+        with self._stage_metrics.span('speech_recognition'), self.config_pool.lease(language) as speech_config:
+            if len(pcm) <= self.recognize_once_max_seconds * BYTES_PER_SECOND:
+                return self._recognize_once(speech_config, pcm)
+
+            stopped = threading.Event()
+            speech_recognizer, all_results = self._start_recognition(speech_config, pcm, stopped.set)
+            try:
+                if not stopped.wait(self._get_timeout(pcm)):
+                    raise TimeoutError(f"Speech recognition timed out after {self._get_timeout(pcm):.0f} seconds")
+            finally:
+                speech_recognizer.stop_continuous_recognition()
+
+        return ' '.join(all_results)
+
+    # Method to get the text of the PCM samples on an event loop (awaits the end of the recognition session; the
+    # single-shot recognitions of short clips run in a worker thread)
+    async def arecognize(self, pcm:bytearray, language:str) -> str:
+        loop = asyncio.get_running_loop()
+        stopped = loop.create_future()
+
+        def set_stopped():
+            if not stopped.done():
+                stopped.set_result(None)
+
+        with self._stage_metrics.span('speech_recognition'):
+            async with self.config_pool.alease(language) as speech_config:
+                if len(pcm) <= self.recognize_once_max_seconds * BYTES_PER_SECOND:
+                    return await asyncio.to_thread(self._recognize_once, speech_config, pcm)
+
+                speech_recognizer, all_results = await asyncio.to_thread(
+                    self._start_recognition, speech_config, pcm, lambda: loop.call_soon_threadsafe(set_stopped))
+                try:
+                    await asyncio.wait_for(stopped, self._get_timeout(pcm))
+                except asyncio.TimeoutError:
+                    raise TimeoutError(f"Speech recognition timed out after {self._get_timeout(pcm):.0f} seconds")
+                finally:
+                    await asyncio.to_thread(speech_recognizer.stop_continuous_recognition)
+
+        return ' '.join(all_results)
+
+    # Method to start the continuous recognition of streamed audio; on_event(kind, text) is called from the Speech SDK
+    # threads with the partial ("partial") and final ("final") results, the errors ("error") and the end of the session
+    # ("stopped"); returns the recognizer and its input stream
+    def _open_stream(self, speech_config, on_event) -> tuple:
+        speech_recognizer, audio_input_stream = self._new_recognizer(speech_config)
+
+        def canceled_cb(evt: speechsdk.SpeechRecognitionCanceledEventArgs):
+            print('CANCELED {}'.format(evt))
+            if evt.cancellation_details.reason == speechsdk.CancellationReason.Error:
+                on_event("error", evt.cancellation_details.error_details)
+            on_event("stopped", "")
+
+        speech_recognizer.recognizing.connect(lambda evt: on_event("partial", evt.result.text))
+        speech_recognizer.recognized.connect(lambda evt: on_event("final", evt.result.text) if evt.result.text else None)
+        speech_recognizer.session_stopped.connect(lambda evt: on_event("stopped", ""))
+        speech_recognizer.canceled.connect(canceled_cb)
+
+        speech_recognizer.start_continuous_recognition()
+
+        return speech_recognizer, audio_input_stream
+
+    # Method to get an event of a streamed recognition for the client
+    def _get_stream_event(self, kind:str, text:str, all_results:list) -> dict:
+        if kind == "final":
+            all_results.append(text)
+        if kind == "error":
+            return {"type": "error", "message": text}
+        return {"type": kind, "text": text}
+
+    # Method to get the last event of a streamed recognition: full text and audio duration (minutes, like the upload
+    # endpoint)
+    def _get_done_event(self, all_results:list, audio_size:int) -> dict:
+        return {"type": "done", "text": ' '.join(all_results),
+                "audio_duration": float(round(audio_size / BYTES_PER_SECOND / 60, 5))}
+
+    # Method to get the next deadline of a streamed recognition and its error message: no audio for
+    # stream_idle_timeout_seconds (before the end of the audio), recognition_timeout_seconds after the end of the audio,
+    # and stream_max_seconds plus recognition_timeout_seconds in all
+    def _get_stream_deadline(self, start_time:float, last_audio_time:float, end_time:float) -> tuple:
+        max_seconds = self.stream_max_seconds + self.recognition_timeout_seconds
+        deadlines = [(start_time + max_seconds, f"Speech stream longer than {max_seconds:g} seconds")]
+        if end_time is None:
+            deadlines.append((last_audio_time + self.stream_idle_timeout_seconds,
+                              f"No audio received for {self.stream_idle_timeout_seconds:g} seconds"))
+        else:
+            deadlines.append((end_time + self.recognition_timeout_seconds,
+                              f"Speech recognition timed out after {self.recognition_timeout_seconds:.0f} seconds"))
+        return min(deadlines)
+
+    # Method to write a streamed chunk to the recognizer (the audio after stream_max_seconds is ignored); returns the
+    # audio size written so far
+    def _write_stream_chunk(self, audio_input_stream, chunk:bytes, audio_size:int) -> int:
+        if chunk and audio_size < self.stream_max_seconds * BYTES_PER_SECOND:
+            audio_input_stream.write(chunk)
+            audio_size += len(chunk)
+        return audio_size
+
+    # Method to recognize streamed PCM chunks (iterable of bytes) as they arrive; yields the partial and final results,
+    # then the "done" event (blocks the calling thread while waiting for the results; the chunks are read and written to
+    # the recognizer by a worker thread, so an idle client doesn't block the timeouts)
+    def stream_recognize(self, chunks, language:str):
+        events = queue.Queue()
+        stopping = threading.Event()
+        all_results = []
+        audio_size = 0
+
+        # Method to write the chunks to the recognizer as they arrive ("audio" events with the audio size, then an
+        # "audio_end" event with the error of the audio source, if any)
+        def feed(audio_input_stream):
+            error = None
+            size = 0
+            try:
+                for chunk in chunks:
+                    if stopping.is_set():
+                        break
+                    size = self._write_stream_chunk(audio_input_stream, chunk, size)
+                    events.put(("audio", size))
+            except Exception as e:
+                error = e
+            finally:
+                audio_input_stream.close()
+                events.put(("audio_end", error))
+
+        with self._stage_metrics.span('speech_stream_recognition'), self.config_pool.lease(language) as speech_config:
+            speech_recognizer, audio_input_stream = self._open_stream(speech_config, lambda *event: events.put(event))
+            start_time = last_audio_time = time.monotonic()
+            end_time = None
+            threading.Thread(target=feed, args=(audio_input_stream,), name="speech-stream", daemon=True).start()
+            try:
+                while True:
+                    deadline, timeout_message = self._get_stream_deadline(start_time, last_audio_time, end_time)
+                    try:
+                        kind, value = events.get(timeout=max(0.0, deadline - time.monotonic()))
+                    except queue.Empty:
+                        raise TimeoutError(timeout_message)
+                    if kind == "audio":
+                        audio_size = value
+                        last_audio_time = time.monotonic()
+                    elif kind == "audio_end":
+                        # An error of the audio source (e.g. the client went away) ends the recognition
+                        if value is not None:
+                            raise value
+                        end_time = time.monotonic()
+                    elif kind == "stopped":
+                        break
+                    else:
+                        yield self._get_stream_event(kind, value, all_results)
+                if end_time is not None:
+                    self._stage_metrics.observe('speech_stream_finish', time.monotonic() - end_time)
+            finally:
+                stopping.set()
+                speech_recognizer.stop_continuous_recognition()
+
+        yield self._get_done_event(all_results, audio_size)
+
+    # Method to recognize streamed PCM chunks (async iterable of bytes) on an event loop; yields the partial and final
+    # results as they arrive, then the "done" event
+    async def astream_recognize(self, chunks, language:str):
+        loop = asyncio.get_running_loop()
+        events = asyncio.Queue()
+        all_results = []
+        audio_size = 0
+
+        def on_event(kind, text):
+            loop.call_soon_threadsafe(events.put_nowait, (kind, text))
+
+        # Method to write the chunks to the recognizer as they arrive (same events as the stream_recognize worker)
+        async def feed(audio_input_stream):
+            error = None
+            size = 0
+            try:
+                async for chunk in chunks:
+                    size = self._write_stream_chunk(audio_input_stream, chunk, size)
+                    events.put_nowait(("audio", size))
+            except Exception as e:
+                error = e
+            finally:
+                audio_input_stream.close()
+                events.put_nowait(("audio_end", error))
+
+        with self._stage_metrics.span('speech_stream_recognition'):
+            async with self.config_pool.alease(language) as speech_config:
+                speech_recognizer, audio_input_stream = await asyncio.to_thread(self._open_stream, speech_config, on_event)
+                start_time = last_audio_time = loop.time()
+                end_time = None
+                feeder = asyncio.create_task(feed(audio_input_stream))
+                try:
+                    while True:
+                        deadline, timeout_message = self._get_stream_deadline(start_time, last_audio_time, end_time)
+                        try:
+                            kind, value = await asyncio.wait_for(events.get(), max(0.0, deadline - loop.time()))
+                        except asyncio.TimeoutError:
+                            raise TimeoutError(timeout_message)
+                        if kind == "audio":
+                            audio_size = value
+                            last_audio_time = loop.time()
+                        elif kind == "audio_end":
+                            # An error of the audio source (e.g. the client went away) ends the recognition
+                            if value is not None:
+                                raise value
+                            end_time = loop.time()
+                        elif kind == "stopped":
+                            break
+                        else:
+                            yield self._get_stream_event(kind, value, all_results)
+                    if end_time is not None:
+                        self._stage_metrics.observe('speech_stream_finish', loop.time() - end_time)
+                finally:
+                    feeder.cancel()
+                    await asyncio.to_thread(speech_recognizer.stop_continuous_recognition)
+
+        yield self._get_done_event(all_results, audio_size)
+
+    # Method to get the voice name of a language (the default voice for other languages)
+    def get_voice_name(self, language:str) -> str:
+        return VOICE_MAP.get(language, DEFAULT_VOICE)
+
+    # Method to convert a text to speech (MP3); returns the Speech SDK result
+    def synthesize(self, text:str, language:str, voice_name:str = None):
+        # Configure Azure Speech Service
+        speech_config = speechsdk.SpeechConfig(
+            subscription=self._keyvault_manager.get_secret("AISPEECH-KEY"), 
+            region="eastus"#keyvault_manager.get_secret("AISPEECH-REGION")
+        )
+        
+        # Set the voice name (based on language if not provided)
+        speech_config.speech_synthesis_voice_name = voice_name or self.get_voice_name(language)
+        
+        # Set output format to high quality audio
+        speech_config.set_speech_synthesis_output_format(
+            speechsdk.SpeechSynthesisOutputFormat.Audio16Khz32KBitRateMonoMp3
+        )
+        
+        # Create a speech synthesizer with null output (we'll get the audio data directly)
+        synthesizer = speechsdk.SpeechSynthesizer(speech_config=speech_config, audio_config=None)
+        
+        # Perform text-to-speech
+        with self._stage_metrics.span('speech_synthesis'):
+            return synthesizer.speak_text_async(text).get()
+
+    # Method to convert a text to speech on an event loop (the synthesis runs in a worker thread)
+    async def asynthesize(self, text:str, language:str, voice_name:str = None):
+        return await asyncio.to_thread(self.synthesize, text, language, voice_name)
@@ -0,0 +1,98 @@
+import os
+import json
+import tempfile
+import hashlib
+import numpy as np
+
+# Topics of the check_topic prompt that can be answered without the GPT model classification
+FAST_PATH_TOPICS = ('1', '2')
+
+TOPIC_FOLDER = os.path.dirname(__file__)
+EXEMPLARS_PATH = os.path.join(TOPIC_FOLDER, "data", "topic_exemplars.json")
+# Precomputed centroids (written at runtime, shared by the workers of the host)
+CENTROIDS_PATH = os.path.join(tempfile.gettempdir(), "genesisai-topic-centroids.npz")
+
+
+# EmbeddingTopicClassifier class
+# Nearest-centroid classifier over the embeddings of example messages of each check_topic category
+class EmbeddingTopicClassifier:
+
+    def __init__(self, embeddings, similarity_threshold:float = 0.90, margin_threshold:float = 0.05, centroids_path:str = None):
+        self._embeddings = embeddings
+        self.similarity_threshold = similarity_threshold
+        self.margin_threshold = margin_threshold
+        centroids_path = centroids_path or CENTROIDS_PATH
+
+        with open(EXEMPLARS_PATH, encoding="utf-8") as exemplars_file:
+            exemplars = json.load(exemplars_file)
+
+        # The centroids are only valid for the same exemplars and the same embeddings deployment
+        exemplars_version = hashlib.sha256(
+            (json.dumps(exemplars, sort_keys=True) + str(getattr(embeddings, "deployment", ""))).encode("utf-8")
+        ).hexdigest()
+
+        self.labels, self._centroids = self._load_centroids(centroids_path, exemplars_version)
+        if self._centroids is None:
+            self.labels, self._centroids = self._build_centroids(exemplars)
+            self._save_centroids(centroids_path, exemplars_version)
+
+    # Method to load the precomputed centroids (None if missing or computed for other exemplars)
+    def _load_centroids(self, centroids_path, exemplars_version):
+        try:
+            with np.load(centroids_path) as centroids_file:
+                if str(centroids_file["version"]) == exemplars_version:
+                    return [str(label) for label in centroids_file["labels"]], centroids_file["centroids"]
+        except Exception:
+            pass
+        return None, None
+
+    # Method to save the centroids, so the next workers/restarts don't need to embed the exemplars again
+    # The file is written next to its final path and then renamed, so the other workers never load a partial file
+    def _save_centroids(self, centroids_path, exemplars_version):
+        temp_path = None
+        try:
+            with tempfile.NamedTemporaryFile(dir=os.path.dirname(os.path.abspath(centroids_path)), suffix=".npz",
+                                             delete=False) as temp_file:
+                temp_path = temp_file.name
+                np.savez(temp_file, version=exemplars_version, labels=np.array(self.labels), centroids=self._centroids)
+            os.replace(temp_path, centroids_path)
+        except Exception as e:
+            print(f"Could not save the topic centroids: {e}")
+            if temp_path is not None and os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    # Method to embed the exemplars (a single embeddings call) and get the normalized centroid of each topic
+    def _build_centroids(self, exemplars:dict):
+        labels = list(exemplars)
+        texts = [text for label in labels for text in exemplars[label]]
+        vectors = self._normalize(np.array(self._embeddings.embed_documents(texts), dtype=np.float32))
+
+        centroids = []
+        start = 0
+        for label in labels:
+            end = start + len(exemplars[label])
+            centroids.append(vectors[start:end].mean(axis=0))
+            start = end
+
+        return labels, self._normalize(np.array(centroids, dtype=np.float32))
+
+    # Method to normalize the vectors to unit length (cosine similarity becomes a dot product)
+    def _normalize(self, vectors:np.ndarray) -> np.ndarray:
+        norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+    # Method to get the nearest topic of a message, its cosine similarity and its margin to the second nearest topic
+    def predict(self, text:str, text_embedding:list = None) -> tuple[str, float, float]:
+        if text_embedding is None:
+            text_embedding = self._embeddings.embed_query(text)
+        similarities = self._centroids @ self._normalize(np.array(text_embedding, dtype=np.float32))
+
+        best, second = np.argsort(similarities)[::-1][:2]
+        return self.labels[best], float(similarities[best]), float(similarities[best] - similarities[second])
+
+    # Method to classify a message; returns the topic only for confident topics 1 and 2, otherwise None
+    def classify(self, text:str, text_embedding:list = None):
+        topic, similarity, margin = self.predict(text, text_embedding)
+        if topic in FAST_PATH_TOPICS and similarity >= self.similarity_threshold and margin >= self.margin_threshold:
+            return topic
+        return None